@@ -0,0 +1,91 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Fake printer sender for the load benchmark. Has no printer behind it and only drives synthetic state.
+
+import random
+import threading
+import time
+
+from base_sender import BaseSender
+
+
+class Sender(BaseSender):
+
+    LINES_PER_SECOND = 2000
+    UPDATE_PERIOD = 0.5
+    HEATING_SPEED = 20 # degrees per second
+    PRINT_TEMPS = [60.0, 210.0]
+    STREAMING_SUPPORTED = True
+    STREAM_READ_AHEAD_LINES = 10000
+
+    def __init__(self, parent, usb_info, profile):
+        super().__init__(parent, usb_info, profile)
+        self.lines_done = 0
+        self.state_lock = threading.Lock()
+        self.operational_flag = True
+        self.state_thread = threading.Thread(target=self.state_loop, name="BenchSenderState", daemon=True)
+        self.state_thread.start()
+
+    def load_gcodes(self, gcodes):
+        with self.state_lock:
+            self.total_gcodes = len(gcodes)
+            self.lines_done = 0
+            self.current_line_number = 0
+            self.percent = 0.0
+            self.target_temps = list(self.PRINT_TEMPS)
+            self.heating = True
+            self.printing_flag = True
+        return True
+
+    def unbuffered_gcodes(self, gcodes):
+        return True
+
+    def cancel(self):
+        with self.state_lock:
+            if not self.printing_flag:
+                return False
+            self.printing_flag = False
+            self.pause_flag = False
+            self.target_temps = [0.0, 0.0]
+        self.register_print_cancelled_event()
+        return True
+
+    def state_loop(self):
+        last_update = time.monotonic()
+        while not self.stop_flag:
+            time.sleep(self.UPDATE_PERIOD)
+            now = time.monotonic()
+            elapsed = now - last_update
+            last_update = now
+            finished = False
+            with self.state_lock:
+                for index, target in enumerate(self.target_temps):
+                    delta = target - self.temps[index]
+                    step = max(min(delta, self.HEATING_SPEED * elapsed), -self.HEATING_SPEED * elapsed)
+                    if target:
+                        step += random.uniform(-0.2, 0.2)
+                    self.temps[index] = round(self.temps[index] + step, self.TEMPERATURE_SIGNS_AFTER_DOT)
+                if self.heating and all(abs(target - temp) < 1 for target, temp in zip(self.target_temps, self.temps)):
+                    self.heating = False
+                if self.printing_flag and not self.pause_flag and not self.heating:
+                    self.lines_done = min(self.lines_done + int(self.LINES_PER_SECOND * elapsed), self.total_gcodes)
+                    self.current_line_number = self.lines_done
+                    self.position = [random.uniform(0, 200), random.uniform(0, 200), self.lines_done / 1000.0, float(self.lines_done)]
+                    if self.total_gcodes:
+                        self.percent = round(self.lines_done / self.total_gcodes * 100, 2)
+                    if self.lines_done >= self.total_gcodes and not self.stream_loading:
+                        self.printing_flag = False
+                        self.target_temps = [0.0, 0.0]
+                        finished = True
+            if finished:
+                self.register_print_finished_event()
@@ -0,0 +1,124 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Throughput benchmark of gcodes cleaning: per line python code against bulk cleaning of whole chunks
+# Usage: python benchmarks/cleaner_benchmark.py --size-mb 100
+
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_FOLDER = os.path.join(os.path.dirname(BENCHMARKS_FOLDER), 'octoprint_3dprinteros')
+MB = 1024 * 1024
+
+
+def per_line_file(data, buffer_class):
+    # former loop of process_gcodes_file
+    gcodes_out = buffer_class()
+    for line in io.BytesIO(data):
+        line = line.split(b";")[0].strip()
+        if line:
+            gcodes_out.append(line)
+    return gcodes_out
+
+
+def bulk_file(data, buffer_class, chunk_size):
+    import gcodes_cleaner
+    gcodes_out = buffer_class()
+    for lines in gcodes_cleaner.iterate_cleaned(io.BytesIO(data), chunk_size=chunk_size):
+        gcodes_out.extend(lines)
+    return gcodes_out
+
+
+def per_line_junk(data, sender_class):
+    lines = []
+    for line in data.split(b"\n"):
+        line = sender_class.strip_line_form_junk(line)
+        if line:
+            lines.append(line)
+    return lines
+
+
+def measure(function, repeats):
+    best = None
+    result = None
+    for _ in range(repeats):
+        result = None
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput benchmark of gcodes cleaning')
+    parser.add_argument('--size-mb', type=float, default=100, help='size of generated gcodes')
+    parser.add_argument('--chunk-kb', type=int, default=1024, help='chunk size of bulk cleaning')
+    parser.add_argument('--repeats', type=int, default=3, help='best of N runs is reported')
+    parser.add_argument('--file', help='use this gcode file instead of generated gcodes')
+    parser.add_argument('--json', help='also save the report to this file')
+    args = parser.parse_args()
+
+    # importing of the client modules creates settings files in the home folder, so it is a temporary one
+    home = tempfile.mkdtemp(prefix='3dprinteros-bench-')
+    os.environ['HOME'] = home
+    os.environ['APPDATA'] = home
+    sys.path.insert(0, PACKAGE_FOLDER)
+    sys.path.insert(0, BENCHMARKS_FOLDER)
+    try:
+        import base_sender
+        from preprocess_benchmark import generate_gcodes
+        if args.file:
+            with open(args.file, 'rb') as f:
+                data = f.read()
+        else:
+            data = generate_gcodes(int(args.size_mb * MB))
+        size = len(data) / MB
+        sender_class = base_sender.BaseSender
+        buffer_class = sender_class.BUFFER_CLASS
+        cases = [
+            ('process_gcodes_file', lambda: per_line_file(data, buffer_class),
+                lambda: bulk_file(data, buffer_class, args.chunk_kb * 1024)),
+            ('strip_line_form_junk', lambda: per_line_junk(data, sender_class),
+                lambda: sender_class.strip_lines_form_junk(data))
+        ]
+        report = {'size': len(data), 'buffer_class': buffer_class.__name__, 'cases': {}}
+        print('Input: %.1fMB, buffer: %s' % (size, buffer_class.__name__))
+        print('%-22s %10s %12s %12s %9s' % ('semantics', 'lines', 'per line MB/s', 'bulk MB/s', 'speedup'))
+        for name, per_line, bulk in cases:
+            per_line_seconds, per_line_output = measure(per_line, args.repeats)
+            bulk_seconds, bulk_output = measure(bulk, args.repeats)
+            if list(per_line_output) != list(bulk_output):
+                raise RuntimeError('Bulk cleaning output differs from per line one in ' + name)
+            lines = len(bulk_output)
+            del per_line_output, bulk_output
+            report['cases'][name] = {'lines': lines, 'per_line_mb_per_second': round(size / per_line_seconds, 2),
+                                     'bulk_mb_per_second': round(size / bulk_seconds, 2)}
+            print('%-22s %10d %12.2f %12.2f %8.2fx' % (name, lines, size / per_line_seconds, size / bulk_seconds,
+                  per_line_seconds / bulk_seconds))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=4)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
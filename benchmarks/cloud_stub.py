@@ -0,0 +1,199 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Local stand-in for the cloud, that implements just enough of streamerapi and apiprinter protocols to keep clients busy
+
+import argparse
+import http.server
+import json
+import sys
+import threading
+import time
+
+BENCH_VID = 'BNCH'
+BENCH_PID = '0001'
+BENCH_SENDER = 'bench_sender'
+
+BENCH_PROFILE = {
+    "alias": "BENCH",
+    "name": "Benchmark printer",
+    "sender": BENCH_SENDER,
+    "extruder_count": 1,
+    "operational_timeout": 60,
+    "vids_pids": [[BENCH_VID, BENCH_PID]],
+    "v2": {
+        "connections": [
+            {
+                "id": "bench",
+                "name": "Benchmark connection",
+                "detector": "StaticDetector",
+                "module": BENCH_SENDER,
+                "ids": [{"VID": BENCH_VID, "PID": BENCH_PID}],
+                "type": "LAN"
+            }
+        ],
+        "model": "Benchmark printer",
+        "vendor": "3DPrinterOS"
+    }
+}
+
+
+class CloudStub:
+
+    USER_TOKEN = 'bench-user-token'
+    DOWNLOAD_PATH = '/downloads/bench.gcode'
+    GCODE_LINE = b"G1 X10.5 Y20.25 Z0.3 E1.2345 F1800 ; benchmark move\n"
+
+    def __init__(self, job_every=0, gcode_size=1024*1024):
+        self.job_every = job_every
+        self.gcode = (self.GCODE_LINE * (gcode_size // len(self.GCODE_LINE) + 1))[:gcode_size]
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.requests = {}
+        self.bytes_received = 0
+        self.command_numbers = {}
+        self.last_job_times = {}
+        self.base_url = ''
+
+    def count(self, target, length):
+        with self.lock:
+            self.requests[target] = self.requests.get(target, 0) + 1
+            self.bytes_received += length
+
+    def get_stats(self):
+        with self.lock:
+            return {'uptime': time.monotonic() - self.start_time,
+                    'requests': dict(self.requests),
+                    'bytes_received': self.bytes_received}
+
+    def reset_stats(self):
+        with self.lock:
+            self.start_time = time.monotonic()
+            self.requests = {}
+            self.bytes_received = 0
+
+    def answer(self, target, message):
+        if target == 'user_login':
+            return {'user_token': self.USER_TOKEN, 'user_login': 'benchmark', 'all_profiles': [BENCH_PROFILE]}
+        if target == 'printer_login':
+            printer = message.get('printer', {})
+            return {'printer_token': 'bench-' + str(printer.get('SNR')),
+                    'printer_profile': json.dumps(BENCH_PROFILE),
+                    'name': 'Benchmark printer ' + str(printer.get('SNR')),
+                    'conn_id': 'bench'}
+        if target == 'get_printer_profiles':
+            return [BENCH_PROFILE]
+        if target == 'register':
+            return {'auth_token': 'bench-' + str(message.get('SNR')), 'email': 'benchmark@localhost'}
+        if target == 'command':
+            return self.command_answer(message)
+        if target in ('camera', 'camera_image_jpeg'):
+            return {'state': 1}
+        if target == 'get_queued_jobs':
+            return []
+        return {}
+
+    def command_answer(self, message):
+        token = message.get('printer_token') or message.get('auth_token')
+        report = message.get('report', {})
+        now = time.monotonic()
+        with self.lock:
+            if not self.job_every or report.get('state') != 'ready':
+                return {}
+            last_job_time = self.last_job_times.setdefault(token, now)
+            if now - last_job_time < self.job_every:
+                return {}
+            self.last_job_times[token] = now
+            number = self.command_numbers.get(token, 0) + 1
+            self.command_numbers[token] = number
+        return {'command': 'gcodes', 'number': number, 'is_link': True,
+                'payload': self.base_url + self.DOWNLOAD_PATH,
+                'filename': 'bench.gcode', 'size': len(self.gcode)}
+
+
+class CloudStubHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    API_PREFIXES = ('/streamerapi/', '/apiprinter/v1/')
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type='application/json', status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        stub = self.server.stub
+        if self.path == stub.DOWNLOAD_PATH:
+            stub.count('download', 0)
+            self.send_body(stub.gcode, 'application/octet-stream')
+        elif self.path == '/stats':
+            self.send_body(json.dumps(stub.get_stats()).encode())
+        elif self.path == '/reset':
+            stub.reset_stats()
+            self.send_body(b'{}')
+        else:
+            self.send_body(b'{}', status=404)
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        for prefix in self.API_PREFIXES:
+            if self.path.startswith(prefix):
+                target = self.path[len(prefix):].split('/')[-1]
+                break
+        else:
+            self.send_body(b'{}', status=404)
+            return
+        stub.count(target, length)
+        if target == 'camera_image_jpeg':
+            message = json.loads(self.headers.get('Camera-Properties', '{}'))
+        else:
+            try:
+                message = json.loads(body) if body else {}
+            except ValueError:
+                self.send_body(b'{}', status=400)
+                return
+        self.send_body(json.dumps(stub.answer(target, message)).encode())
+
+
+def start(host='127.0.0.1', port=0, job_every=0, gcode_size=1024*1024):
+    server = http.server.ThreadingHTTPServer((host, port), CloudStubHandler)
+    server.daemon_threads = True
+    server.stub = CloudStub(job_every, gcode_size)
+    server.stub.base_url = 'http://%s:%d' % server.server_address[:2]
+    thread = threading.Thread(target=server.serve_forever, name='CloudStub', daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local 3DPrinterOS cloud stand-in for load benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--job-every', type=float, default=0, help='send a print job link to each ready printer every N seconds (0 to disable)')
+    parser.add_argument('--gcode-size', type=int, default=1024*1024, help='size of the served gcode file in bytes')
+    args = parser.parse_args()
+    server = start(args.host, args.port, args.job_every, args.gcode_size)
+    print('Listening on %s:%d' % server.server_address[:2], flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    sys.exit(0)
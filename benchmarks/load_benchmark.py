@@ -0,0 +1,311 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# End-to-end load benchmark: runs a SlaveApp with N simulated printers against a local cloud stub
+# Usage: python benchmarks/load_benchmark.py --printers 50 --duration 60
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_FOLDER = os.path.join(os.path.dirname(BENCHMARKS_FOLDER), 'octoprint_3dprinteros')
+STUB_START_TIMEOUT = 10
+WARMUP_TIMEOUT = 60
+QUIT_TIMEOUT = 30
+
+
+class LatencyStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latencies = {}
+            self.failures = {}
+
+    def add(self, target, latency, success):
+        with self.lock:
+            if success:
+                self.latencies.setdefault(target, []).append(latency)
+            else:
+                self.failures[target] = self.failures.get(target, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {target: list(values) for target, values in self.latencies.items()}, dict(self.failures)
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(percent / 100.0 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def get_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def get_max_rss():
+    if not resource:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss
+    return max_rss * 1024
+
+
+def start_stub(args):
+    command = [sys.executable, os.path.join(BENCHMARKS_FOLDER, 'cloud_stub.py'), '--port', '0',
+               '--job-every', str(args.job_every), '--gcode-size', str(args.gcode_size)]
+    stub = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    line = stub.stdout.readline()
+    if not line.startswith('Listening on'):
+        stub.kill()
+        raise RuntimeError('Cloud stub failed to start: ' + line)
+    host, port = line.split()[-1].rsplit(':', 1)
+    return stub, host, int(port)
+
+
+def stub_request(host, port, path):
+    with urllib.request.urlopen('http://%s:%d%s' % (host, port, path), timeout=STUB_START_TIMEOUT) as response:
+        return json.loads(response.read())
+
+
+def patch_settings(args, host, port):
+    # has to be done before import of http_client, because it reads URL and protocol settings on class creation
+    import config
+    import cloud_stub
+    settings = config.get_settings()
+    settings['URL'] = host
+    settings['protocol'].update({'encryption': False, 'custom_port': port, 'user_login': not args.apiprinter})
+    settings['camera']['enabled'] = False
+    settings['active_detectors'] = {'StaticDetector': True}
+    settings['static_printers'] = [{'VID': cloud_stub.BENCH_VID, 'PID': cloud_stub.BENCH_PID, 'SNR': str(number)}
+                                   for number in range(args.printers)]
+    settings['printer_loop_period'] = args.period
+    settings['main_loop_period'] = 1
+    settings['logging']['per_printer'] = False
+    settings['printer_profiles']['only_local'] = False
+    settings['printer_profiles']['get_updates'] = True
+    settings['autostart_queue'] = False
+    settings['downloader'] = dict(settings.get('downloader', {}), streaming=args.streaming)
+
+
+def instrument_http_client(stats):
+    import http_client
+    original_request = http_client.HTTPClient.request
+
+    def timed_request(self, method, connection, path, payload, headers=None):
+        started = time.perf_counter()
+        answer = original_request(self, method, connection, path, payload, headers)
+        stats.add(path.rsplit('/', 1)[-1], time.perf_counter() - started, answer is not None)
+        return answer
+
+    http_client.HTTPClient.request = timed_request
+
+
+class CameraLoad(threading.Thread):
+
+    FRAME = b'\xff\xd8\xff\xe0' + b'\x00' * 48 * 1024 + b'\xff\xd9'
+
+    def __init__(self, app, fps, stop_event):
+        import http_client
+        self.app = app
+        self.logger = app.logger.getChild(self.__class__.__name__)
+        self.fps = fps
+        self.stop_event = stop_event
+        self.stop_flag = False
+        self.offline_mode = False
+        self.http_client = http_client.get_printerinterface_protocol_connection()(self)
+        super().__init__(name='CameraLoad', daemon=True)
+
+    def register_error(self, code, message, is_blocking=False, is_info=False):
+        self.logger.warning("Error N%d. %s" % (code, message))
+
+    def run(self):
+        import http_client
+        token = self.app.user_login.user_token or 'bench-camera'
+        while not self.stop_event.wait(1.0 / self.fps):
+            if self.http_client.CAMERA_IMAGEJPEG_SUPPORTED:
+                path, properties = self.http_client.pack(http_client.HTTPClient.CAMERA_IMAGEJPEG, token, 1, 'Camera1')
+                headers = {"Content-Type": "image/jpeg", "Content-Length": len(self.FRAME), "Camera-Properties": properties}
+                self.http_client.send(path, self.FRAME, headers)
+            else:
+                import base64
+                self.http_client.pack_and_send(http_client.HTTPClient.CAMERA, token, 1, 'Camera1', base64.b64encode(self.FRAME))
+        self.http_client.close()
+
+
+def create_app(logger):
+    import slave_app
+
+    class Owner:
+        _logger = logger
+
+    return slave_app.SlaveApp(Owner())
+
+
+def wait_for_reports(app, stats, printers, timeout):
+    time_left = timeout
+    while time_left > 0:
+        latencies, _ = stats.snapshot()
+        interfaces = list(getattr(app, 'printer_interfaces', []))
+        if len(interfaces) >= printers and len(latencies.get('command', [])) >= printers:
+            return True
+        time.sleep(0.5)
+        time_left -= 0.5
+    return False
+
+
+def form_report(args, stats, server_stats, duration, cpu_times, rss):
+    latencies, failures = stats.snapshot()
+    total_requests = sum(len(values) for values in latencies.values())
+    report = {
+        'printers': args.printers,
+        'period': args.period,
+        'duration': round(duration, 2),
+        'requests': total_requests,
+        'requests_per_second': round(total_requests / duration, 2),
+        'failures': failures,
+        'cpu_user': round(cpu_times[0], 3),
+        'cpu_system': round(cpu_times[1], 3),
+        'cpu_percent': round((cpu_times[0] + cpu_times[1]) / duration * 100, 1),
+        'rss': rss,
+        'max_rss': get_max_rss(),
+        'threads': threading.active_count(),
+        'targets': {},
+        'server': server_stats
+    }
+    for target, values in sorted(latencies.items()):
+        values.sort()
+        report['targets'][target] = {
+            'count': len(values),
+            'per_second': round(len(values) / duration, 2),
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p90_ms': round(percentile(values, 90) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2),
+            'max_ms': round(values[-1] * 1000, 2)
+        }
+    return report
+
+
+def print_report(report):
+    print('Printers: %d, report period: %ss, measured: %ss' % (report['printers'], report['period'], report['duration']))
+    print('Requests: %d (%.2f req/s), failures: %s' % (report['requests'], report['requests_per_second'], report['failures'] or 'none'))
+    print('CPU: user %.3fs, system %.3fs, %.1f%% of one core' % (report['cpu_user'], report['cpu_system'], report['cpu_percent']))
+    print('RSS: %.1fMB, peak %.1fMB, threads: %d' % (report['rss'] / 1048576, report['max_rss'] / 1048576, report['threads']))
+    print('Server: %s' % ', '.join('%s %d' % item for item in sorted(report['server'].get('requests', {}).items())))
+    print('%-20s %8s %8s %9s %9s %9s %9s' % ('target', 'count', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for target, target_stats in report['targets'].items():
+        print('%-20s %8d %8.2f %9.2f %9.2f %9.2f %9.2f' % (target, target_stats['count'], target_stats['per_second'],
+              target_stats['p50_ms'], target_stats['p90_ms'], target_stats['p99_ms'], target_stats['max_ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load benchmark of the client with N simulated printers')
+    parser.add_argument('--printers', type=int, default=10, help='number of simulated printers')
+    parser.add_argument('--duration', type=float, default=30, help='measurement time in seconds after warmup')
+    parser.add_argument('--period', type=float, default=2, help='printer report period in seconds (printer_loop_period)')
+    parser.add_argument('--apiprinter', action='store_true', help='use apiprinter protocol instead of streamerapi')
+    parser.add_argument('--camera-fps', type=float, default=0, help='send synthetic camera frames with this rate (0 to disable)')
+    parser.add_argument('--job-every', type=float, default=0, help='cloud sends a print job to each ready printer every N seconds (0 to disable)')
+    parser.add_argument('--gcode-size', type=int, default=1024*1024, help='size of the print job file in bytes')
+    parser.add_argument('--streaming', action='store_true', help='print jobs while they are still downloading')
+    parser.add_argument('--lines-per-second', type=int, default=2000, help='print speed of simulated printers')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', help='also save the report to this file')
+    args = parser.parse_args()
+
+    # all the client settings and files go to a temporary home, so benchmark never touches real ones
+    home = tempfile.mkdtemp(prefix='3dprinteros-bench-')
+    os.environ['HOME'] = home
+    os.environ['APPDATA'] = home
+    sys.path.insert(0, PACKAGE_FOLDER)
+    sys.path.insert(0, BENCHMARKS_FOLDER)
+    handler = logging.StreamHandler()
+    handler.setLevel(args.log_level)
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(logging.DEBUG if args.log_level == 'DEBUG' else logging.INFO)
+    logger = logging.getLogger('benchmark')
+
+    stub, host, port = start_stub(args)
+    app = None
+    stop_event = threading.Event()
+    try:
+        patch_settings(args, host, port)
+        import bench_sender
+        bench_sender.Sender.LINES_PER_SECOND = args.lines_per_second
+        if not args.apiprinter:
+            import user_login
+            user_login.UserLogin.save_login('benchmark', 'benchmark')
+        stats = LatencyStats()
+        instrument_http_client(stats)
+        started = time.monotonic()
+        app = create_app(logger)
+        if not app.init_ok:
+            raise RuntimeError('Client app failed to init')
+        app.start()
+        if not wait_for_reports(app, stats, args.printers, WARMUP_TIMEOUT):
+            raise RuntimeError('Not all printers connected in %d seconds' % WARMUP_TIMEOUT)
+        print('Warmup done in %.1fs' % (time.monotonic() - started))
+        if args.camera_fps:
+            CameraLoad(app, args.camera_fps, stop_event).start()
+        stats.reset()
+        stub_request(host, port, '/reset')
+        times_before = os.times()
+        measure_start = time.monotonic()
+        time.sleep(args.duration)
+        times_after = os.times()
+        duration = time.monotonic() - measure_start
+        cpu_times = (times_after.user - times_before.user, times_after.system - times_before.system)
+        report = form_report(args, stats, stub_request(host, port, '/stats'), duration, cpu_times, get_rss())
+    finally:
+        stop_event.set()
+        if app:
+            app.stop_flag = True
+            if app.is_alive():
+                app.join(QUIT_TIMEOUT)
+        stub.terminate()
+        stub.wait()
+        shutil.rmtree(home, ignore_errors=True)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
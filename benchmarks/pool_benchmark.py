@@ -0,0 +1,92 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Scaling of gcodes loading with the processes pool: load time of process_gcodes_file and preprocess_gcodes
+# in this thread against the pool of 2, 3... processes. Outputs and line offsets indexes are checked to match.
+# Usage: python benchmarks/pool_benchmark.py --size-mb 200 --processes 4
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_FOLDER = os.path.join(os.path.dirname(BENCHMARKS_FOLDER), 'octoprint_3dprinteros')
+MB = 1024 * 1024
+
+
+def measure(function):
+    started = time.perf_counter()
+    result = function()
+    return time.perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling of gcodes loading with the processes pool')
+    parser.add_argument('--size-mb', type=float, default=200, help='size of generated gcodes')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='largest pool to measure')
+    parser.add_argument('--file', help='use this gcode file instead of generated gcodes')
+    parser.add_argument('--json', help='also save the report to this file')
+    args = parser.parse_args()
+
+    # importing of the client modules creates settings files in the home folder, so it is a temporary one
+    home = tempfile.mkdtemp(prefix='3dprinteros-bench-')
+    os.environ['HOME'] = home
+    os.environ['APPDATA'] = home
+    sys.path.insert(0, PACKAGE_FOLDER)
+    sys.path.insert(0, BENCHMARKS_FOLDER)
+    try:
+        import base_sender
+        import gcodes_index
+        import process_pool
+        from preprocess_benchmark import generate_gcodes
+        sender = base_sender.BaseSender(None, usb_info={'VID': '0000', 'PID': '0000', 'SNR': 'benchmark'})
+        path = args.file
+        if not path:
+            path = os.path.join(home, 'benchmark.gcode')
+            with open(path, 'wb') as f:
+                f.write(generate_gcodes(int(args.size_mb * MB)))
+        with open(path, 'rb') as f:
+            data = f.read()
+        size = len(data) / MB
+        process_pool.ENABLED = True
+        process_pool.MIN_SIZE = 0
+        report = {'size': len(data), 'cpus': os.cpu_count(), 'runs': []}
+        print('Input: %.1fMB, CPUs: %s' % (size, os.cpu_count()))
+        print('%10s %14s %10s %14s %10s' % ('processes', 'file load s', 'speedup', 'preprocess s', 'speedup'))
+        reference = None
+        for processes in range(1, max(args.processes, 1) + 1):
+            process_pool.PROCESSES = processes
+            load_seconds, loaded = measure(lambda: sender.process_gcodes_file(path, build_line_index=True))
+            index = gcodes_index.LineOffsetIndex.load(path)
+            preprocess_seconds, preprocessed = measure(lambda: sender.preprocess_gcodes(data))
+            if reference is None:
+                reference = (list(loaded), list(index.offsets), list(preprocessed), load_seconds, preprocess_seconds)
+            elif (list(loaded), list(index.offsets), list(preprocessed)) != reference[:3]:
+                raise RuntimeError('Output of the pool of %d processes differs from the output of this thread' % processes)
+            del loaded, preprocessed
+            report['runs'].append({'processes': processes, 'load_seconds': round(load_seconds, 4),
+                                   'preprocess_seconds': round(preprocess_seconds, 4)})
+            print('%10d %14.3f %9.2fx %14.3f %9.2fx' % (processes, load_seconds, reference[3] / load_seconds,
+                  preprocess_seconds, reference[4] / preprocess_seconds))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=4)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
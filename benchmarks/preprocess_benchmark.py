@@ -0,0 +1,150 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Scaling benchmark of BaseSender.preprocess_gcodes: time per MB should stay flat from 1KB to hundreds of MB
+# Usage: python benchmarks/preprocess_benchmark.py --max-size-mb 500 --compare
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_FOLDER = os.path.join(os.path.dirname(BENCHMARKS_FOLDER), 'octoprint_3dprinteros')
+MB = 1024 * 1024
+
+
+def generate_gcodes(size, seed=0):
+    # slicer like mix of moves, extrusions, comments and windows line endings
+    rng = random.Random(seed)
+    lines = []
+    length = 0
+    layer = 0
+    while length < size:
+        roll = rng.random()
+        if roll < 0.01:
+            layer += 1
+            line = b';LAYER:%d\r\nG1 Z%.2f F600' % (layer, layer * 0.2)
+        elif roll < 0.05:
+            line = b'; comment ' + b'x' * rng.randint(0, 40)
+        elif roll < 0.8:
+            line = b'G1 X%.3f Y%.3f E%.5f' % (rng.uniform(0, 220), rng.uniform(0, 220), rng.uniform(0, 2))
+        else:
+            line = b'G0 F%d X%.3f Y%.3f' % (rng.choice((1800, 3000, 7200)), rng.uniform(0, 220), rng.uniform(0, 220))
+        lines.append(line)
+        length += len(line) + 1
+    return b'\n'.join(lines)[:size]
+
+
+def legacy_preprocess_gcodes(sender, gcodes_in):
+    # former implementation, which copies the remainder of input on each chunk, for --compare
+    gcodes_out = sender.BUFFER_CLASS()
+    partline = b""
+    while gcodes_in:
+        buf_len = min(len(gcodes_in), sender.GCODES_PREPROCESS_BUFFER)
+        buf = partline + gcodes_in[:buf_len]
+        gcodes_in = gcodes_in[buf_len:]
+        partline = b""
+        buf = buf.replace(b"\r", b"")
+        if buf:
+            lines = buf.split(b'\n')
+            if gcodes_in:
+                partline = lines.pop()
+            else:
+                while lines and not lines[-1]:
+                    lines.pop()
+            gcodes_out.extend(lines)
+    return gcodes_out
+
+
+def form_sizes(max_size):
+    sizes = []
+    size = 1024
+    while size < max_size:
+        sizes.append(size)
+        size *= 4
+    sizes.append(max_size)
+    return sizes
+
+
+def measure(function, repeats):
+    best = None
+    result = None
+    for _ in range(repeats):
+        result = None
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling benchmark of gcodes preprocessing')
+    parser.add_argument('--max-size-mb', type=float, default=500, help='size of the largest input')
+    parser.add_argument('--repeats', type=int, default=3, help='best of N runs is reported for inputs under 10MB')
+    parser.add_argument('--compare', action='store_true', help='also run the former quadratic implementation and check that outputs match')
+    parser.add_argument('--json', help='also save the report to this file')
+    args = parser.parse_args()
+
+    # importing of the client modules creates settings files in the home folder, so it is a temporary one
+    home = tempfile.mkdtemp(prefix='3dprinteros-bench-')
+    os.environ['HOME'] = home
+    os.environ['APPDATA'] = home
+    sys.path.insert(0, PACKAGE_FOLDER)
+    try:
+        import base_sender
+        import process_pool
+        process_pool.ENABLED = False # scaling of this thread is measured, pool_benchmark.py measures the pool
+        sender = types.SimpleNamespace(parent=None, logger=logging.getLogger('benchmark'),
+                                       BUFFER_CLASS=base_sender.BaseSender.BUFFER_CLASS,
+                                       GCODES_PREPROCESS_BUFFER=base_sender.BaseSender.GCODES_PREPROCESS_BUFFER)
+        report = []
+        print('%12s %10s %10s %10s %12s' % ('input', 'lines', 'seconds', 'MB/s', 'legacy s'))
+        for size in form_sizes(int(args.max_size_mb * MB)):
+            gcodes = generate_gcodes(size)
+            repeats = args.repeats if size < 10 * MB else 1
+            seconds, output = measure(lambda: base_sender.BaseSender.preprocess_gcodes(sender, gcodes), repeats)
+            lines = len(output)
+            entry = {'size': size, 'lines': lines, 'seconds': round(seconds, 6), 'mb_per_second': round(size / MB / seconds, 2)}
+            if args.compare:
+                legacy_seconds, legacy_output = measure(lambda: legacy_preprocess_gcodes(sender, gcodes), repeats)
+                if list(legacy_output) != list(output):
+                    raise RuntimeError('Output differs from the former implementation on %dB input' % size)
+                del legacy_output
+                entry['legacy_seconds'] = round(legacy_seconds, 6)
+            del output, gcodes
+            report.append(entry)
+            print('%11.3fM %10d %10.4f %10.2f %12s' % (size / MB, lines, seconds, entry['mb_per_second'],
+                  '%.4f' % entry['legacy_seconds'] if 'legacy_seconds' in entry else '-'))
+        large = [entry for entry in report if entry['size'] >= 10 * MB]
+        if len(large) > 1:
+            # for linear scaling throughput of the largest input stays close to throughput of a smaller one.
+            # Smaller inputs fit CPU caches and are faster anyway.
+            ratio = large[-1]['mb_per_second'] / large[0]['mb_per_second']
+            print('Throughput of the largest input relative to %.0fMB one: %.2f' % (large[0]['size'] / MB, ratio))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=4)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -28,6 +28,7 @@ import config
 import log
 import paths
 import platforms
+import process_pool
 import version
 
 try:
@@ -431,6 +432,7 @@ class App:
             printer_name = pi.printer_profile.get('name', 'nameless printer')
             state = 'Joining ' + printer_name + ' ' + str(pi) + '...'
             self.close_module(state, pi.join, self.QUIT_THREAD_JOIN_TIMEOUT)
+        self.close_module('Closing processes pool...', process_pool.shutdown)
         if hasattr(self, 'camera_controller'):
             self.close_module('Closing camera...', self.camera_controller.stop_camera_process)
         if hasattr(self, "plugin_controller"):
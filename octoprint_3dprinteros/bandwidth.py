@@ -0,0 +1,231 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Token bucket scheduler for bulk traffic. Commands and reports do not pass through it, so they are never delayed.
+# Each traffic class has a priority (lower is more important) and an optional rate cap,
+# and all of them share an optional total rate. Camera runs in its own process, so when the total rate is set, each process
+# publishes its traffic and the priority of its most important waiter to a state file and charges traffic of the others to its total rate.
+
+import collections
+import io
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+import config
+import paths
+
+DOWNLOAD = 'download'
+CAMERA = 'camera'
+LOGS = 'logs'
+PREFETCH = 'prefetch'
+
+
+class TokenBucket:
+
+    BURST_TIME = 0.5 # seconds of traffic, that could pass at once after idling
+
+    def __init__(self, rate):
+        self.rate = rate # bytes per second, 0 for unlimited
+        self.tokens = rate * self.BURST_TIME
+        self.last_time = time.monotonic()
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.tokens + (now - self.last_time) * self.rate, self.rate * self.BURST_TIME)
+        self.last_time = now
+
+    def is_ready(self):
+        return not self.rate or self.tokens > 0
+
+    def consume(self, amount):
+        # tokens could go below zero, so any amount is granted at once and paid off by waiting afterwards
+        if self.rate:
+            self.tokens -= amount
+
+    def get_wait_time(self):
+        if self.is_ready():
+            return 0
+        return -self.tokens / self.rate
+
+
+class BandwidthManager(config.Singleton):
+
+    ENABLED = config.get_settings().get('bandwidth', {}).get('enabled', False)
+    TOTAL_RATE = config.get_settings().get('bandwidth', {}).get('total_kb_per_sec', 0) * 1024
+    CLASSES = config.get_settings().get('bandwidth', {}).get('classes', {})
+    RATE_WINDOW = 5 # seconds
+    MAX_WAIT_STEP = 0.5
+    DEFAULT_PRIORITY = 10
+    SHARE_PERIOD = 0.5 # seconds between exchanges of state with other processes
+    SHARE_TIMEOUT = 2 # state of a process, that did not update it for that long, is ignored
+    STALE_STATE_TIMEOUT = 60 # state files of processes, which are gone, are removed after that
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.condition = threading.Condition()
+        self.total_bucket = TokenBucket(self.TOTAL_RATE)
+        self.buckets = {}
+        self.waiting = []
+        self.order = itertools.count()
+        self.history = {}
+        self.sent_bytes = 0 # by this process, published for the others
+        self.waited_priority = None # of the most important waiter since the last publication
+        self.state_path = os.path.join(paths.BANDWIDTH_STATE_FOLDER, f'{os.getpid()}.json')
+        self.last_share_time = 0.0
+        self.external_bytes = {} # state file name: sent bytes of the last reading
+        self.external_priority = None # of the most important waiter of other processes
+
+    def get_priority(self, traffic_class):
+        return self.CLASSES.get(traffic_class, {}).get('priority', self.DEFAULT_PRIORITY)
+
+    def get_bucket(self, traffic_class):
+        bucket = self.buckets.get(traffic_class)
+        if not bucket:
+            bucket = TokenBucket(self.CLASSES.get(traffic_class, {}).get('max_kb_per_sec', 0) * 1024)
+            self.buckets[traffic_class] = bucket
+        return bucket
+
+    def is_next(self, ticket):
+        # the most important waiter, that is not held by its own class cap
+        for waiting_ticket in sorted(self.waiting):
+            if self.buckets[waiting_ticket[2]].is_ready():
+                return waiting_ticket == ticket
+        return False
+
+    def acquire(self, traffic_class, amount, stop_check=None):
+        # blocks until the traffic class is allowed to pass amount of bytes. Returns False if stop_check became true.
+        if not self.ENABLED:
+            self.account(traffic_class, amount)
+            return True
+        with self.condition:
+            bucket = self.get_bucket(traffic_class)
+            ticket = (self.get_priority(traffic_class), next(self.order), traffic_class)
+            self.waiting.append(ticket)
+            if self.waited_priority is None or ticket[0] < self.waited_priority:
+                self.waited_priority = ticket[0]
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self.TOTAL_RATE and now - self.last_share_time >= self.SHARE_PERIOD:
+                        self.share_state(now)
+                    self.total_bucket.refill(now)
+                    for other_bucket in self.buckets.values():
+                        other_bucket.refill(now)
+                    if self.total_bucket.is_ready() and self.is_next(ticket) and \
+                            (self.external_priority is None or self.external_priority >= ticket[0]):
+                        break
+                    if stop_check and stop_check():
+                        return False
+                    wait_time = max(bucket.get_wait_time(), self.total_bucket.get_wait_time()) or self.MAX_WAIT_STEP
+                    self.condition.wait(min(wait_time, self.MAX_WAIT_STEP))
+                bucket.consume(amount)
+                self.total_bucket.consume(amount)
+                self.sent_bytes += amount
+            finally:
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+        self.account(traffic_class, amount)
+        return True
+
+    def share_state(self, now):
+        # publishes traffic of this process and reads the one of the others. Their traffic since the last reading
+        # is charged to the total bucket, so all processes together keep within the total rate.
+        wall_time = time.time()
+        was_recent = now - self.last_share_time < self.SHARE_TIMEOUT
+        self.last_share_time = now
+        state = {'time': wall_time, 'sent_bytes': self.sent_bytes, 'waiting_priority': self.waited_priority}
+        self.waited_priority = min((ticket[0] for ticket in self.waiting), default=None)
+        try:
+            os.makedirs(paths.BANDWIDTH_STATE_FOLDER, exist_ok=True)
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
+            names = os.listdir(paths.BANDWIDTH_STATE_FOLDER)
+        except OSError as e:
+            self.logger.debug('Unable to share bandwidth state: ' + str(e))
+            return
+        external_bytes = {}
+        self.external_priority = None
+        for name in names:
+            path = os.path.join(paths.BANDWIDTH_STATE_FOLDER, name)
+            if path == self.state_path or not name.endswith('.json'):
+                continue
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+                age = wall_time - state['time']
+                if age > self.STALE_STATE_TIMEOUT:
+                    os.remove(path)
+                    continue
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            if age > self.SHARE_TIMEOUT:
+                continue
+            external_bytes[name] = state.get('sent_bytes', 0)
+            # traffic, that was sent while this process did not share, is not charged, since its time has passed
+            if was_recent and name in self.external_bytes:
+                self.total_bucket.consume(max(external_bytes[name] - self.external_bytes[name], 0))
+            priority = state.get('waiting_priority')
+            if priority is not None and (self.external_priority is None or priority < self.external_priority):
+                self.external_priority = priority
+        self.external_bytes = external_bytes
+
+    def account(self, traffic_class, amount):
+        now = time.monotonic()
+        with self.condition:
+            history = self.history.setdefault(traffic_class, collections.deque())
+            history.append((now, amount))
+            while history and history[0][0] < now - self.RATE_WINDOW:
+                history.popleft()
+
+    def get_rates(self):
+        # average bytes per second of each traffic class over the last RATE_WINDOW seconds
+        now = time.monotonic()
+        with self.condition:
+            return {traffic_class: sum(amount for timestamp, amount in history if timestamp >= now - self.RATE_WINDOW) / self.RATE_WINDOW
+                    for traffic_class, history in self.history.items()}
+
+
+class ThrottledReader:
+    # file-like body for requests, which passes through the bandwidth manager as it is being sent
+
+    def __init__(self, data, traffic_class, stop_check=None):
+        self.file = io.BytesIO(data)
+        self.length = len(data)
+        self.traffic_class = traffic_class
+        self.stop_check = stop_check
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        if data:
+            acquire(self.traffic_class, len(data), self.stop_check)
+        return data
+
+
+def acquire(traffic_class, amount, stop_check=None):
+    return BandwidthManager.instance().acquire(traffic_class, amount, stop_check)
+
+
+def is_enabled():
+    return BandwidthManager.ENABLED
+
+
+def get_rates():
+    return BandwidthManager.instance().get_rates()
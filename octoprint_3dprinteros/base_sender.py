@@ -13,6 +13,7 @@
 import base64
 import binascii
 import collections
+import contextlib
 import logging
 import os
 import re
@@ -23,20 +24,38 @@ import time
 import tempfile
 import threading
 import zipfile
+import zlib
 import typing
 
+import bgcode_decoder
 import config
+import gcodes_analyzer
+import gcodes_buffer
+import gcodes_cleaner
+import gcodes_decompressor
+import gcodes_index
 import platforms
 import paths
 import printer_settings_and_id
+import process_pool
 
 
 class BaseSender:
 
     TEMPERATURE_SIGNS_AFTER_DOT = 2 # rounding done using this
     REPORT_JOBS = False
-    BUFFER_CLASS = collections.deque
-    MEMORY_STORE_COOF = 1.6
+    PACKED_GCODES_BUFFER = config.get_settings().get('packed_gcodes_buffer', True)
+    if PACKED_GCODES_BUFFER:
+        BUFFER_CLASS = gcodes_buffer.PackedGcodesBuffer
+        MEMORY_STORE_COOF = 1.3 # lines data, its offsets and bytearray overallocation
+    else:
+        BUFFER_CLASS = collections.deque
+        MEMORY_STORE_COOF = 1.6
+    LAZY_GCODES_FILE = config.get_settings().get('lazy_gcodes_file', False)
+    LINE_OFFSET_INDEX = config.get_settings().get('line_offset_index', True) # stored next to a kept file for resume and jumps
+    SPILL_SETTINGS = config.get_settings().get('spilled_gcodes_buffer', {})
+    SPILLED_GCODES_BUFFER = PACKED_GCODES_BUFFER and SPILL_SETTINGS.get('enabled', True) # instead of "Not enough memory"
+    SPILL_READ_AHEAD_SIZE = SPILL_SETTINGS.get('read_ahead_mb', 8) * 1024 * 1024
     MEMORY_MARGIN = 60 * 1024 * 1024 # 60MB
     GCODES_PREPROCESS_BUFFER = 20 * 1024 * 1024 # 20MB
     COMMENT_CHARS = [b";"]
@@ -45,7 +64,14 @@ class BaseSender:
     MAX_FILENAME_LEN = 253
 
     NATIVE_FILE_EXTENSION = ".gcode"
+    # If True, downloader could call gcodes_stream to print while file is still downloading. Senders, which print from
+    # the buffer passed to load_gcodes, set it, when they keep printing while stream_loading is set and the buffer is empty.
+    STREAMING_SUPPORTED = False
+    STREAM_START_LINES = 1000 # lines read before print of a streamed file starts
+    STREAM_READ_AHEAD_LINES = 200000 # reading of a stream pauses, when it is that far ahead of the printed line
+    STREAM_WAIT_PERIOD = 0.5
     UNZIP_SUBPROCESS_LINE = [sys.executable, "-m", "zipfile", "-e"]
+    IN_PROCESS_UNZIP = config.get_settings().get('in_process_unzip', True)
     # UGZIP_SUBPROCESS_LINE = [sys.executable, "-m", "gzip", "-d"]
 
     AXIS_NAMES = ('X', 'Y', 'Z')
@@ -57,6 +83,11 @@ class BaseSender:
             line = line.split(comment_char)[0].strip()
         return line
 
+    @classmethod
+    def strip_lines_form_junk(cls, data: bytes) -> typing.List[bytes]:
+        # same as strip_line_form_junk for each line of data, without empty lines, but done over the whole data at once
+        return gcodes_cleaner.clean_chunk(data, tuple(cls.COMMENT_CHARS), expand_tabs=True)
+
     @staticmethod
     def add_camera_url(url_to_add: str, retries_left: int = 2) -> None:
         existing_urls = ''
@@ -139,6 +170,9 @@ class BaseSender:
         self.position = [0.0, 0.0, 0.0, 0.0]  # X, Y, Z, E
         self.profile = profile # empty profile is ok for some senders
         self.estimated_time = None
+        self.material_volumes = None
+        self.gcodes_analysis = None
+        self.gcodes_analysis_thread = None
         self.buffer = None
         self.total_gcodes = 0
         self.current_line_number = 0
@@ -170,6 +204,9 @@ class BaseSender:
         self.allow_increase_of_print_time_left = config.get_settings().get('print_estimation', {}).get('allow_rise_time_left', False)
         self.intercept_pause = config.get_settings().get('intercept_pause')
         self.keep_print_files = config.get_settings().get('keep_print_files', False)
+        self.file_hashes = {} # path: hashes calculated by downloader
+        self.stream_loading = False # gcodes are still being read from a download, while they are printed
+        self.kept_print_file = None # last printed file, which was kept, so the print could be resumed from a line of it
         self.verbose = config.get_settings().get('verbose', False)
         self.print_start_time = None
         #self.heating_start_time = None
@@ -254,15 +291,51 @@ class BaseSender:
         self.register_error(605, "Cancel is not supported for this printer type", is_blocking=False)
         return False
 
-    def process_gcodes_file(self, gcodes_file: str) -> collections.deque:
-        if self.file_can_fit_memory(gcodes_file):
-            gcodes_out = self.BUFFER_CLASS()
+    def process_gcodes_file(self, gcodes_file: typing.Union[str, typing.BinaryIO], build_line_index: bool = False) -> collections.deque:
+        # gcodes_file could also be an opened binary file, such as zip entry, that was already checked to fit memory.
+        # Line offsets index is worth building only for a file, which is kept after loading.
+        is_path = isinstance(gcodes_file, (str, bytes, os.PathLike))
+        if is_path and self.LAZY_GCODES_FILE:
+            # lines are read from the file as the sender pops them, so memory use does not depend on file size
             try:
-                with open(gcodes_file, "rb") as f:
-                    for line in f:
-                        line = line.split(b";")[0].strip()
-                        if line:
-                            gcodes_out.append(line)
+                gcodes_out = gcodes_buffer.MappedGcodesFile(gcodes_file, tuple(self.COMMENT_CHARS))
+            except (OSError, ValueError) as e:
+                self.logger.warning('Unable to map gcodes file: ' + str(e))
+                self.register_error(85, "File loading error. Cancelling...", is_blocking=True)
+                return None
+            line_index = gcodes_index.LineOffsetIndex.load(gcodes_file)
+            if line_index:
+                gcodes_out.set_line_index(line_index)
+            return gcodes_out
+        if not is_path or self.file_can_fit_memory(gcodes_file):
+            gcodes_out = self.create_gcodes_buffer()
+            comment_chars = tuple(self.COMMENT_CHARS)
+            line_index = None
+            if is_path and build_line_index:
+                line_index = gcodes_index.LineOffsetIndex()
+            try:
+                with open(gcodes_file, "rb") if is_path else contextlib.nullcontext(gcodes_file) as f:
+                    loaded = False
+                    if is_path and process_pool.is_worth_using(os.fstat(f.fileno()).st_size):
+                        loaded = self.load_gcodes_in_pool(f, gcodes_out, line_index)
+                        if not loaded:
+                            gcodes_out.clear()
+                            f.seek(0)
+                            if line_index:
+                                line_index = gcodes_index.LineOffsetIndex()
+                    if not loaded:
+                        for chunk in gcodes_cleaner.iterate_chunks(f):
+                            lines = gcodes_cleaner.split_chunk(chunk, comment_chars)
+                            if line_index:
+                                line_index.add_chunk(chunk, lines)
+                            lines = list(filter(None, lines))
+                            if lines:
+                                gcodes_out.extend(lines)
+                if line_index:
+                    try:
+                        line_index.save(gcodes_file)
+                    except (OSError, ValueError) as e:
+                        self.logger.warning('Unable to save line offsets index: ' + str(e))
             except OSError:
                 if self.parent:
                     self.parent.register_error(85, "File loading error. Cancelling...", is_blocking=True)
@@ -270,39 +343,81 @@ class BaseSender:
                     self.logger.error("File loading error. Cancelling...")
             return gcodes_out
 
+    def load_gcodes_in_pool(self, binary_file: typing.BinaryIO, gcodes_out: typing.Any,
+                            line_index: gcodes_index.LineOffsetIndex = None) -> bool:
+        # chunks are cleaned by processes of the pool in parallel and are merged in order of the file.
+        # Returns False when the pool is not usable, so the file could be loaded in this thread.
+        arguments = ((chunk, tuple(self.COMMENT_CHARS), False, bool(line_index))
+                     for chunk in gcodes_cleaner.iterate_chunks(binary_file, process_pool.CHUNK_SIZE))
+        try:
+            executor = process_pool.get_executor()
+            for data, ends, starts, size in process_pool.map_ordered(executor, gcodes_cleaner.clean_chunk_packed,
+                                                                     arguments, lambda: self.stop_flag):
+                self.extend_packed(gcodes_out, data, ends)
+                if line_index:
+                    line_index.add_line_starts(starts, size)
+        except (OSError, RuntimeError, ValueError) as e:
+            self.logger.warning('Gcodes loading by processes pool failed: ' + str(e))
+            return False
+        return True
+
+    def preprocess_in_pool(self, gcodes_in: typing.Union[bytes, str], gcodes_out: typing.Any) -> bool:
+        arguments = gcodes_cleaner.iterate_buffer_chunks(gcodes_in, process_pool.CHUNK_SIZE)
+        try:
+            executor = process_pool.get_executor()
+            for data, ends in process_pool.map_ordered(executor, gcodes_cleaner.split_lines_packed, arguments,
+                                                       lambda: self.parent and self.parent.stop_flag):
+                self.extend_packed(gcodes_out, data, ends)
+        except process_pool.Stopped:
+            return False # loop in this thread stops at once too
+        except (OSError, RuntimeError, ValueError) as e:
+            self.logger.warning('Gcodes preprocessing by processes pool failed: ' + str(e))
+            return False
+        return True
+
+    @staticmethod
+    def extend_packed(gcodes_out: typing.Any, data: bytes, ends: typing.Sequence[int]) -> None:
+        if hasattr(gcodes_out, 'extend_packed'):
+            gcodes_out.extend_packed(data, ends)
+        else:
+            gcodes_out.extend(gcodes_cleaner.unpack_lines(data, ends))
+
     def preprocess_gcodes(self, gcodes_in: typing.Any) -> collections.deque:
-        gcodes_out = collections.deque()
+        # input is split in chunks of GCODES_PREPROCESS_BUFFER through a view, so nothing but the current chunk is copied
+        gcodes_out = self.BUFFER_CLASS()
         if gcodes_in:
             if type(gcodes_in) in (list, tuple, collections.deque):
                 if type(gcodes_in[0]) == str:
                     sep = "\n"
                 else:
-                    sep = b"\b"
+                    sep = b"\n"
                 gcodes_in = sep.join(gcodes_in)
-            if type(gcodes_in) == str:
-                partline = ""
-            else:
-                partline = b""
-            while gcodes_in:
-                if self.parent and self.parent.stop_flag:
-                    break
-                buf_len = min(len(gcodes_in), self.GCODES_PREPROCESS_BUFFER)
-                buf = partline + gcodes_in[:buf_len]
-                gcodes_in = gcodes_in[buf_len:]
-                if type(buf) == str:
-                    buf = buf.encode("utf-8")
-                    partline = ""
+            # large input is split in the pool of processes, if it is not usable the split is done here
+            if not (process_pool.is_worth_using(len(gcodes_in)) and self.preprocess_in_pool(gcodes_in, gcodes_out)):
+                gcodes_out.clear()
+                if type(gcodes_in) == str:
+                    view = gcodes_in
                 else:
+                    view = memoryview(gcodes_in)
+                partline = b""
+                total_len = len(gcodes_in)
+                for start in range(0, total_len, self.GCODES_PREPROCESS_BUFFER):
+                    if self.parent and self.parent.stop_flag:
+                        break
+                    end = start + self.GCODES_PREPROCESS_BUFFER
+                    chunk = view[start:end]
+                    if type(chunk) == str:
+                        chunk = chunk.encode("utf-8")
+                    buf = (partline + chunk).replace(b"\r", b"")
                     partline = b""
-                buf = buf.replace(b"\r", b"")
-                if buf:
-                    lines = buf.split(b'\n')
-                    if gcodes_in:
-                        partline = lines.pop()
-                    else:
-                        while lines and not lines[-1]:
-                            lines.pop()
-                    gcodes_out.extend(lines)
+                    if buf:
+                        lines = buf.split(b'\n')
+                        if end < total_len:
+                            partline = lines.pop()
+                        else:
+                            while lines and not lines[-1]:
+                                lines.pop()
+                        gcodes_out.extend(lines)
         self.logger.info('Got %d gcodes to execute.' % len(gcodes_out))
         return gcodes_out
 
@@ -312,6 +427,24 @@ class BaseSender:
             return free_mem > (size * self.MEMORY_STORE_COOF + self.MEMORY_MARGIN)
         return True # always try if we can't determine a free memory
 
+    def can_load_gcodes(self, size: int) -> bool:
+        # size is only an estimation. Spilled buffer measures memory it really takes and keeps what does not fit on disk.
+        if self.is_enough_memory(size):
+            return True
+        if self.SPILLED_GCODES_BUFFER:
+            self.logger.info('Gcodes could not fit in free memory, so the rest of them will be spilled to disk')
+            return True
+        return False
+
+    def create_gcodes_buffer(self) -> typing.Any:
+        if not self.SPILLED_GCODES_BUFFER:
+            return self.BUFFER_CLASS()
+        memory_limit = None
+        free_mem = self.get_free_memory()
+        if free_mem:
+            memory_limit = max(free_mem - self.MEMORY_MARGIN, self.SPILL_READ_AHEAD_SIZE * 2)
+        return gcodes_buffer.SpilledGcodesBuffer(memory_limit, self.SPILL_READ_AHEAD_SIZE, paths.DOWNLOAD_FOLDER)
+
     def file_can_fit_memory(self, filepath: str) -> bool:
         try:
             size = os.path.getsize(filepath)
@@ -319,35 +452,243 @@ class BaseSender:
         except:
             self.logger.exception('Exception on getting file size:')
         else:
-            if not self.is_enough_memory(size):
+            if not self.can_load_gcodes(size):
                 self.parent.register_error(88, "Not enough memory. Cancelling...", is_blocking=True)
                 return False
         return True
 
     # new way to call gcodes without old protocol multi meaning gcodes in printer_interface
-    def print_file(self, filepath: typing.AnyStr, keep_file: bool = False) -> bool:
-        return self.gcodes(filepath, keep_file)
-
-    def gcodes(self, filepath: typing.AnyStr, keep_file: bool = False) -> bool:
+    def print_file(self, filepath: typing.AnyStr, keep_file: bool = False, start_line: int = 0) -> bool:
+        return self.gcodes(filepath, keep_file, start_line)
+
+    def resume_print_from_line(self, line_number: int) -> bool:
+        # prints the last kept file again from the line of line_number, such as current_line_number of a cancelled print
+        if self.is_printing():
+            self.register_error(604, "Printer already printing.", is_blocking=False)
+            return False
+        if not self.kept_print_file or not os.path.isfile(self.kept_print_file):
+            self.register_error(85, "No kept print file to resume print from", is_blocking=False)
+            return False
+        return self.print_file(self.kept_print_file, keep_file=True, start_line=int(line_number))
+
+    def gcodes(self, filepath: typing.AnyStr, keep_file: bool = False, start_line: int = 0) -> bool:
         success = False
+        stopped = False
         self.logger.debug("Start loading gcodes...")
-        if str(filepath).endswith(".zip"):
-            gcodes = self.unzip_file(filepath, self.process_gcodes_file)
-        else:
-            gcodes = self.process_gcodes_file(filepath)
+        is_zip = str(filepath).endswith(".zip")
+        if start_line and is_zip:
+            self.register_error(85, "Print from a line is not supported for zip files. Cancelling...", is_blocking=False)
+            return False
+        try:
+            if start_line:
+                gcodes = self.process_gcodes_file_from_line(filepath, start_line)
+            elif is_zip:
+                gcodes = self.unzip_file(filepath, self.process_gcodes_file)
+            elif self.get_file_compression(filepath):
+                gcodes = self.decompress_file(filepath, self.process_gcodes_file)
+            else:
+                build_line_index = self.LINE_OFFSET_INDEX and (self.keep_print_files or keep_file)
+                gcodes = self.process_gcodes_file(filepath, build_line_index)
+        except process_pool.Stopped:
+            self.logger.info('Gcodes loading was stopped')
+            gcodes = None
+            stopped = True
         if gcodes:
             success = self.load_gcodes(gcodes) != False # None is equal to True here
             if success:
                 self.print_start_time = time.monotonic()
-        else:
+        elif not stopped:
             self.logger.error('Error: empty gcodes unpack result')
+        if not success:
+            self.stop_gcodes_analysis()
+        elif not is_zip and not start_line:
+            self.start_gcodes_analysis(filepath) # the file is still there, since it is removed only below
         if not self.keep_print_files and not keep_file:
             try:
                 os.remove(filepath)
             except:
                 pass
+            gcodes_index.LineOffsetIndex.remove(filepath)
+        elif not is_zip:
+            self.kept_print_file = os.fspath(filepath)
         return success
 
+    def process_gcodes_file_from_line(self, filepath: str, line_number: int) -> collections.deque:
+        # loads gcodes of a kept file starting from the line of line_number, without reading lines before it
+        if self.LAZY_GCODES_FILE and not self.get_file_compression(filepath):
+            gcodes = self.process_gcodes_file(filepath)
+            if gcodes:
+                try:
+                    gcodes.seek(line_number)
+                except IndexError:
+                    gcodes.close()
+                    self.register_error(85, f"Line {line_number} to start print from is out of file. Cancelling...", is_blocking=False)
+                    return None
+            return gcodes
+        try:
+            size = gcodes_decompressor.get_file_content_size(filepath)
+        except gcodes_decompressor.ERRORS as e:
+            self.logger.warning(f'Unable to open gcodes file {filepath}: {e}')
+            self.register_error(85, "File loading error. Cancelling...", is_blocking=True)
+            return None
+        if not self.can_load_gcodes(size):
+            self.register_error(88, "Not enough memory. Cancelling...", is_blocking=True)
+            return None
+        try:
+            f = self.open_gcodes_file_at_line(filepath, line_number)
+        except gcodes_decompressor.ERRORS as e:
+            self.logger.warning(f'Unable to open gcodes file {filepath} at line {line_number}: {e}')
+            self.register_error(85, "File loading error. Cancelling...", is_blocking=True)
+            return None
+        if not f:
+            self.register_error(85, f"Line {line_number} to start print from is out of file. Cancelling...", is_blocking=False)
+            return None
+        self.logger.info(f'Loading gcodes from line {line_number}')
+        try:
+            with f:
+                return self.process_gcodes_file(f)
+        except gcodes_decompressor.ERRORS as e:
+            self.logger.warning(f'Decompression error of gcodes file {filepath}: {e}')
+            self.register_error(87, "Decompression error. Cancelling...", is_blocking=True)
+
+    def build_line_index(self, filepath: str) -> gcodes_index.LineOffsetIndex:
+        # indexes lines of the file by a pass over it. Index of a plain file is stored next to it.
+        comment_chars = tuple(self.COMMENT_CHARS)
+        line_index = gcodes_index.LineOffsetIndex()
+        with gcodes_decompressor.open_file(filepath) as f:
+            for chunk in gcodes_cleaner.iterate_chunks(f):
+                line_index.add_chunk(chunk, gcodes_cleaner.split_chunk(chunk, comment_chars))
+        if not self.get_file_compression(filepath): # offsets of decompressed lines are not stored next to a compressed file
+            try:
+                line_index.save(filepath)
+            except (OSError, ValueError) as e:
+                self.logger.warning('Unable to save line offsets index: ' + str(e))
+        return line_index
+
+    def open_gcodes_file_at_line(self, filepath: str, line_number: int) -> typing.BinaryIO:
+        # returns the file opened at the line of line_number, as it is numbered in the loaded gcodes and in reports,
+        # or None if there is no such line. Stored index is used when it is valid, otherwise it is built by a pass over
+        # the file and stored.
+        comment_chars = tuple(self.COMMENT_CHARS)
+        line_index = gcodes_index.LineOffsetIndex.load(filepath)
+        if not line_index:
+            line_index = self.build_line_index(filepath)
+        try:
+            offset, skip = line_index.locate(line_number)
+        except IndexError:
+            return None
+        f = gcodes_decompressor.open_file(filepath)
+        try:
+            f.seek(offset)
+            while skip:
+                line = f.readline()
+                if not line:
+                    f.close()
+                    return None
+                if gcodes_cleaner.clean_chunk(line, comment_chars):
+                    skip -= 1
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+    def gcodes_stream(self, stream: typing.BinaryIO) -> bool:
+        # prints a file, that is still downloading, from a buffer, which grows while it is printed. Reading waits for
+        # the sender, when it is STREAM_READ_AHEAD_LINES ahead. When the print stops, reading stops and download is canceled.
+        gcodes = self.create_gcodes_buffer()
+        lines_read = 0
+        loaded = False
+        chunks = self.iterate_stream_gcodes(stream)
+        self.stream_loading = True
+        try:
+            for lines in chunks:
+                gcodes.extend(lines)
+                lines_read += len(lines)
+                self.set_total_gcodes(lines_read)
+                if not loaded:
+                    if lines_read < self.STREAM_START_LINES:
+                        continue
+                    loaded = self.load_streamed_gcodes(gcodes)
+                    if not loaded:
+                        return False
+                while self.is_printing() and not self.stop_flag and \
+                        lines_read - self.get_current_line_number() > self.STREAM_READ_AHEAD_LINES:
+                    time.sleep(self.STREAM_WAIT_PERIOD)
+                if not self.is_printing() or self.stop_flag:
+                    self.logger.info('Print of streamed gcodes stopped. Stopping the stream')
+                    return False
+            if not loaded and lines_read:
+                loaded = self.load_streamed_gcodes(gcodes)
+            elif not loaded:
+                self.logger.error('Error: empty gcodes stream')
+            return loaded
+        except IOError as e:
+            self.logger.warning('Gcodes stream error: ' + str(e))
+            if loaded:
+                self.cancel()
+            return False
+        finally:
+            self.stream_loading = False
+            chunks.close()
+
+    def load_streamed_gcodes(self, gcodes: typing.Any) -> bool:
+        self.logger.info(f'Starting print of streamed gcodes after {len(gcodes)} lines')
+        success = self.load_gcodes(gcodes) != False # None is equal to True here
+        if success:
+            self.print_start_time = time.monotonic()
+        return success
+
+    def start_gcodes_analysis(self, filepath: str) -> None:
+        # estimations are calculated in background, while the loaded file is printed
+        self.stop_gcodes_analysis()
+        self.gcodes_analysis = None
+        self.estimated_time = None
+        self.material_volumes = None
+        if self.get_file_compression(filepath) == gcodes_decompressor.BGCODE and self.set_bgcode_analysis(filepath):
+            return # slicer estimations from metadata blocks are used instead of analysis
+        if GcodesAnalysisThread.ENABLED:
+            try:
+                self.gcodes_analysis_thread = GcodesAnalysisThread(self, filepath)
+            except gcodes_decompressor.ERRORS as e:
+                self.logger.warning('Unable to open file for gcodes analysis: ' + str(e))
+            else:
+                self.gcodes_analysis_thread.start()
+
+    def stop_gcodes_analysis(self) -> None:
+        if self.gcodes_analysis_thread and self.gcodes_analysis_thread.is_alive():
+            self.gcodes_analysis_thread.stop_flag = True
+        self.gcodes_analysis_thread = None
+
+    def set_bgcode_analysis(self, filepath: str) -> bool:
+        try:
+            with open(filepath, "rb") as f:
+                analysis = bgcode_decoder.get_analysis(bgcode_decoder.read_metadata(f))
+        except gcodes_decompressor.ERRORS as e:
+            self.logger.warning('Unable to read bgcode metadata: ' + str(e))
+            return False
+        if not analysis:
+            return False
+        self.logger.info(f'Estimations from bgcode metadata: {analysis}')
+        self.set_gcodes_analysis(analysis)
+        return True
+
+    def set_gcodes_analysis(self, analysis: dict) -> None:
+        self.gcodes_analysis = analysis
+        self.estimated_time = analysis['estimated_time']
+        self.material_volumes = analysis['material_volumes']
+        if not self.est_print_time:
+            self.set_estimated_print_time(analysis['estimated_time'])
+
+    def iterate_stream_gcodes(self, stream: typing.BinaryIO) -> typing.Iterator[typing.List[bytes]]:
+        # yields lists of cleaned lines. Blocks when the consumer catches up with the downloader.
+        # DownloadStreamError(IOError) is raised on download failure. Closing of the stream before its end cancels the download.
+        try:
+            yield from gcodes_cleaner.iterate_cleaned(stream, tuple(self.COMMENT_CHARS), expand_tabs=True)
+        finally:
+            stream.close()
+            if not self.keep_print_files:
+                stream.remove_file()
+
     @property
     def filename(self) -> str:
         return self.send_filename
@@ -575,7 +916,7 @@ class BaseSender:
         return None
 
     def get_material_volumes(self) -> typing.List[float]:
-        return None
+        return self.material_volumes
 
     def get_material_colors_hex(self) -> typing.List[str]:
         return None
@@ -633,7 +974,99 @@ class BaseSender:
                 pass
         return 0
 
-    def unzip_file(self, filepath: str, processor: typing.Callable[[str], collections.deque], remove_after: bool = True) -> collections.deque:
+    def unzip_file(self, filepath: str, processor: typing.Callable[[typing.Union[str, typing.BinaryIO]], collections.deque], remove_after: bool = True) -> collections.deque:
+        # entry is inflated on the fly while processor reads it, without writing an extracted copy
+        if not self.IN_PROCESS_UNZIP:
+            return self.unzip_file_subprocess(filepath, processor, remove_after)
+        try:
+            with zipfile.ZipFile(filepath) as archive:
+                entries = {info.filename: info for info in archive.infolist() if not info.is_dir()}
+                self.logger.info(f'Zip contents: {list(entries)}')
+                if not entries:
+                    raise zipfile.BadZipFile('no files in archive')
+                info = entries[self.select_file_to_print({name: info.file_size for name, info in entries.items()})]
+                self.logger.info(f'File to print: {info.filename}')
+                if not self.can_load_gcodes(info.file_size):
+                    self.register_error(88, "Not enough memory. Cancelling...", is_blocking=True)
+                    return None
+                with archive.open(info) as f:
+                    return processor(f)
+        except (zipfile.BadZipFile, zlib.error, OSError, IOError, NotImplementedError, RuntimeError) as e:
+            self.logger.warning(f'Unzip error of {filepath}: {e}')
+            self.register_error(87, "Unzip error. Cancelling...", is_blocking=True)
+        finally:
+            if remove_after:
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+
+    def get_file_compression(self, filepath: str) -> str:
+        try:
+            return gcodes_decompressor.detect_file_compression(filepath)
+        except OSError:
+            return None # missing file is reported on its loading
+
+    def decompress_file(self, filepath: str, processor: typing.Callable[[typing.BinaryIO], collections.deque]) -> collections.deque:
+        # gzip or zstd compressed gcodes are decompressed on the fly while processor reads them, without an extracted copy
+        try:
+            with open(filepath, "rb") as f:
+                compression = gcodes_decompressor.detect_compression(f.read(gcodes_decompressor.MAGIC_SIZE))
+                f.seek(0)
+                return self.decompress(f, compression, processor)
+        except OSError as e:
+            self.logger.warning(f'Unable to open compressed gcodes file {filepath}: {e}')
+            self.register_error(85, "File loading error. Cancelling...", is_blocking=True)
+
+    def decompress(self, binary_file: typing.BinaryIO, compression: str, processor: typing.Callable[[typing.BinaryIO], collections.deque]) -> collections.deque:
+        try:
+            size = gcodes_decompressor.get_content_size(binary_file, compression)
+            self.logger.info(f'Loading {compression} compressed gcodes of size: {size/1024/1024}MB')
+            if not self.can_load_gcodes(size):
+                self.register_error(88, "Not enough memory. Cancelling...", is_blocking=True)
+                return None
+            if compression == gcodes_decompressor.BGCODE and process_pool.is_worth_using(size):
+                gcodes = self.decode_bgcode_in_pool(binary_file, processor)
+                if gcodes is not None:
+                    return gcodes
+                binary_file.seek(0)
+            with gcodes_decompressor.open_decompressed(binary_file, compression) as f:
+                return processor(f)
+        except gcodes_decompressor.ERRORS as e:
+            self.logger.warning(f'Decompression error of {compression} gcodes: {e}')
+            self.register_error(87, "Decompression error. Cancelling...", is_blocking=True)
+
+    def decode_bgcode_in_pool(self, binary_file: typing.BinaryIO, processor: typing.Callable[[typing.BinaryIO], collections.deque]) -> collections.deque:
+        # gcode blocks are independent, so they are decompressed and decoded by processes of the pool in parallel.
+        # Returns None when the pool is not usable, so the file could be decoded in this thread.
+        try:
+            executor = process_pool.get_executor()
+            blocks_decoder = lambda blocks: process_pool.map_ordered(executor, bgcode_decoder.decode_gcode_block,
+                                                                     blocks, lambda: self.stop_flag)
+            with bgcode_decoder.BgcodeReader(binary_file, blocks_decoder, closefd=False) as f:
+                return processor(f)
+        except (OSError, RuntimeError) as e:
+            self.logger.warning('Bgcode decoding by processes pool failed: ' + str(e))
+            return None
+
+    def select_file_to_print(self, file_sizes: dict) -> str:
+        if len(file_sizes) == 1:
+            return next(iter(file_sizes))
+        bigest_file_name = ""
+        bigest_file_size = 0
+        right_extension_files = []
+        for filename, size in file_sizes.items():
+            if filename.endswith(self.NATIVE_FILE_EXTENSION):
+                right_extension_files.append(filename)
+            if size > bigest_file_size:
+                bigest_file_size = size
+                bigest_file_name = filename
+        if not right_extension_files or \
+            (len(right_extension_files) > 1 and bigest_file_name in right_extension_files):
+            return bigest_file_name
+        return right_extension_files[0]
+
+    def unzip_file_subprocess(self, filepath: str, processor: typing.Callable[[str], collections.deque], remove_after: bool = True) -> collections.deque:
         # you will need a callback here, since temporary directory always erases on destructor
         try:
             with tempfile.TemporaryDirectory(dir=paths.DOWNLOAD_FOLDER) as unzip_tmpdir_name:
@@ -646,27 +1079,13 @@ class BaseSender:
                     elif exit_code == 0:
                         files_list = os.listdir(unzip_tmpdir_name)
                         self.logger.info(f'Zip contents: {files_list}')
-                        if len(files_list) == 1:
-                            filename = files_list[0]
-                        else:
-                            bigest_file_name = ""
-                            bigest_file_size = 0
-                            right_extension_files = []
-                            for filename in files_list:
-                                if filename.endswith(self.NATIVE_FILE_EXTENSION):
-                                    right_extension_files.append(filename)
-                                try:
-                                    size = os.path.getsize(filename)
-                                except OSError:
-                                    size = 0
-                                if size > bigest_file_size:
-                                    bigest_file_size = size
-                                    bigest_file_name = filename
-                            if not right_extension_files or \
-                                (len(right_extension_files) > 1 and bigest_file_name in right_extension_files):
-                                filename = bigest_file_name
-                            else:
-                                filename = right_extension_files[0]
+                        file_sizes = {}
+                        for filename in files_list:
+                            try:
+                                file_sizes[filename] = os.path.getsize(os.path.join(unzip_tmpdir_name, filename))
+                            except OSError:
+                                file_sizes[filename] = 0
+                        filename = self.select_file_to_print(file_sizes)
                         self.logger.info(f'File to print: {filename}')
                         filename = os.path.join(unzip_tmpdir_name, filename)
                         return processor(filename)
@@ -703,7 +1122,15 @@ class BaseSender:
     def camera_disable_hook(self):
         pass
 
+    def set_file_hashes(self, filename: str, hashes: dict) -> None:
+        self.file_hashes = {os.path.abspath(filename): hashes}
+
     def calculate_file_crc(self, filename, hexify=True):
+        crc = self.file_hashes.get(os.path.abspath(filename), {}).get('crc32')
+        if crc is not None:
+            if hexify:
+                crc = '{:#010x}'.format(crc)
+            return str(crc)
         try:
             with open(filename, "rb") as f:
                 crc = None
@@ -780,3 +1207,86 @@ class SpeedCalculationThread(threading.Thread):
                         self.logger.info(f"Delta:{delta_time} Speed:{speed} Avg:{avg_speed}")
                 last_percent = self.sender.get_percent()
                 last_time = time.monotonic()
+
+
+class GcodesAnalysisThread(threading.Thread):
+
+    SETTINGS = config.get_settings().get('gcodes_analysis', {})
+    ENABLED = SETTINGS.get('enabled', False)
+    ACCELERATION = SETTINGS.get('acceleration', gcodes_analyzer.DEFAULT_ACCELERATION)
+    FEEDRATE = SETTINGS.get('feedrate', gcodes_analyzer.DEFAULT_FEEDRATE)
+    FILAMENT_DIAMETER = SETTINGS.get('filament_diameter', gcodes_analyzer.DEFAULT_FILAMENT_DIAMETER)
+    POOL_MIN_SIZE = SETTINGS.get('pool_min_size_mb', 16) * 1024 * 1024 # analysis is slower than loading, so the pool pays off earlier
+
+    def __init__(self, sender: BaseSender, filepath: str):
+        self.sender = sender
+        self.stop_flag = False
+        self.logger = sender.logger.getChild(self.__class__.__name__)
+        self.comment_chars = tuple(sender.COMMENT_CHARS)
+        # opened at once, so the file could be removed after loading, while it is still analyzed
+        self.size = gcodes_decompressor.get_file_content_size(filepath)
+        self.file = gcodes_decompressor.open_file(filepath)
+        super().__init__(name="GcodesAnalysis", daemon=True)
+
+    def is_stopped(self) -> bool:
+        return self.stop_flag or self.sender.stop_flag
+
+    def get_filament_diameter(self) -> float:
+        try:
+            return float(self.sender.profile.get('filament_diameter', self.FILAMENT_DIAMETER))
+        except (TypeError, ValueError):
+            return self.FILAMENT_DIAMETER
+
+    def run(self) -> None:
+        try:
+            start_time = time.monotonic()
+            analyzer = None
+            # pool is not used for a not seekable stream, since it could not be reread after a pool failure
+            if self.file.seekable() and process_pool.is_worth_using(self.size, self.POOL_MIN_SIZE):
+                analyzer = self.analyze_in_pool()
+            if not analyzer and not self.is_stopped():
+                self.file.seek(0)
+                analyzer = self.analyze_in_thread()
+            if not analyzer:
+                self.logger.info('Gcodes analysis was stopped')
+                return
+            analysis = analyzer.get_results(self.get_filament_diameter())
+            self.logger.info(f'Gcodes analysis took {time.monotonic() - start_time:.2f}s: {analysis}')
+            self.sender.set_gcodes_analysis(analysis)
+        except Exception:
+            self.logger.exception('Exception on gcodes analysis:')
+        finally:
+            self.file.close()
+
+    def analyze_in_thread(self) -> gcodes_analyzer.GcodesAnalyzer:
+        analyzer = gcodes_analyzer.GcodesAnalyzer(self.ACCELERATION, self.FEEDRATE)
+        for lines in gcodes_cleaner.iterate_cleaned(self.file, self.comment_chars):
+            if self.is_stopped():
+                return None
+            analyzer.analyze(lines)
+        return analyzer
+
+    def analyze_in_pool(self) -> gcodes_analyzer.GcodesAnalyzer:
+        # chunks are analyzed by processes in parallel and merged in order of the file.
+        # Modes of a chunk start are found by a fast scan of the previous chunks, to submit it without waiting for them.
+        analyzer = gcodes_analyzer.GcodesAnalyzer(self.ACCELERATION, self.FEEDRATE)
+        scanner = gcodes_analyzer.GcodesAnalyzer(self.ACCELERATION, self.FEEDRATE)
+
+        def iterate_arguments():
+            for chunk in gcodes_cleaner.iterate_chunks(self.file, process_pool.CHUNK_SIZE):
+                yield chunk, self.comment_chars, scanner.get_modes(), self.FEEDRATE
+                scanner.scan_modes(chunk)
+
+        try:
+            executor = process_pool.get_executor()
+            for chunk_analyzer in process_pool.map_ordered(executor, gcodes_analyzer.analyze_chunk,
+                                                           iterate_arguments(), self.is_stopped):
+                analyzer.merge(chunk_analyzer)
+        except process_pool.Stopped:
+            return None
+        except (OSError, RuntimeError, ValueError) as e:
+            self.logger.warning('Gcodes analysis in processes pool failed: ' + str(e))
+            return None
+        if self.is_stopped():
+            return None
+        return analyzer
@@ -0,0 +1,463 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Streaming decoder of binary gcode (bgcode) files of libbgcode format version 1.
+# File is a header and a sequence of blocks: metadata blocks, thumbnails and gcode blocks. Each block has optional crc32
+# checksum and its data could be compressed by deflate or heatshrink. Gcode blocks could also be encoded by meatpack.
+# Gcode blocks are independent, so they could be decoded in the pool of processes. Decoded gcodes are text gcodes, so
+# BgcodeReader could be read by the same code, which reads text gcodes files.
+# Module heatshrink2 is optional. Pure python heatshrink decompression is used without it.
+
+import io
+import itertools
+import re
+import struct
+import zlib
+
+try:
+    import heatshrink2
+except ImportError:
+    heatshrink2 = None
+
+MAGIC = b"GCDE"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sIH") # magic, version, checksum type
+BLOCK_HEADER = struct.Struct("<HHI") # type, compression, uncompressed size
+COMPRESSED_SIZE = struct.Struct("<I") # only when the block is compressed
+ENCODING = struct.Struct("<H") # parameters of all blocks but thumbnails
+CHECKSUM = struct.Struct("<I")
+
+CHECKSUM_NONE = 0
+CHECKSUM_CRC32 = 1
+
+FILE_METADATA = 0
+GCODE = 1
+SLICER_METADATA = 2
+PRINTER_METADATA = 3
+PRINT_METADATA = 4
+THUMBNAIL = 5
+METADATA_BLOCKS = {FILE_METADATA: 'file', SLICER_METADATA: 'slicer', PRINTER_METADATA: 'printer', PRINT_METADATA: 'print'}
+PARAMETERS_SIZES = {THUMBNAIL: 6} # format, width and height
+METADATA_ENCODING_INI = 0
+
+COMPRESSION_NONE = 0
+COMPRESSION_DEFLATE = 1
+HEATSHRINK_PARAMETERS = {2: (11, 4), 3: (12, 4)} # window and lookahead bits
+
+GCODE_ENCODING_NONE = 0
+GCODE_ENCODING_MEATPACK = 1
+GCODE_ENCODING_MEATPACK_COMMENTS = 2
+MEATPACK_SIZE_RATIO = 2 # each byte of meatpacked gcodes is one or two characters
+
+# meatpack packs the most frequent characters of gcodes in 4 bits, 0b1111 means that a full character follows.
+# 0xff 0xff is a signal, which is followed by a command byte.
+MEATPACK_CHARS = b"0123456789. \nGX"
+MEATPACK_NO_SPACES_CHARS = MEATPACK_CHARS.replace(b" ", b"E") # spaces are not sent in no spaces mode
+MEATPACK_ENABLE_PACKING = 251
+MEATPACK_DISABLE_PACKING = 250
+MEATPACK_RESET_ALL = 249
+MEATPACK_ENABLE_NO_SPACES = 247
+MEATPACK_DISABLE_NO_SPACES = 246
+MEATPACK_NEWLINE = MEATPACK_CHARS.index(b"\n")
+MEATPACK_SKIPPED = b"\0" # upper half of a byte, which starts with newline, is unused
+# bytes, which are followed by full characters. Plain runs of other bytes between them are decoded by translate.
+MEATPACK_LOW_FULL = bytes(byte for byte in range(0x0f, 0xff, 0x10))
+MEATPACK_HIGH_FULL = bytes(byte for byte in range(0xf0, 0xff) if byte & 0xf != MEATPACK_NEWLINE)
+MEATPACK_UNIT_RE = re.compile(rb"(\xff\xff.|\xff..|[" + re.escape(MEATPACK_LOW_FULL) + rb"].|["
+                              + re.escape(MEATPACK_HIGH_FULL) + rb"].)", re.DOTALL)
+G_PARAMETERS = tuple(bytes((letter,)) for letter in b"XYZEFIJRPWHCA")
+NOT_RESPACED_RE = re.compile(rb"^[^G\n][^\n]*|;[^\n]*", re.MULTILINE) # lines, which are not G lines, and comments
+
+
+class BgcodeError(ValueError):
+    pass
+
+
+def make_meatpack_tables(chars):
+    # translate tables for lower and upper halves of bytes without full characters
+    low = bytes(chars[byte & 0xf] if byte & 0xf != 0xf else 0 for byte in range(256))
+    high = bytes(chars[byte >> 4] if byte >> 4 != 0xf and byte & 0xf != MEATPACK_NEWLINE else 0 for byte in range(256))
+    return low, high
+
+
+MEATPACK_TABLES = {False: make_meatpack_tables(MEATPACK_CHARS), True: make_meatpack_tables(MEATPACK_NO_SPACES_CHARS)}
+
+
+def heatshrink_decompress(data, window_bits, lookahead_bits):
+    if heatshrink2:
+        return heatshrink2.decompress(data, window_sz2=window_bits, lookahead_sz2=lookahead_bits)
+    # bits are read msb first. Tag bit 1 is a literal byte, 0 is a backref of window_bits index and lookahead_bits count.
+    # Any token is at most 17 bits, so with up to 7 bits of offset it is always inside of 3 bytes at its position.
+    window = 1 << window_bits
+    out = bytearray(window) # backrefs before the start of data point to zeroed window
+    backref_bits = 1 + window_bits + lookahead_bits
+    index_shift = 23 - window_bits
+    index_mask = window - 1
+    count_shift = index_shift - lookahead_bits
+    count_mask = (1 << lookahead_bits) - 1
+    total_bits = len(data) * 8
+    data = data + b"\0\0\0"
+    position = 0
+    while True:
+        offset = position >> 3
+        bits = ((data[offset] << 16 | data[offset + 1] << 8 | data[offset + 2]) << (position & 7)) & 0xffffff
+        if bits & 0x800000:
+            if position + 9 > total_bits:
+                break
+            out.append(bits >> 15 & 0xff)
+            position += 9
+        else:
+            if position + backref_bits > total_bits:
+                break # padding of the last byte
+            index = (bits >> index_shift & index_mask) + 1
+            count = (bits >> count_shift & count_mask) + 1
+            position += backref_bits
+            start = len(out) - index
+            if count <= index:
+                out += out[start:start + count]
+            else:
+                out += (out[start:] * (count // index + 1))[:count]
+    return bytes(out[window:])
+
+
+def decompress_block(data, compression, uncompressed_size):
+    if compression == COMPRESSION_NONE:
+        return data
+    try:
+        if compression == COMPRESSION_DEFLATE:
+            data = zlib.decompress(data)
+        elif compression in HEATSHRINK_PARAMETERS:
+            data = heatshrink_decompress(data, *HEATSHRINK_PARAMETERS[compression])
+        else:
+            raise BgcodeError(f'unknown compression of block: {compression}')
+    except zlib.error as e:
+        raise BgcodeError(f'block decompression error: {e}')
+    if len(data) != uncompressed_size:
+        raise BgcodeError(f'block size after decompression {len(data)} is not {uncompressed_size}')
+    return data
+
+
+class MeatpackUnits(dict):
+    # padded decoded forms of bytes with full characters after them, such as b"X1" -> b"1X\0\0". There are only a few
+    # hundreds of distinct ones, so each is decoded once.
+
+    def __init__(self, packing, no_spaces):
+        super().__init__()
+        self.packing = packing
+        self.chars = MEATPACK_NO_SPACES_CHARS if no_spaces else MEATPACK_CHARS
+
+    def __missing__(self, unit):
+        decoded = unit
+        if self.packing:
+            first = unit[0]
+            if first == 0xff:
+                decoded = unit[1:]
+            elif first & 0xf == 0xf:
+                decoded = unit[1:] + self.chars[first >> 4:(first >> 4) + 1]
+            else:
+                decoded = self.chars[first & 0xf:(first & 0xf) + 1] + unit[1:]
+        decoded = decoded.ljust(len(unit) * 2, MEATPACK_SKIPPED)
+        self[unit] = decoded
+        return decoded
+
+
+MEATPACK_UNITS = {(packing, no_spaces): MeatpackUnits(packing, no_spaces) for packing in (False, True) for no_spaces in (False, True)}
+
+
+def meatpack_translate(data, out, start, end, packing, no_spaces):
+    # each byte of data[start:end] is written to two places of out, so out is twice longer than data
+    segment = data[start:end]
+    if packing:
+        low, high = MEATPACK_TABLES[no_spaces]
+        out[start * 2:end * 2:2] = segment.translate(low)
+        out[start * 2 + 1:end * 2:2] = segment.translate(high)
+    else:
+        out[start * 2:end * 2:2] = segment
+
+
+def meatpack_decode(data):
+    # same as meatpack decoder of Marlin. Runs of bytes between signals are decoded by translate to two places per byte.
+    # Places of bytes with full characters after them are overwritten by python, unused places are zeros removed at end.
+    out = bytearray(len(data) * 2)
+    packing = False
+    no_spaces = False
+    respace = False
+    start = 0
+    units = MEATPACK_UNITS[packing, no_spaces]
+    fixups = []
+    for match in itertools.chain(MEATPACK_UNIT_RE.finditer(data), (None,)):
+        unit = match.group() if match else b"\xff\xff\0"
+        if unit[:2] != b"\xff\xff":
+            fixups.append((match.start() * 2, units[unit]))
+            continue
+        end = match.start() if match else len(data)
+        meatpack_translate(data, out, start, end, packing, no_spaces)
+        for offset, decoded in fixups:
+            out[offset:offset + len(decoded)] = decoded
+        fixups.clear()
+        start = end + len(unit)
+        command = unit[2]
+        if command == MEATPACK_ENABLE_PACKING:
+            packing = True
+        elif command == MEATPACK_DISABLE_PACKING:
+            packing = False
+        elif command == MEATPACK_ENABLE_NO_SPACES:
+            no_spaces = respace = True
+        elif command == MEATPACK_DISABLE_NO_SPACES:
+            no_spaces = False
+        elif command == MEATPACK_RESET_ALL:
+            packing = no_spaces = False
+        units = MEATPACK_UNITS[packing, no_spaces]
+    text = bytes(out).replace(MEATPACK_SKIPPED, b"")
+    if respace:
+        text = respace_g_lines(text)
+    return text
+
+
+def respace_g_lines(text):
+    # libbgcode decoder restores spaces before parameters of G commands, which were omitted in no spaces mode.
+    # Runs of G lines are respaced by replaces of whole run, other lines and comments are kept as they are.
+    out = []
+    start = 0
+    for match in NOT_RESPACED_RE.finditer(text):
+        out.append(respace_g_run(text[start:match.start()]))
+        out.append(match.group())
+        start = match.end()
+    out.append(respace_g_run(text[start:]))
+    return b"".join(out)
+
+
+def respace_g_run(text):
+    for parameter in G_PARAMETERS:
+        text = text.replace(parameter, b" " + parameter)
+    return text.replace(b"  ", b" ")
+
+
+def decode_gcode_block(data, compression, uncompressed_size, encoding):
+    # returns text gcodes of a block. Could be called by processes of the pool.
+    data = decompress_block(data, compression, uncompressed_size)
+    if encoding in (GCODE_ENCODING_MEATPACK, GCODE_ENCODING_MEATPACK_COMMENTS):
+        return meatpack_decode(data)
+    if encoding != GCODE_ENCODING_NONE:
+        raise BgcodeError(f'unknown encoding of gcode block: {encoding}')
+    return data
+
+
+def parse_ini(data):
+    metadata = {}
+    for line in data.decode('utf-8', errors='replace').splitlines():
+        key, sep, value = line.partition('=')
+        if sep:
+            metadata[key.strip()] = value.strip()
+    return metadata
+
+
+def parse_time(text):
+    # time in format of the slicer, such as 1d 2h 3m 4s
+    units = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+    parts = re.findall(r"(\d+)\s*([dhms])", text)
+    if not parts:
+        raise ValueError(f'not a time: {text}')
+    return sum(int(value) * units[unit] for value, unit in parts)
+
+
+def parse_numbers(text):
+    return [float(value) for value in text.split(',') if value.strip()]
+
+
+def get_analysis(metadata, filament_diameter=1.75):
+    # estimations of the slicer in the same form as results of gcodes_analyzer, or None without print time in metadata
+    values = {}
+    for name in ('file', 'slicer', 'printer', 'print'): # later blocks are more specific
+        values.update(metadata.get(name, {}))
+    try:
+        estimated_time = parse_time(values['estimated printing time (normal mode)'])
+    except (KeyError, ValueError):
+        return None
+    lengths = []
+    volumes = []
+    try:
+        lengths = [round(length, 2) for length in parse_numbers(values.get('filament used [mm]', ''))]
+        if 'filament used [cm3]' in values:
+            volumes = [round(volume, 2) for volume in parse_numbers(values['filament used [cm3]'])]
+        else:
+            diameter = parse_numbers(values.get('filament_diameter', '')) or [filament_diameter]
+            area = 3.141592653589793 * diameter[0] * diameter[0] / 4
+            volumes = [round(length * area / 1000, 2) for length in lengths]
+    except ValueError:
+        pass
+    layers = None
+    try:
+        layers = int(values['total layers count'])
+    except (KeyError, ValueError):
+        pass
+    return {'estimated_time': estimated_time,
+            'layers': layers,
+            'filament_lengths': lengths, # mm
+            'material_volumes': volumes, # cm3
+            'bounding_box': None}
+
+
+class BgcodeReader(io.RawIOBase):
+    # binary file like object, which reads text gcodes of gcode blocks of bgcode file, decoding them block by block.
+    # Metadata blocks, which precede gcode blocks, are collected in metadata. Blocks could be decoded elsewhere by
+    # blocks_decoder, which takes iterable of decode_gcode_block arguments and yields decoded blocks in the same order.
+
+    def __init__(self, binary_file, blocks_decoder=None, closefd=True):
+        super().__init__()
+        self.file = binary_file
+        self.closefd = closefd
+        self.metadata = {}
+        magic, version, self.checksum_type = FILE_HEADER.unpack(self.read_exactly(FILE_HEADER.size))
+        if magic != MAGIC:
+            raise BgcodeError('not a bgcode file')
+        if version != VERSION:
+            raise BgcodeError(f'unsupported bgcode version: {version}')
+        if self.checksum_type not in (CHECKSUM_NONE, CHECKSUM_CRC32):
+            raise BgcodeError(f'unknown checksum type: {self.checksum_type}')
+        if not blocks_decoder:
+            blocks_decoder = lambda blocks: itertools.starmap(decode_gcode_block, blocks)
+        self.decoded_blocks = iter(blocks_decoder(self.iterate_gcode_blocks()))
+        self.buffer = b""
+        self.buffer_position = 0
+        self.position = 0
+
+    def read_exactly(self, size):
+        data = self.file.read(size)
+        if len(data) != size:
+            raise BgcodeError('unexpected end of bgcode file')
+        return data
+
+    def iterate_blocks(self):
+        # yields type, compression, uncompressed size, parameters and data of blocks with verified checksums
+        while True:
+            header = self.file.read(BLOCK_HEADER.size)
+            if not header:
+                return
+            if len(header) != BLOCK_HEADER.size:
+                raise BgcodeError('unexpected end of bgcode file')
+            block_type, compression, uncompressed_size = BLOCK_HEADER.unpack(header)
+            size = uncompressed_size
+            if compression != COMPRESSION_NONE:
+                size_data = self.read_exactly(COMPRESSED_SIZE.size)
+                header += size_data
+                size = COMPRESSED_SIZE.unpack(size_data)[0]
+            parameters = self.read_exactly(PARAMETERS_SIZES.get(block_type, ENCODING.size))
+            data = self.read_exactly(size)
+            if self.checksum_type == CHECKSUM_CRC32:
+                checksum = CHECKSUM.unpack(self.read_exactly(CHECKSUM.size))[0]
+                if zlib.crc32(data, zlib.crc32(parameters, zlib.crc32(header))) != checksum:
+                    raise BgcodeError(f'checksum mismatch of block of type {block_type}')
+            yield block_type, compression, uncompressed_size, parameters, data
+
+    def iterate_gcode_blocks(self):
+        # yields arguments of decode_gcode_block
+        for block_type, compression, uncompressed_size, parameters, data in self.iterate_blocks():
+            if block_type == GCODE:
+                yield data, compression, uncompressed_size, ENCODING.unpack(parameters)[0]
+            elif block_type in METADATA_BLOCKS and ENCODING.unpack(parameters)[0] == METADATA_ENCODING_INI:
+                self.metadata[METADATA_BLOCKS[block_type]] = parse_ini(decompress_block(data, compression, uncompressed_size))
+
+    def fill_buffer(self):
+        # returns False at the end of gcodes
+        while self.buffer_position >= len(self.buffer):
+            block = next(self.decoded_blocks, None)
+            if block is None:
+                return False
+            self.buffer = block
+            self.buffer_position = 0
+        return True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.fill_buffer():
+            return 0
+        size = min(len(buffer), len(self.buffer) - self.buffer_position)
+        buffer[:size] = self.buffer[self.buffer_position:self.buffer_position + size]
+        self.buffer_position += size
+        self.position += size
+        return size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.readall()
+        if not size or not self.fill_buffer():
+            return b""
+        data = self.buffer[self.buffer_position:self.buffer_position + size]
+        self.buffer_position += len(data)
+        self.position += len(data)
+        return data
+
+    def readline(self, size=-1):
+        parts = []
+        while size and self.fill_buffer():
+            end = self.buffer.find(b"\n", self.buffer_position) + 1 or len(self.buffer)
+            if size > 0:
+                end = min(end, self.buffer_position + size)
+                size -= end - self.buffer_position
+            parts.append(self.buffer[self.buffer_position:end])
+            self.position += end - self.buffer_position
+            self.buffer_position = end
+            if parts[-1].endswith(b"\n"):
+                break
+        return b"".join(parts)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # only forward, by decoding of skipped gcodes
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('bgcode reader could be seeked only from the start or the current position')
+        if offset < self.position:
+            raise io.UnsupportedOperation('bgcode reader could not be seeked backwards')
+        while self.position < offset and self.read(min(offset - self.position, io.DEFAULT_BUFFER_SIZE * 16)):
+            pass
+        return self.position
+
+    def close(self):
+        if not self.closed and self.closefd:
+            self.file.close()
+        super().close()
+
+
+def read_metadata(binary_file):
+    # metadata blocks of bgcode file, without decoding of gcode blocks
+    reader = BgcodeReader(binary_file, blocks_decoder=lambda blocks: iter(()), closefd=False)
+    for _ in reader.iterate_gcode_blocks():
+        break
+    return reader.metadata
+
+
+def get_content_size(binary_file):
+    # size of text gcodes of seekable bgcode file, estimated by block headers without reading of blocks data
+    binary_file.seek(0)
+    checksum_type = FILE_HEADER.unpack(binary_file.read(FILE_HEADER.size))[2]
+    checksum_size = CHECKSUM.size if checksum_type == CHECKSUM_CRC32 else 0
+    size = 0
+    while True:
+        header = binary_file.read(BLOCK_HEADER.size)
+        if len(header) != BLOCK_HEADER.size:
+            return size
+        block_type, compression, uncompressed_size = BLOCK_HEADER.unpack(header)
+        data_size = uncompressed_size
+        if compression != COMPRESSION_NONE:
+            data_size = COMPRESSED_SIZE.unpack(binary_file.read(COMPRESSED_SIZE.size) or b"\0" * COMPRESSED_SIZE.size)[0]
+        parameters = binary_file.read(PARAMETERS_SIZES.get(block_type, ENCODING.size))
+        if block_type == GCODE:
+            encoding = ENCODING.unpack(parameters)[0] if len(parameters) == ENCODING.size else GCODE_ENCODING_NONE
+            size += uncompressed_size * (MEATPACK_SIZE_RATIO if encoding != GCODE_ENCODING_NONE else 1)
+        binary_file.seek(data_size + checksum_size, io.SEEK_CUR)
@@ -0,0 +1,246 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+import errno
+import http.client
+import logging
+import selectors
+import socket
+import ssl
+import threading
+import time
+
+import requests
+import requests.adapters
+import urllib3.connection
+import urllib3.connectionpool
+import urllib3.exceptions
+
+import config
+
+
+class ResolverCache:
+
+    TTL = config.get_settings()['protocol'].get('dns_cache_ttl', 300)
+    NEGATIVE_TTL = config.get_settings()['protocol'].get('dns_negative_ttl', 10)
+    CONNECT_ATTEMPT_DELAY = config.get_settings()['protocol'].get('connect_attempt_delay', 0.25)
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def getaddrinfo(self, host, port):
+        key = (host, port)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry:
+            expires, addresses, error = entry
+            if now < expires:
+                if error:
+                    raise error
+                return addresses
+        try:
+            addresses = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            if entry and entry[1]:
+                # resolver is down, but the stale addresses are better than no connection at all
+                self.logger.warning(f'Unable to resolve {host}: {e}. Using cached addresses')
+                return entry[1]
+            with self.lock:
+                self.entries[key] = (now + self.NEGATIVE_TTL, None, e)
+            raise
+        with self.lock:
+            self.entries[key] = (now + self.TTL, addresses, None)
+        return addresses
+
+    def invalidate(self, host, port):
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+    @staticmethod
+    def interleave_families(addresses):
+        # RFC 8305: alternate address families, starting with the first one returned by the resolver
+        families = {}
+        for address in addresses:
+            families.setdefault(address[0], []).append(address)
+        queues = list(families.values())
+        result = []
+        while queues:
+            for queue in list(queues):
+                result.append(queue.pop(0))
+                if not queue:
+                    queues.remove(queue)
+        return result
+
+    def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None, socket_options=None):
+        host, port = address[:2]
+        if host.startswith('['):
+            host = host.strip('[]')
+        if not isinstance(timeout, (int, float)):
+            timeout = socket.getdefaulttimeout()
+        addresses = self.interleave_families(self.getaddrinfo(host, port))
+        try:
+            return self.connect_first(addresses, timeout, source_address, socket_options)
+        except socket.timeout:
+            raise
+        except OSError:
+            # all addresses are unreachable, so probably they are outdated
+            self.invalidate(host, port)
+            raise
+
+    def connect_first(self, addresses, timeout, source_address, socket_options):
+        # starts a new connection attempt every CONNECT_ATTEMPT_DELAY (or as soon as previous one fails) and keeps the first one to succeed
+        deadline = None if timeout is None else time.monotonic() + timeout
+        selector = selectors.DefaultSelector()
+        pending = []
+        last_error = None
+        next_attempt_time = time.monotonic()
+        try:
+            while addresses or pending:
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    raise socket.timeout('timed out')
+                if addresses and (now >= next_attempt_time or not pending):
+                    family, socktype, proto, _, sockaddr = addresses.pop(0)
+                    sock = None
+                    try:
+                        sock = socket.socket(family, socktype, proto)
+                        if socket_options:
+                            for option in socket_options:
+                                sock.setsockopt(*option)
+                        if source_address:
+                            sock.bind(source_address)
+                        sock.setblocking(False)
+                        error_code = sock.connect_ex(sockaddr)
+                        if error_code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                            raise OSError(error_code, errno.errorcode.get(error_code, 'connection error'))
+                    except OSError as e:
+                        last_error = e
+                        if sock:
+                            sock.close()
+                        continue
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    pending.append(sock)
+                    next_attempt_time = now + self.CONNECT_ATTEMPT_DELAY
+                wait_until = deadline
+                if addresses:
+                    wait_until = next_attempt_time if deadline is None else min(deadline, next_attempt_time)
+                wait = None if wait_until is None else max(wait_until - time.monotonic(), 0)
+                for key, _ in selector.select(wait):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    pending.remove(sock)
+                    error_code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if error_code:
+                        last_error = OSError(error_code, errno.errorcode.get(error_code, 'connection error'))
+                        sock.close()
+                        next_attempt_time = time.monotonic()
+                    else:
+                        sock.settimeout(timeout)
+                        return sock
+            if last_error:
+                raise last_error
+            raise OSError('getaddrinfo returns an empty list')
+        finally:
+            for sock in pending:
+                sock.close()
+            selector.close()
+
+
+resolver = ResolverCache()
+
+# _new_conn of urllib3 connections is overridden, so only the versions it was checked with are used
+SUPPORTED_URLLIB3_VERSIONS = (1, 2)
+URLLIB3_SUPPORTED = urllib3.__version__.split('.')[0] in map(str, SUPPORTED_URLLIB3_VERSIONS)
+
+
+class HTTPConnection(http.client.HTTPConnection):
+    # http.client connection, that connects through the resolver cache
+
+    def __init__(self, host, port=None, resolver=resolver, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.resolver = resolver
+
+    def connect(self):
+        self.sock = self.resolver.create_connection((self.host, self.port), self.timeout, self.source_address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class HTTPSConnection(HTTPConnection):
+
+    default_port = http.client.HTTPS_PORT
+
+    def __init__(self, host, port=None, context=None, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.context = context or ssl.create_default_context()
+
+    def connect(self):
+        super().connect()
+        try:
+            self.sock = self.context.wrap_socket(self.sock, server_hostname=self.host)
+        except BaseException:
+            self.sock.close()
+            self.sock = None
+            raise
+
+
+class CachedConnectionMixin:
+
+    resolver = resolver
+
+    def _new_conn(self):
+        try:
+            return self.resolver.create_connection((self.host, self.port), self.timeout,
+                                                   source_address=self.source_address, socket_options=self.socket_options)
+        except socket.timeout as e:
+            raise urllib3.exceptions.ConnectTimeoutError(
+                self, f"Connection to {self.host} timed out. (connect timeout={self.timeout})") from e
+        except OSError as e:
+            raise urllib3.exceptions.NewConnectionError(self, f"Failed to establish a new connection: {e}") from e
+
+
+class CachedHTTPConnection(CachedConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+
+class CachedHTTPSConnection(CachedConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+
+class CachedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = CachedHTTPConnection
+
+
+class CachedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = CachedHTTPSConnection
+
+
+class CachedHTTPAdapter(requests.adapters.HTTPAdapter):
+    # connects through the resolver cache instead of urllib3's own resolving and connecting
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': CachedHTTPConnectionPool,
+                                                   'https': CachedHTTPSConnectionPool}
+
+
+def requests_session():
+    session = requests.Session()
+    if not URLLIB3_SUPPORTED:
+        logging.getLogger(__name__).warning(f'Not supported urllib3 version {urllib3.__version__}. Resolving without cache')
+        return session
+    adapter = CachedHTTPAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,213 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Local cache of downloaded print files. Files are stored by sha256 of their contents,
+# cloud's file/job ids and hashes are only lookup keys pointing to the contents.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import config
+import paths
+
+
+class DownloadCache(config.Singleton):
+
+    ENABLED = config.get_settings().get('downloader', {}).get('cache', False)
+    MAX_SIZE = config.get_settings().get('downloader', {}).get('cache_size_mb', 1024) * 1024 * 1024
+    INDEX_FILENAME = 'index.json'
+    HASH_READ_SIZE = 1024*1024
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.index_lock = threading.RLock()
+        self.folder = paths.init_folder(paths.DOWNLOAD_CACHE_NAME, paths.CURRENT_SETTINGS_FOLDER)
+        self.index_path = os.path.join(self.folder, self.INDEX_FILENAME)
+        self.entries = {} # sha256: {'size': int, 'last_used': float}
+        self.keys = {} # lookup key: sha256
+        self.load_index()
+
+    @staticmethod
+    def form_keys(file_info, size=None):
+        # lookup keys of a cloud file. Ids are combined with size to never mix up files of reused ids.
+        keys = []
+        if not file_info:
+            return keys
+        size = size or file_info.get('size')
+        file_hash = file_info.get('sha256')
+        if file_hash:
+            keys.append('sha256:' + str(file_hash).lower())
+        if size:
+            for name in ('file_id', 'job_id'):
+                value = file_info.get(name)
+                if value:
+                    keys.append(f'{name}:{value}:{size}')
+        return keys
+
+    @staticmethod
+    def calculate_sha256(path):
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(DownloadCache.HASH_READ_SIZE)
+                if not data:
+                    break
+                file_hash.update(data)
+        return file_hash.hexdigest()
+
+    def load_index(self):
+        with self.index_lock:
+            try:
+                with open(self.index_path) as f:
+                    index = json.load(f)
+                self.entries = index['entries']
+                self.keys = index['keys']
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.logger.warning('Download cache index is broken and will be reset: ' + str(e))
+                self.entries, self.keys = {}, {}
+            for file_hash in list(self.entries):
+                if not os.path.isfile(self.get_entry_path(file_hash)):
+                    self.remove_entry(file_hash)
+            for name in os.listdir(self.folder):
+                if name != self.INDEX_FILENAME and name not in self.entries:
+                    try:
+                        os.remove(os.path.join(self.folder, name))
+                    except OSError:
+                        pass
+
+    def save_index(self):
+        with self.index_lock:
+            try:
+                with tempfile.NamedTemporaryFile('w', dir=self.folder, delete=False, suffix='.tmp') as f:
+                    json.dump({'entries': self.entries, 'keys': self.keys}, f)
+                os.replace(f.name, self.index_path)
+            except OSError as e:
+                self.logger.warning('Unable to save download cache index: ' + str(e))
+
+    def get_entry_path(self, file_hash):
+        return os.path.join(self.folder, file_hash)
+
+    def get_total_size(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def remove_entry(self, file_hash):
+        with self.index_lock:
+            self.entries.pop(file_hash, None)
+            for key, value in list(self.keys.items()):
+                if value == file_hash:
+                    del self.keys[key]
+            try:
+                os.remove(self.get_entry_path(file_hash))
+            except OSError:
+                pass
+
+    def lookup(self, keys):
+        # returns path of the cached file or None
+        with self.index_lock:
+            for key in keys:
+                file_hash = self.keys.get(key)
+                if file_hash:
+                    path = self.get_entry_path(file_hash)
+                    try:
+                        if os.path.getsize(path) != self.entries[file_hash]['size']:
+                            raise OSError('size mismatch')
+                    except (OSError, KeyError) as e:
+                        self.logger.warning(f'Dropping broken download cache entry {file_hash}: {e}')
+                        self.remove_entry(file_hash)
+                        self.save_index()
+                        continue
+                    self.entries[file_hash]['last_used'] = time.time()
+                    for other_key in keys:
+                        self.keys.setdefault(other_key, file_hash)
+                    self.save_index()
+                    self.logger.info(f'Download cache hit by {key}')
+                    return path
+
+    def extract(self, cached_path, suffix):
+        # sender can remove or move the print file, so it gets its own link to the cached file
+        fd, path = tempfile.mkstemp(dir=paths.DOWNLOAD_FOLDER, prefix='3dprinteros-', suffix=suffix)
+        os.close(fd)
+        os.remove(path)
+        try:
+            os.link(cached_path, path)
+        except OSError:
+            shutil.copyfile(cached_path, path)
+        return path
+
+    def get_entry(self, file_hash):
+        with self.index_lock:
+            return dict(self.entries.get(file_hash, {}))
+
+    def store(self, path, keys, file_hash=None, crc32=None):
+        if not keys:
+            return
+        try:
+            size = os.path.getsize(path)
+            if size > self.MAX_SIZE:
+                self.logger.info(f'File of {size}B is larger than download cache size. Not caching')
+                return
+            if not file_hash:
+                file_hash = self.calculate_sha256(path)
+            with self.index_lock:
+                cached_path = self.get_entry_path(file_hash)
+                if file_hash not in self.entries:
+                    try:
+                        os.link(path, cached_path)
+                    except FileExistsError:
+                        pass
+                    except OSError:
+                        shutil.copyfile(path, cached_path)
+                self.entries[file_hash] = {'size': size, 'last_used': time.time()}
+                if crc32 is not None:
+                    self.entries[file_hash]['crc32'] = crc32
+                for key in keys:
+                    self.keys[key] = file_hash
+                self.evict(file_hash)
+                self.save_index()
+            self.logger.info(f'Stored {size}B in download cache as {file_hash}')
+        except OSError as e:
+            self.logger.warning('Unable to store file in download cache: ' + str(e))
+
+    def store_bytes(self, data, keys, file_hash=None, crc32=None):
+        if not keys or len(data) > self.MAX_SIZE:
+            return
+        if not file_hash:
+            file_hash = hashlib.sha256(data).hexdigest()
+        with tempfile.NamedTemporaryFile('wb', dir=self.folder, delete=False, suffix='.tmp') as f:
+            f.write(data)
+        try:
+            self.store(f.name, keys, file_hash, crc32)
+        finally:
+            try:
+                os.remove(f.name)
+            except OSError:
+                pass
+
+    def evict(self, keep_hash=None):
+        # removes least recently used files until cache fits in its size limit
+        with self.index_lock:
+            total_size = self.get_total_size()
+            for file_hash in sorted(self.entries, key=lambda file_hash: self.entries[file_hash]['last_used']):
+                if total_size <= self.MAX_SIZE:
+                    break
+                if file_hash != keep_hash:
+                    total_size -= self.entries[file_hash]['size']
+                    self.logger.info(f'Evicting {file_hash} from download cache')
+                    self.remove_entry(file_hash)
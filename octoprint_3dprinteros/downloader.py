@@ -10,16 +10,24 @@
 # (available at https://www.3dprinteros.com/terms-and-conditions/),
 # and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
 
+import hashlib
+import json
 import os
+import queue
 import tempfile
 import threading
 import time
 import io
+import zlib
 
 import requests
 import certifi
 
+import bandwidth
 import config
+import dns_cache
+import download_cache
+import gcodes_decompressor
 import log
 import paths
 
@@ -29,39 +37,93 @@ class Downloader(threading.Thread):
     CONNECTION_TIMEOUT = 6
     MAX_RETRIES = 5
     DOWNLOAD_CHUNK_SIZE = 128*1024 #128kB
+    SEGMENTS = config.get_settings().get('downloader', {}).get('segments', 1)
+    SEGMENTED_MIN_SIZE = config.get_settings().get('downloader', {}).get('segmented_min_size_mb', 32) * 1024 * 1024
+    PROGRESS_LOG_PERIOD = 1
+    STREAMING = config.get_settings().get('downloader', {}).get('streaming', False)
+    STREAMING_PREFIX_SIZE = config.get_settings().get('downloader', {}).get('streaming_prefix_kb', 1024) * 1024
+    RESUME_AFTER_RESTART = config.get_settings().get('downloader', {}).get('resume_after_restart', True)
 
-    def __init__(self, parent, url, callback, is_zip):
+    def __init__(self, parent, url, callback, is_zip, file_info=None):
         self.logger = parent.logger.getChild(self.__class__.__name__)
         self.parent = parent
         self.url = url
         self.callback = callback
         self.in_memory_gcodes = False
-        if config.get_settings()['in_memory_gcodes']:
-            try:
-                self.in_memory_gcodes = getattr(parent.sender, 'print_bytes')
-                if self.in_memory_gcodes:
-                    self.logger.info('In memory gcodes mode enabled')
-            except:
-                pass
+        # only senders, which implement print_bytes, load gcodes from memory. Zip archives are always unpacked from a file.
+        if config.get_settings()['in_memory_gcodes'] and not is_zip:
+            self.in_memory_gcodes = callable(getattr(getattr(parent, 'sender', None), 'print_bytes', None))
+            if self.in_memory_gcodes:
+                self.logger.info('In memory gcodes mode enabled')
         self.is_zip = is_zip
+        self.job_id = file_info.get('job_id') if file_info else None
+        self.announced_size = 0
+        if file_info and str(file_info.get('size', '')).isdigit():
+            self.announced_size = int(file_info['size'])
+        self.partial = None
+        self.validators = {}
+        self.crc32 = 0
+        self.sha256 = hashlib.sha256()
+        self.hashed_bytes = 0
+        self.hashes = {}
+        self.expected_hashes = {}
+        if file_info:
+            self.expected_hashes = {name: file_info[name] for name in ('crc32', 'sha256') if file_info.get(name)}
+        self.cache = None
+        self.cache_keys = []
+        self.cache_hit = False
+        if download_cache.DownloadCache.ENABLED:
+            self.cache = download_cache.DownloadCache.instance()
+            self.cache_keys = self.cache.form_keys(file_info)
         self.cancel_flag = False
         self.download_size = 0
         self.downloaded_bytes = 0
         self.written_bytes = 0 
         self.percent = 0.0
+        self.progress_lock = threading.Lock()
+        self.progress_condition = threading.Condition(self.progress_lock)
+        self.cancel_segments = False
+        self.finished = False
+        self.failed = False
+        self.stream_started = False
+        self.stream_stopped = False # consumer of the stream stopped before the end of download
+        self.stream_callback = None
+        if self.STREAMING and not is_zip and not self.in_memory_gcodes:
+            sender = getattr(parent, 'sender', None)
+            if getattr(sender, 'STREAMING_SUPPORTED', False) and getattr(callback, '__name__', None) in ('gcodes', 'print_file'):
+                self.stream_callback = sender.gcodes_stream
+                self.logger.info('Streaming gcodes to the sender during download')
         threading.Thread.__init__(self, name="Downloader", daemon=True)
 
     @log.log_exception
     def run(self):
         self.logger.info('Starting downloading')
-        downloaded = self.download()
-        if downloaded and self.callback:
+        try:
+            downloaded = self.download()
+        finally:
+            if self.partial:
+                self.partial.release()
+        if downloaded and not self.cache_hit:
+            downloaded = self.check_integrity(downloaded)
+        if downloaded and self.cache_keys and not self.cache_hit and not self.cancel_flag:
+            self.store_in_cache(downloaded)
+        with self.progress_condition:
+            if downloaded:
+                self.finished = True
+            else:
+                self.failed = True
+            self.progress_condition.notify_all()
+        if downloaded:
+            self.pass_hashes_to_sender(downloaded)
+        if self.stream_started:
+            pass # sender is already consuming the file
+        elif downloaded and self.callback:
             if self.in_memory_gcodes:
                 self.logger.info('In memory gcodes mode enabled. Overriding download complete callback with load_text')
                 self.parent.sender.print_bytes(downloaded)
             else:
                 self.execule_callback(downloaded)
-        if self.cancel_flag:
+        if self.cancel_flag and not self.stream_stopped:
             self.logger.info('Cancel command was received after printing start in downloading thread')
             try:
                 self.parent.sender.cancel()
@@ -87,33 +149,68 @@ class Downloader(threading.Thread):
             suffix = ".zip"
         else:
             suffix = ".gcode"
+        if self.cache_keys:
+            downloaded = self.load_from_cache(suffix)
+            if downloaded:
+                return downloaded
         if self.in_memory_gcodes:
             tmp_file = io.BytesIO()
             filename = None
         else:
-            tmp_file = tempfile.NamedTemporaryFile(mode='wb', dir=paths.DOWNLOAD_FOLDER,
-                delete=False, prefix='3dprinteros-', suffix=suffix)
-            filename = tmp_file.name
+            if self.RESUME_AFTER_RESTART and not self.stream_callback:
+                PartialDownload.remove_stale(self.logger)
+                self.partial = PartialDownload.acquire(self.logger, self.url, self.job_id, suffix)
+            if self.partial:
+                filename = self.partial.path
+                # data without a manifest is not resumable, so it is truncated instead of being overwritten in place
+                tmp_file = open(filename, 'r+b' if self.partial.size and os.path.isfile(filename) else 'wb')
+            else:
+                tmp_file = tempfile.NamedTemporaryFile(mode='wb', dir=paths.DOWNLOAD_FOLDER,
+                    delete=False, prefix='3dprinteros-', suffix=suffix)
+                filename = tmp_file.name
         retry = 0
         compression = None
+        session = dns_cache.requests_session()
+        # range support is probed only for files, which are expected to be big enough for segments, since the probe
+        # costs a round trip. When size is not known in advance, it is taken from the first response.
+        expected_size = self.get_expected_size()
+        segmentable = self.SEGMENTS > 1 and bool(filename) and not self.stream_callback
+        if segmentable and expected_size >= self.SEGMENTED_MIN_SIZE:
+            segmentable = False
+            size = self.probe_range_support(session)
+            if self.partial and size and (size != self.partial.size or not self.partial.is_valid_for(self.validators)):
+                self.partial.reset(tmp_file)
+            if size >= self.SEGMENTED_MIN_SIZE:
+                result, tmp_file = self.download_in_segments(filename, size, tmp_file)
+                if result:
+                    session.close()
+                    return self.complete_partial(filename)
+                if result is False:
+                    retry = self.MAX_RETRIES
+        elif expected_size:
+            segmentable = False
+        if self.partial and self.partial.get_resume_offset() and not tmp_file.closed:
+            self.resume_partial(tmp_file)
         while retry < self.MAX_RETRIES and not self.parent.stop_flag and not self.cancel_flag:
             if retry:
                 self.logger.warning("Download retry/resume N" + str(retry))
             self.logger.info("Connecting to server...")
             headers = { 'Accept-Encoding': 'identity, deflate, compress, gzip',
                      'Accept': '*/*', 'User-Agent': 'python-requests/{requests.__version__}'}
+            if self.downloaded_bytes and compression:
+                # offsets in a compressed stream could not be resumed, but data written so far is a prefix of the uncompressed file
+                self.logger.info(f'Download was compressed with {compression}. Resuming it without compression')
+                headers['Accept-Encoding'] = 'identity'
+                self.downloaded_bytes = self.written_bytes
+                self.download_size = 0
             if self.downloaded_bytes:
-                if compression:
-                    self.downloaded_bytes = 0
-                    self.percent = 0.0
-                    self.written_bytes = 0
-                    tmp_file.truncate(0)
-                    self.logger.info(f'Unable to resume with compression {compression}. Restarting download')
-                else:
-                    headers['Range'] = 'bytes=%d-' % self.downloaded_bytes
-                    self.logger.info(f'Resuming download from {self.downloaded_bytes}')
+                headers['Range'] = 'bytes=%d-' % self.downloaded_bytes
+                validator = self.validators.get('ETag') or self.validators.get('Last-Modified')
+                if validator:
+                    headers['If-Range'] = validator
+                self.logger.info(f'Resuming download from {self.downloaded_bytes}')
             try:
-                response = requests.get(self.url, headers = headers, stream=True, timeout = self.CONNECTION_TIMEOUT, verify=certifi.where())
+                response = session.get(self.url, headers = headers, stream=True, timeout = self.CONNECTION_TIMEOUT, verify=certifi.where())
             except Exception as e:
                 response = None
                 self.parent.register_error(65, "Unable to open download link: " + str(e), is_blocking=False)
@@ -123,52 +220,402 @@ class Downloader(threading.Thread):
                 if not response.ok:
                     self.parent.register_error(68, f'Download error: HTTP status not OK, but {response.status_code}', is_blocking=False)
                 else:
+                    if 'Range' in headers and (response.status_code != 206 or not self.is_expected_content_range(response) \
+                                               or response.headers.get('Content-Encoding')):
+                        # server ignored the range or the file has changed, so the data received before is useless
+                        if self.stream_started:
+                            self.parent.register_error(66, 'Download error: unable to resume download after streaming to the sender started', is_blocking=True)
+                            break
+                        self.logger.info('Server did not resume the download. Restarting it')
+                        self.download_size = 0
+                        self.downloaded_bytes = 0
+                        self.written_bytes = 0
+                        self.percent = 0.0
+                        self.reset_hashes()
+                        tmp_file.seek(0)
+                        tmp_file.truncate(0)
+                        if self.partial:
+                            self.partial.reset()
+                        if response.status_code == 206:
+                            continue # not the whole file, so it has to be requested again
                     if not self.download_size:
                         self.download_size = int(response.headers.get('content-length', 0))
+                        if response.status_code == 206:
+                            self.download_size += self.downloaded_bytes
                         self.logger.info(f"Starting download of {self.download_size}B")
                         compression = response.headers.get('Content-Encoding')
                         if compression:
                             self.logger.info("Download compression encoding: " + str(compression))
-                    self.downloaded_bytes += self.download_chunks(response, tmp_file)
+                        if segmentable and self.download_size >= self.SEGMENTED_MIN_SIZE and not compression \
+                                and response.status_code == 200 and response.headers.get('Accept-Ranges') == 'bytes':
+                            segmentable = False
+                            self.update_validators(response)
+                            response.close()
+                            result, tmp_file = self.download_in_segments(filename, self.download_size, tmp_file)
+                            if result:
+                                session.close()
+                                return self.complete_partial(filename)
+                            if result is False:
+                                break
+                            continue
+                        segmentable = False
+                        if self.partial:
+                            self.update_validators(response)
+                            self.partial.start(self.download_size, self.validators, resumable=not compression)
+                            if not self.downloaded_bytes:
+                                tmp_file.truncate(0) # no bytes of a previous attempt should stay past the new end
+                    self.downloaded_bytes += self.download_chunks(response, tmp_file, filename)
                     self.logger.info(f"Downloaded {self.downloaded_bytes}B")
                     if self.downloaded_bytes == self.download_size:
                         self.logger.info(f'Success. Downloaded: {self.download_size}B. Wrote: {self.written_bytes}B')
+                        if self.stream_callback and not self.stream_started:
+                            tmp_file.flush()
+                            self.start_stream(filename)
                         if self.in_memory_gcodes:
                             tmp_file.seek(0)
                             ret = tmp_file.read()
                         else:
                             ret = filename
                         tmp_file.close()
-                        return ret
+                        session.close()
+                        return self.complete_partial(ret)
                     elif self.downloaded_bytes > self.download_size:
-                        self.parent.register_error(66, "Download error: data is corrupted. Expected: {self.download_size}B. Downloaded: {self.download_size}B. Wrote: {self.written_bytes}B", is_blocking=False)
+                        self.parent.register_error(66, f"Download error: data is corrupted. Expected: {self.download_size}B. Downloaded: {self.downloaded_bytes}B. Wrote: {self.written_bytes}B", is_blocking=False)
                         break
-                    else: 
-                        self.parent.register_error(66, "Download error: connection was lost. Expected: {self.download_size}B. Downloaded: {self.download_size}B. Wrote: {self.written_bytes}B", is_blocking=False)
+                    elif self.stream_stopped:
+                        break
+                    else:
+                        self.parent.register_error(66, f"Download error: connection was lost. Expected: {self.download_size}B. Downloaded: {self.downloaded_bytes}B. Wrote: {self.written_bytes}B", is_blocking=False)
             finally:
                 if response:
                     response.close()
                 retry += 1
                 time.sleep(1)
-        self.parent.register_error(66, 'Download error: unable to complete download', is_blocking=True)
+        session.close()
+        if self.stream_stopped:
+            self.logger.info('Download canceled, since the print of streamed gcodes stopped')
+        else:
+            self.parent.register_error(66, 'Download error: unable to complete download', is_blocking=True)
         try:
             tmp_file.close()
         except:
             pass
+        if self.partial and self.partial.resumable and not self.cancel_flag:
+            self.logger.info(f'Keeping {self.written_bytes}B of partial download to resume it later')
+            self.partial.save()
+            return
         try:
             if filename:
                 os.remove(filename)
         except:
             pass
+        if self.partial:
+            self.partial.remove()
+
+    def update_validators(self, response):
+        self.validators = {name: response.headers[name] for name in ('ETag', 'Last-Modified') if response.headers.get(name)}
+
+    def is_expected_content_range(self, response):
+        # bytes <first>-<last>/<total>
+        try:
+            first_last, total = response.headers.get('Content-Range', '').split(' ', 1)[-1].split('/')
+            first = int(first_last.split('-')[0])
+        except ValueError:
+            return False
+        return first == self.downloaded_bytes and (not self.download_size or total == str(self.download_size))
+
+    def resume_partial(self, tmp_file):
+        offset = self.partial.get_resume_offset()
+        self.download_size = self.partial.size
+        self.validators = dict(self.partial.validators)
+        tmp_file.seek(0)
+        while self.hashed_bytes < offset:
+            self.update_hashes(tmp_file.read(min(self.DOWNLOAD_CHUNK_SIZE, offset - self.hashed_bytes)))
+        tmp_file.seek(offset)
+        tmp_file.truncate()
+        self.downloaded_bytes = self.written_bytes = offset
+        self.percent = round(offset / self.download_size * 100, 2)
+        self.logger.info(f'Found {offset}B of {self.download_size}B downloaded before restart')
+
+    def complete_partial(self, downloaded):
+        # moves finished download out of partial downloads folder, where it could be found after restart
+        if not self.partial:
+            return downloaded
+        fd, filename = tempfile.mkstemp(dir=paths.DOWNLOAD_FOLDER, prefix='3dprinteros-', suffix=self.partial.suffix)
+        os.close(fd)
+        try:
+            os.replace(downloaded, filename)
+        except OSError as e:
+            self.logger.warning('Unable to move finished download: ' + str(e))
+            os.remove(filename)
+            return downloaded
+        self.partial.remove()
+        return filename
+
+    def load_from_cache(self, suffix):
+        cached_path = self.cache.lookup(self.cache_keys)
+        if cached_path:
+            try:
+                if self.in_memory_gcodes:
+                    with open(cached_path, 'rb') as f:
+                        downloaded = f.read()
+                else:
+                    downloaded = self.cache.extract(cached_path, suffix)
+            except OSError as e:
+                self.logger.warning('Unable to load file from download cache: ' + str(e))
+            else:
+                if self.expected_hashes and not self.verify_cached(cached_path, downloaded):
+                    self.logger.info('Downloading the file instead of the broken download cache entry')
+                    return None
+                if self.in_memory_gcodes:
+                    self.download_size = len(downloaded)
+                else:
+                    self.download_size = os.path.getsize(downloaded)
+                self.downloaded_bytes = self.written_bytes = self.download_size
+                self.percent = 100
+                self.cache_hit = True
+                self.hashes = {'sha256': os.path.basename(cached_path)}
+                crc32 = self.cache.get_entry(self.hashes['sha256']).get('crc32')
+                if crc32 is not None:
+                    self.hashes['crc32'] = crc32
+                self.logger.info(f'Loaded {self.download_size}B from download cache. Skipping download')
+                return downloaded
+
+    def store_in_cache(self, downloaded):
+        if self.in_memory_gcodes:
+            self.cache.store_bytes(downloaded, self.cache_keys, self.hashes.get('sha256'), self.hashes.get('crc32'))
+        else:
+            self.cache.store(downloaded, self.cache_keys, self.hashes.get('sha256'), self.hashes.get('crc32'))
+
+    def update_hashes(self, data):
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.sha256.update(data)
+        self.hashed_bytes += len(data)
+
+    def reset_hashes(self):
+        self.crc32 = 0
+        self.sha256 = hashlib.sha256()
+        self.hashed_bytes = 0
+
+    def hash_downloaded(self, downloaded):
+        # hashes are mostly calculated on the fly, only segments downloaded out of order are read back
+        if self.in_memory_gcodes:
+            self.update_hashes(downloaded[self.hashed_bytes:])
+        else:
+            with open(downloaded, 'rb') as f:
+                f.seek(self.hashed_bytes)
+                while True:
+                    data = f.read(self.DOWNLOAD_CHUNK_SIZE)
+                    if not data:
+                        break
+                    self.update_hashes(data)
+        self.hashes = {'crc32': self.crc32, 'sha256': self.sha256.hexdigest()}
+
+    def get_hash_mismatch(self):
+        # returns name and expected value of the first hash, that does not match the job, or None
+        for name, expected in self.expected_hashes.items():
+            if name == 'crc32':
+                try:
+                    matches = (expected if isinstance(expected, int) else int(str(expected), 16)) == self.hashes['crc32']
+                except ValueError:
+                    self.logger.warning(f'Invalid expected crc32: {expected}. Skipping its check')
+                    continue
+            else:
+                matches = str(expected).lower() == self.hashes['sha256']
+            if not matches:
+                return name, expected
 
-    def download_chunks(self, response, tmp_file):
+    def remove_downloaded(self, downloaded):
+        if not self.in_memory_gcodes:
+            try:
+                os.remove(downloaded)
+            except OSError:
+                pass
+
+    def check_integrity(self, downloaded):
+        try:
+            self.hash_downloaded(downloaded)
+        except OSError as e:
+            self.parent.register_error(66, 'Download error: unable to read downloaded file: ' + str(e), is_blocking=True)
+            return None
+        self.logger.info(f"Downloaded file crc32: {self.hashes['crc32']:#010x} sha256: {self.hashes['sha256']}")
+        mismatch = self.get_hash_mismatch()
+        if mismatch:
+            self.parent.register_error(66, f'Download error: {mismatch[0]} mismatch. Expected: {mismatch[1]}', is_blocking=True)
+            self.remove_downloaded(downloaded)
+            return None
+        if self.expected_hashes:
+            self.logger.info('Downloaded file checksum verified')
+        return downloaded
+
+    def verify_cached(self, cached_path, downloaded):
+        # cached file could be damaged on disk or stored under a reused key, so it is checked against the job's hashes
+        try:
+            self.hash_downloaded(downloaded)
+        except OSError as e:
+            self.logger.warning('Unable to read file from download cache: ' + str(e))
+            mismatch = True
+        else:
+            mismatch = self.get_hash_mismatch()
+            if mismatch:
+                self.logger.warning(f'Download cache entry {os.path.basename(cached_path)} {mismatch[0]} mismatch. Expected: {mismatch[1]}')
+        self.reset_hashes()
+        if mismatch:
+            self.hashes = {}
+            self.remove_downloaded(downloaded)
+            self.cache.remove_entry(os.path.basename(cached_path))
+            self.cache.save_index()
+            return False
+        return True
+
+    def pass_hashes_to_sender(self, downloaded):
+        set_file_hashes = getattr(getattr(self.parent, 'sender', None), 'set_file_hashes', None)
+        if set_file_hashes and not self.in_memory_gcodes:
+            set_file_hashes(downloaded, self.hashes)
+
+    def get_expected_size(self):
+        if self.partial and self.partial.size:
+            return self.partial.size
+        return self.announced_size
+
+    def download_in_segments(self, filename, size, tmp_file):
+        # returns result of download_segmented and file to continue single stream download in, if server ignores ranges
+        tmp_file.close()
+        if self.partial and not self.partial.size:
+            self.partial.start(size, self.validators)
+        result = self.download_segmented(filename, size)
+        if result is None:
+            self.logger.info('Server does not support range requests. Falling back to single stream download')
+            self.download_size = 0
+            self.downloaded_bytes = 0
+            self.written_bytes = 0
+            self.percent = 0.0
+            self.reset_hashes()
+            tmp_file = open(filename, 'wb')
+            if self.partial:
+                self.partial.reset()
+        return result, tmp_file
+
+    def probe_range_support(self, session):
+        # returns size of the file if server accepts range requests on it, otherwise 0
+        headers = {'Range': 'bytes=0-0', 'Accept-Encoding': 'identity', 'Accept': '*/*'}
+        try:
+            response = session.get(self.url, headers=headers, stream=True, timeout=self.CONNECTION_TIMEOUT, verify=certifi.where())
+        except Exception as e:
+            self.logger.info('Range support probe failed: ' + str(e))
+            return 0
+        try:
+            self.update_validators(response)
+            if response.status_code == 206:
+                total = response.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+                if total.isdigit():
+                    return int(total)
+        finally:
+            response.close()
+        return 0
+
+    def download_segmented(self, filename, size):
+        # returns True on success, None if server ignores ranges and False on error
+        self.download_size = size
+        segment_size = max(-(-size // self.SEGMENTS), self.DOWNLOAD_CHUNK_SIZE)
+        self.logger.info(f'Starting segmented download of {size}B in segments of {segment_size}B')
+        try:
+            f = open(filename, 'r+b')
+            f.truncate(size)
+        except OSError as e:
+            self.parent.register_error(66, 'Download error: unable to allocate file: ' + str(e), is_blocking=True)
+            return False
+        with f:
+            writer = DownloadWriter(self, f)
+            writer.preallocate(size)
+            writer.start()
+            segments = [SegmentDownloader(self, writer, start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+            if self.partial:
+                for segment in segments:
+                    segment.position = segment.written = self.partial.get_received_end(segment.first, segment.end)
+                received = sum(segment.position - segment.first for segment in segments)
+                if received:
+                    self.logger.info(f'Found {received}B of {size}B downloaded before restart')
+                    self.add_progress(received)
+                    self.add_written(received)
+            for segment in segments:
+                segment.start()
+            prev_percent = 0
+            while any(segment.is_alive() for segment in segments):
+                time.sleep(self.PROGRESS_LOG_PERIOD)
+                if self.percent > prev_percent:
+                    self.logger.info(f'File downloading: {self.percent}%')
+                    prev_percent = self.percent
+                if any(segment.range_unsupported for segment in segments):
+                    self.cancel_segments = True
+                if self.partial:
+                    self.partial.update([[segment.first, segment.written] for segment in segments], force=True)
+            for segment in segments:
+                segment.join()
+            writer.close()
+        if self.partial:
+            self.partial.update([[segment.first, segment.written] for segment in segments], force=True)
+        if any(segment.range_unsupported for segment in segments):
+            return None
+        if not writer.error and all(segment.is_finished() for segment in segments):
+            self.percent = 100
+            self.logger.info(f'Success. Downloaded: {self.download_size}B. Wrote: {self.written_bytes}B')
+            return True
+        if not self.cancel_flag and not self.parent.stop_flag:
+            errors = [segment.error for segment in segments if segment.error]
+            self.parent.register_error(66, f'Download error: segmented download failed: {errors}', is_blocking=False)
+        return False
+
+    def add_progress(self, length):
+        with self.progress_lock:
+            self.downloaded_bytes += length
+            if self.download_size:
+                self.percent = round(min(self.downloaded_bytes / self.download_size, 1.0) * 100, 2)
+
+    def add_written(self, length):
+        with self.progress_condition:
+            self.written_bytes += length
+            self.progress_condition.notify_all()
+
+    def chunk_written(self, data):
+        # called by writer in order of the file, after the data is written
+        self.update_hashes(data)
+        self.add_written(len(data))
+        if self.partial:
+            self.partial.update([[0, self.written_bytes]])
+
+    def is_stopped(self):
+        return self.cancel_flag or self.parent.stop_flag or self.cancel_segments
+
+    def start_stream(self, filename):
+        try:
+            compression = gcodes_decompressor.detect_file_compression(filename)
+        except OSError as e:
+            compression = str(e)
+        if compression:
+            # compressed and binary gcodes could not be cleaned by lines, so they are printed after the download
+            self.logger.info(f'Not streaming gcodes, since the file is not plain gcodes: {compression}')
+            self.stream_callback = None
+            return
+        self.logger.info(f'Starting gcodes streaming to the sender after {self.written_bytes}B')
+        self.stream_started = True
+        stream = DownloadStream(self, filename)
+        threading.Thread(target=self.stream_callback, args=(stream,), name="GcodesStream", daemon=True).start()
+
+    def download_chunks(self, response, tmp_file, filename=None):
         downloaded_bytes = 0
         prev_percent = 0
+        offset = written_before = self.written_bytes
+        compression = response.headers.get('Content-Encoding')
+        writer = DownloadWriter(self, tmp_file)
+        if not compression:
+            writer.preallocate(self.download_size)
+        writer.start()
         try:
             for chunk in response.iter_content(self.DOWNLOAD_CHUNK_SIZE):
                 if self.cancel_flag or self.parent.stop_flag:
                     self.logger.info('Download canceled')
-                    return downloaded_bytes
+                    break
                 downloaded_bytes = response.raw.tell()
                 if self.download_size:
                     self.percent = round(min((downloaded_bytes + self.downloaded_bytes) / self.download_size, 1.0) * 100, 2)
@@ -177,17 +624,447 @@ class Downloader(threading.Thread):
                         prev_percent = self.percent
                 else:
                     self.logger.info(f"File downloading: {(downloaded_bytes + self.downloaded_bytes) // 1024}kB")
-                tmp_file.write(chunk)
-                self.written_bytes += len(chunk)
+                if not writer.write(offset, chunk, self.chunk_written, self.is_stopped):
+                    break
+                offset += len(chunk)
+                bandwidth.acquire(bandwidth.DOWNLOAD, len(chunk), self.is_stopped)
+                if self.stream_callback and not self.stream_started and self.written_bytes >= self.STREAMING_PREFIX_SIZE:
+                    self.start_stream(filename)
+            else:
+                self.percent = 100
         except Exception as e:
             self.parent.register_error(69, 'Download error: chunk error: ' + str(e), is_blocking=False)
-            return downloaded_bytes
-        else:
-            self.percent = 100
-            return downloaded_bytes
+        finally:
+            writer.close()
+        if writer.error:
+            self.parent.register_error(69, 'Download error: unable to write file: ' + str(writer.error), is_blocking=False)
+            if compression:
+                return 0
+        if not compression:
+            # only the data, that reached the file, counts as downloaded, so a retry resumes right after it
+            return self.written_bytes - written_before
+        return downloaded_bytes
 
     def cancel(self):
-        self.cancel_flag = True
+        with self.progress_condition:
+            self.cancel_flag = True
+            self.progress_condition.notify_all()
 
     def get_percent(self):
         return self.percent
+
+
+class PartialDownload:
+    # download progress persisted next to its data, to resume the download after restart of the client
+
+    MANIFEST_SUFFIX = '.json'
+    MAX_AGE = config.get_settings().get('downloader', {}).get('partial_max_age_hours', 72) * 3600
+    SAVE_PERIOD = 1
+    active_paths = set()
+    active_paths_lock = threading.Lock()
+
+    def __init__(self, logger, url, job_id, suffix):
+        self.logger = logger.getChild(self.__class__.__name__)
+        self.url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        self.job_id = job_id
+        self.suffix = suffix
+        # links could be signed anew on each resend of a job, so job id is a better key when cloud provides it
+        if job_id:
+            name = hashlib.sha256(f'job:{job_id}'.encode('utf-8')).hexdigest()[:32]
+        else:
+            name = self.url_hash[:32]
+        self.path = os.path.join(paths.PARTIAL_DOWNLOADS_FOLDER, name + suffix)
+        self.manifest_path = os.path.join(paths.PARTIAL_DOWNLOADS_FOLDER, name + self.MANIFEST_SUFFIX)
+        self.size = 0
+        self.validators = {}
+        self.ranges = [] # [first, end) pairs of received bytes
+        self.resumable = True
+        self.last_save_time = 0
+        self.load()
+
+    @classmethod
+    def acquire(cls, logger, url, job_id, suffix):
+        # returns None if the same file is already downloading by another printer
+        partial = cls(logger, url, job_id, suffix)
+        with cls.active_paths_lock:
+            if partial.path in cls.active_paths:
+                return None
+            cls.active_paths.add(partial.path)
+        return partial
+
+    def release(self):
+        with self.active_paths_lock:
+            self.active_paths.discard(self.path)
+
+    @classmethod
+    def remove_stale(cls, logger):
+        try:
+            names = os.listdir(paths.PARTIAL_DOWNLOADS_FOLDER)
+        except OSError:
+            return
+        with cls.active_paths_lock:
+            active_paths = set(cls.active_paths)
+        now = time.time()
+        for name in names:
+            path = os.path.join(paths.PARTIAL_DOWNLOADS_FOLDER, name)
+            if os.path.splitext(path)[0] in [os.path.splitext(active_path)[0] for active_path in active_paths]:
+                continue
+            try:
+                if now - os.path.getmtime(path) > cls.MAX_AGE:
+                    logger.info('Removing stale partial download ' + name)
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def load(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if not os.path.isfile(self.path):
+                raise ValueError('no data file')
+            self.size = int(manifest['size'])
+            self.validators = dict(manifest.get('validators', {}))
+            self.ranges = [[int(first), int(end)] for first, end in manifest['ranges']]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.warning('Dropping broken partial download manifest: ' + str(e))
+            self.reset()
+
+    def save(self):
+        if not self.resumable:
+            return
+        self.last_save_time = time.monotonic()
+        manifest = {'url_hash': self.url_hash, 'job_id': self.job_id, 'size': self.size,
+                    'validators': self.validators, 'ranges': self.ranges, 'updated': time.time()}
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=paths.PARTIAL_DOWNLOADS_FOLDER, delete=False, suffix='.tmp') as f:
+                json.dump(manifest, f)
+            os.replace(f.name, self.manifest_path)
+        except OSError as e:
+            self.logger.warning('Unable to save partial download manifest: ' + str(e))
+
+    def start(self, size, validators, resumable=True):
+        self.size = size
+        self.validators = dict(validators)
+        self.ranges = []
+        self.resumable = resumable and bool(size)
+        if self.resumable:
+            self.save()
+        else:
+            self.remove_manifest()
+
+    def update(self, ranges, data_file=None, force=False):
+        self.ranges = ranges
+        if force or time.monotonic() - self.last_save_time >= self.SAVE_PERIOD:
+            if data_file:
+                data_file.flush() # manifest should never claim data, that is still in buffers
+            self.save()
+
+    def reset(self, data_file=None):
+        self.size = 0
+        self.validators = {}
+        self.ranges = []
+        if data_file:
+            data_file.seek(0)
+            data_file.truncate(0)
+        self.remove_manifest()
+
+    def is_valid_for(self, validators):
+        return not self.validators or not validators or self.validators == validators
+
+    def get_resume_offset(self):
+        if self.size and self.ranges and self.ranges[0][0] == 0:
+            return min(self.ranges[0][1], self.size)
+        return 0
+
+    def get_received_end(self, first, end):
+        for range_first, range_end in self.ranges:
+            if range_first == first:
+                return min(range_end, end + 1)
+        return first
+
+    def remove_manifest(self):
+        try:
+            os.remove(self.manifest_path)
+        except OSError:
+            pass
+
+    def remove(self):
+        self.remove_manifest()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class DownloadWriter(threading.Thread):
+    # write-behind stage between network and file, so slow storage does not stall socket reads.
+    # Callbacks are called only after their data is written, so progress, streaming and partial download manifest
+    # never count data, that is still queued.
+
+    WRITE_BEHIND = config.get_settings().get('downloader', {}).get('write_behind', True)
+    QUEUE_SIZE = config.get_settings().get('downloader', {}).get('write_queue_kb', 4096) * 1024
+    PREALLOCATE = config.get_settings().get('downloader', {}).get('preallocate', True)
+    FSYNC = config.get_settings().get('downloader', {}).get('fsync', False)
+    MAX_WRITE_SIZE = 2*1024*1024
+    PUT_TIMEOUT = 1
+
+    def __init__(self, downloader, data_file):
+        self.logger = downloader.logger.getChild(self.__class__.__name__)
+        self.file = data_file
+        self.queue = queue.Queue(max(self.QUEUE_SIZE // Downloader.DOWNLOAD_CHUNK_SIZE, 1))
+        self.pending = []
+        self.write_lock = threading.Lock()
+        self.error = None
+        self.closed = False
+        threading.Thread.__init__(self, name="DownloadWriter", daemon=True)
+
+    def start(self):
+        if self.WRITE_BEHIND:
+            threading.Thread.start(self)
+
+    def preallocate(self, size):
+        # reserves the whole file at once, instead of growing it chunk by chunk into fragments
+        if not self.PREALLOCATE or not size or not hasattr(os, 'posix_fallocate'):
+            return
+        try:
+            self.file.flush()
+            os.posix_fallocate(self.file.fileno(), 0, size)
+        except (OSError, ValueError) as e: # in memory files have no fileno
+            self.logger.debug('Unable to preallocate download file: ' + str(e))
+
+    def write(self, offset, data, callback=None, stop_check=None):
+        # returns False on write error or if stop_check became true while the queue was full
+        if self.error:
+            return False
+        item = (offset, data, callback)
+        if not self.is_alive():
+            try:
+                self.write_items([item])
+            except OSError as e:
+                self.logger.warning('Unable to write downloaded data: ' + str(e))
+                self.error = e
+                return False
+            return True
+        while True:
+            try:
+                self.queue.put(item, timeout=self.PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                if self.error or (stop_check and stop_check()):
+                    return False
+
+    def write_items(self, items):
+        with self.write_lock:
+            self.file.seek(items[0][0])
+            if len(items) == 1:
+                self.file.write(items[0][1])
+            else:
+                self.file.write(b"".join(item[1] for item in items))
+            self.file.flush()
+        for _, data, callback in items:
+            if callback:
+                callback(data)
+
+    def get_items(self):
+        # joins queued contiguous chunks into one write. The slower the storage, the more chunks are waiting
+        # and the larger the writes get, while on fast storage chunks are written as soon as they arrive.
+        if self.pending:
+            item = self.pending.pop()
+        else:
+            item = self.queue.get()
+        if item is None:
+            return []
+        items = [item]
+        size = len(item[1])
+        while size < self.MAX_WRITE_SIZE:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None or item[0] != items[-1][0] + len(items[-1][1]):
+                self.pending.append(item)
+                break
+            items.append(item)
+            size += len(item[1])
+        return items
+
+    @log.log_exception
+    def run(self):
+        while True:
+            items = self.get_items()
+            if not items:
+                break
+            if not self.error:
+                try:
+                    self.write_items(items)
+                except OSError as e:
+                    self.logger.warning('Unable to write downloaded data: ' + str(e))
+                    self.error = e
+
+    def close(self):
+        # waits until all queued data is written. Does not close the file itself.
+        if self.closed:
+            return
+        self.closed = True
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        if self.FSYNC and not self.error:
+            try:
+                os.fsync(self.file.fileno())
+            except (OSError, ValueError) as e:
+                self.logger.warning('Unable to sync download file: ' + str(e))
+
+
+class DownloadStreamError(IOError):
+    pass
+
+
+class DownloadStream:
+    # file-like reader of a file that is still being downloaded. Blocks until downloader writes enough data.
+
+    READ_CHUNK = 64*1024
+
+    def __init__(self, downloader, filename):
+        self.downloader = downloader
+        self.name = filename
+        self.file = open(filename, 'rb')
+        self.position = 0
+
+    def wait_for_data(self):
+        downloader = self.downloader
+        with downloader.progress_condition:
+            while downloader.written_bytes <= self.position:
+                if downloader.finished:
+                    return False
+                if downloader.failed or downloader.cancel_flag or downloader.parent.stop_flag:
+                    raise DownloadStreamError('Download of streamed file failed or was canceled')
+                downloader.progress_condition.wait(1)
+            return True
+
+    def read(self, size=-1):
+        if not self.wait_for_data():
+            return b""
+        available = self.downloader.written_bytes - self.position
+        if size is None or size < 0 or size > available:
+            size = available
+        data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+    def __iter__(self):
+        partline = b""
+        while True:
+            data = self.read(self.READ_CHUNK)
+            if not data:
+                if partline:
+                    yield partline
+                return
+            lines = (partline + data).split(b"\n")
+            partline = lines.pop()
+            yield from lines
+
+    def get_percent(self):
+        if self.downloader.download_size:
+            return round(min(self.position / self.downloader.download_size, 1.0) * 100, 2)
+        return 0.0
+
+    def close(self):
+        # consumer, which stops before the end of the file, does not need the rest of it
+        self.file.close()
+        downloader = self.downloader
+        with downloader.progress_condition:
+            if not downloader.finished and not downloader.failed and not downloader.cancel_flag:
+                downloader.logger.info('Gcodes stream is closed before the end of download. Canceling download')
+                downloader.stream_stopped = True
+                downloader.cancel_flag = True
+                downloader.progress_condition.notify_all()
+
+    def remove_file(self):
+        # downloader is waited for, since it could still be writing or checking the file
+        if self.downloader is not threading.current_thread():
+            self.downloader.join()
+        try:
+            os.remove(self.name)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class SegmentDownloader(threading.Thread):
+
+    def __init__(self, downloader, writer, start, end):
+        self.downloader = downloader
+        self.logger = downloader.logger.getChild(self.__class__.__name__)
+        self.writer = writer
+        self.first = start
+        self.position = start # end of received data
+        self.written = start # end of data written to the file
+        self.end = end # inclusive, as in Range header
+        self.hash_inline = False
+        self.range_unsupported = False
+        self.error = None
+        threading.Thread.__init__(self, name="SegmentDownloader", daemon=True)
+
+    def is_finished(self):
+        return self.position > self.end
+
+    def chunk_written(self, data):
+        if self.hash_inline:
+            self.downloader.update_hashes(data)
+        self.written += len(data)
+        self.downloader.add_written(len(data))
+
+    @log.log_exception
+    def run(self):
+        session = dns_cache.requests_session()
+        retry = 0
+        # the first segment is contiguous from the start of the file, so it could be hashed as it goes
+        self.hash_inline = not self.position
+        try:
+            while not self.is_finished() and retry < self.downloader.MAX_RETRIES and not self.downloader.is_stopped():
+                if retry:
+                    self.logger.warning(f'Segment retry N{retry} from {self.position}')
+                    time.sleep(retry)
+                retry += 1
+                headers = {'Range': f'bytes={self.position}-{self.end}', 'Accept-Encoding': 'identity', 'Accept': '*/*'}
+                try:
+                    response = session.get(self.downloader.url, headers=headers, stream=True,
+                                           timeout=self.downloader.CONNECTION_TIMEOUT, verify=certifi.where())
+                except Exception as e:
+                    self.error = str(e)
+                    continue
+                try:
+                    if response.status_code == 200:
+                        self.range_unsupported = True
+                        return
+                    if response.status_code != 206:
+                        self.error = f'HTTP status {response.status_code}'
+                        continue
+                    for chunk in response.iter_content(self.downloader.DOWNLOAD_CHUNK_SIZE):
+                        if self.downloader.is_stopped():
+                            return
+                        chunk = chunk[:self.end + 1 - self.position]
+                        if not self.writer.write(self.position, chunk, self.chunk_written, self.downloader.is_stopped):
+                            if self.writer.error:
+                                self.error = 'write error: ' + str(self.writer.error)
+                            return
+                        self.position += len(chunk)
+                        self.downloader.add_progress(len(chunk))
+                        bandwidth.acquire(bandwidth.DOWNLOAD, len(chunk), self.downloader.is_stopped)
+                        retry = 0
+                        if self.is_finished():
+                            break
+                except Exception as e:
+                    self.error = str(e)
+                finally:
+                    response.close()
+        finally:
+            session.close()
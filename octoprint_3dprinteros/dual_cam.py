@@ -25,6 +25,7 @@ if path not in sys.path:
     sys.path.insert(0, path)
 
 
+import bandwidth
 import config
 import http_client
 import log
@@ -125,6 +126,8 @@ class Camera:
     IMAGE_EXT = ".jpg"
     SAME_IMAGE = 'S'
     JOIN_TIMEOUT = 10
+    BINARY_JPEG_PROBE_ATTEMPTS = 3
+    BINARY_JPEG_UNSUPPORTED_STATUSES = (400, 404, 405, 415, 501)
 
     DEBUG = config.get_settings()["camera"]["logging"]
     SAVE_IMG_PATH = ""
@@ -163,6 +166,7 @@ class Camera:
         self.offline_mode = bool("--offline" in sys.argv) or config.get_settings().get('offline_mode')
         self.hardware_resize = config.get_settings()["camera"]["hardware_resize"]
         self.send_as_imagejpeg = config.get_settings()["camera"]["binary_jpeg"]
+        self.binary_jpeg_confirmed = False
         self.allow_net_input = config.get_settings()["camera"]["network_input"]
         self.allow_usb_input = config.get_settings()["camera"]["usb_input"]
         self.reconnect = config.get_settings()["camera"]["reconnect"]
@@ -229,6 +233,9 @@ class Camera:
                     sys.exit(1)
             if mac:
                 self.http_client.host_id = mac #we need to use MAC from client to ensure that it's not changed on camera restart
+            if self.send_as_imagejpeg and not self.http_client.CAMERA_IMAGEJPEG_SUPPORTED:
+                self.logger.info("Camera: binary jpeg upload is not supported by current protocol. Using base64")
+                self.send_as_imagejpeg = False
 
     def start(self):
         self.search_cameras()
@@ -454,14 +461,15 @@ class Camera:
             self.last_sent_frame_time[number] = time.monotonic()
         send_number = self.get_camera_number_for_cloud()
         message = self.token, send_number, "Camera" + str(send_number)
+        if frame != Camera.SAME_IMAGE:
+            bandwidth.acquire(bandwidth.CAMERA, len(frame), lambda: self.stop_flag)
         #self.logger.debug("Camera %d sending frame to server..." % send_number)
         if self.send_as_imagejpeg:
-            if frame == Camera.SAME_IMAGE:
-                frame == ""
             answer = self.pack_and_send_as_imagejpeg(message, frame)
         else:
             if frame != Camera.SAME_IMAGE:
-                frame = base64.b64encode(frame).decode()
+                frame = base64.b64encode(frame)
+                self.http_client.bytes_copied += len(frame)
             answer = self.pack_and_send(message, frame)
         if type(answer) != dict:
             self.logger.debug("Camera %d can't send frame to server - HTTP error" % send_number)
@@ -474,6 +482,7 @@ class Camera:
                     self.logger.debug("Frame: 'S'")
                 else:
                     self.logger.debug("Frame: %dB", len(frame))
+                self.logger.debug("Transfer stats: %s", self.http_client.get_transfer_stats())
 
     def pack_and_send(self, message, frame):
         message = list(message)
@@ -485,7 +494,15 @@ class Camera:
         headers = { "Content-Type": "image/jpeg",
                 "Content-Length": len(frame),
                 "Camera-Properties": package_message }
-        return self.http_client.send(target_url_path, frame, headers)
+        if self.binary_jpeg_confirmed:
+            return self.http_client.send(target_url_path, frame, headers)
+        answer = self.http_client.send(target_url_path, frame, headers, attempts=self.BINARY_JPEG_PROBE_ATTEMPTS)
+        if type(answer) == dict:
+            self.binary_jpeg_confirmed = True
+        elif self.http_client.last_status in self.BINARY_JPEG_UNSUPPORTED_STATUSES:
+            self.logger.warning(f"Camera: server rejected binary jpeg upload with {self.http_client.last_status}. Falling back to base64")
+            self.send_as_imagejpeg = False
+        return answer
 
     def main_loop(self):
         while not self.stop_flag:
@@ -0,0 +1,372 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Single pass analysis of gcodes: print time by feedrates and acceleration, layers count, filament usage per tool
+# and bounding box of extrusion. Large files are split in chunks, that are analyzed in parallel by analyze_chunk.
+# A chunk starts with unknown position and feedrate, so moves that depend on them are kept as pending and
+# are analyzed on merge, when the end state of the previous chunk is known. Relative moves from an unknown position
+# keep their sum as a StartOffset, which is resolved on merge too.
+
+import math
+import re
+
+import gcodes_cleaner
+
+DEFAULT_ACCELERATION = 1000 # mm/s2
+DEFAULT_FEEDRATE = 1500 # mm/min
+DEFAULT_FILAMENT_DIAMETER = 1.75 # mm
+LAYER_EPSILON = 0.01 # mm, smaller rise of extrusion height is not counted as a new layer
+
+WORD_RE = re.compile(rb"([A-Z])[ \t]*([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))")
+# commands, which change modes for the rest of the file. Found without full parsing to give chunks their starting modes.
+MODES_RE = re.compile(rb"(?:^|\n)[ \t]*((?:G9[01]|M8[23]|M204|T)[^\n;]*)", re.IGNORECASE)
+STOP_COMMANDS = (b"M400", b"M109", b"M190")
+
+
+def trapezoid_time(distance, speed, entry_speed, exit_speed, acceleration):
+    # time of a move, which accelerates from entry speed to speed and decelerates to exit speed
+    if acceleration <= 0:
+        return distance / speed
+    entry_speed = min(entry_speed, speed)
+    exit_speed = min(exit_speed, speed)
+    accelerate_distance = (speed * speed - entry_speed * entry_speed) / (2 * acceleration)
+    decelerate_distance = (speed * speed - exit_speed * exit_speed) / (2 * acceleration)
+    cruise_distance = distance - accelerate_distance - decelerate_distance
+    if cruise_distance >= 0:
+        return (2 * speed - entry_speed - exit_speed) / acceleration + cruise_distance / speed
+    peak_speed = math.sqrt(acceleration * distance + (entry_speed * entry_speed + exit_speed * exit_speed) / 2)
+    if peak_speed < max(entry_speed, exit_speed):
+        return 2 * distance / (entry_speed + exit_speed)
+    return (2 * peak_speed - entry_speed - exit_speed) / acceleration
+
+
+class StartOffset:
+    # position of an axis, which is offset from its unknown value at the start of a chunk
+
+    __slots__ = ('offset',)
+
+    def __init__(self, offset):
+        self.offset = offset
+
+    def resolve(self, start):
+        if start is None or isinstance(start, StartOffset):
+            return start
+        return start + self.offset
+
+
+def is_known(value):
+    return value is not None and not isinstance(value, StartOffset)
+
+
+def analyze_chunk(chunk, comment_chars, modes, feedrate=DEFAULT_FEEDRATE):
+    # runs in a worker process of the pool. Modes are ones at the start of the chunk.
+    analyzer = GcodesAnalyzer(feedrate=feedrate, chunk=True)
+    analyzer.set_modes(modes)
+    analyzer.analyze(gcodes_cleaner.clean_chunk(chunk, comment_chars))
+    analyzer.finish_move()
+    return analyzer
+
+
+class GcodesAnalyzer:
+
+    STATE_FIELDS = ('x', 'y', 'z', 'e', 'feedrate', 'relative', 'relative_e', 'tool', 'acceleration')
+
+    def __init__(self, acceleration=DEFAULT_ACCELERATION, feedrate=DEFAULT_FEEDRATE, chunk=False):
+        self.relative = False
+        self.relative_e = False
+        self.tool = 0
+        self.acceleration = acceleration
+        self.default_feedrate = feedrate / 60
+        if chunk:
+            # None is a value from the end of the previous chunk, StartOffset is a value relative to it
+            self.x = self.y = self.z = self.e = self.feedrate = None
+            self.pending = [] # lines of moves, that need values of the previous chunk, with the state before them
+        else:
+            self.x = self.y = self.z = self.e = 0.0
+            self.feedrate = self.default_feedrate
+            self.pending = None
+        self.retracted = 0.0
+        self.last_move = None # not yet timed move: distance, speed, entry speed and direction
+        self.time = 0.0
+        self.extruded = {} # tool: filament length
+        self.layer_heights = [] # heights, at which extrusion went above all the previous ones
+        self.bbox = None # min x, min y, min z, max x, max y, max z of extrusion moves
+        self.start_height_extrusion = False # chunk extruded at the height of the end of the previous chunk
+
+    def get_modes(self):
+        return self.relative, self.relative_e, self.tool, self.acceleration
+
+    def set_modes(self, modes):
+        self.relative, self.relative_e, self.tool, self.acceleration = modes
+
+    def get_state(self):
+        return tuple(getattr(self, field) for field in self.STATE_FIELDS)
+
+    def set_state(self, state):
+        for field, value in zip(self.STATE_FIELDS, state):
+            setattr(self, field, value)
+
+    def scan_modes(self, chunk):
+        # updates only the modes by a raw chunk of gcodes, which is much faster than the full analysis
+        for match in MODES_RE.finditer(chunk):
+            words = WORD_RE.findall(match.group(1).upper())
+            if words:
+                self.set_mode(words[0], dict(words[1:]))
+
+    def set_mode(self, command, params):
+        letter, number = command
+        if letter == b"G":
+            if number == b"90":
+                self.relative = self.relative_e = False
+            elif number == b"91":
+                self.relative = self.relative_e = True
+        elif letter == b"M":
+            if number == b"82":
+                self.relative_e = False
+            elif number == b"83":
+                self.relative_e = True
+            elif number == b"204":
+                acceleration = params.get(b"P", params.get(b"S"))
+                if acceleration is not None:
+                    self.acceleration = float(acceleration)
+        elif letter == b"T":
+            self.tool = int(float(number))
+
+    def analyze(self, lines):
+        for line in lines:
+            if line[:1] not in b"GMTgmt":
+                continue
+            words = WORD_RE.findall(line.upper())
+            if not words:
+                continue
+            command = words[0]
+            letter, number = command
+            if letter == b"G":
+                number = number.lstrip(b"0") or b"0"
+                if number in (b"0", b"1"):
+                    self.move(line, dict(words[1:]))
+                elif number in (b"2", b"3"):
+                    self.move(line, dict(words[1:]), clockwise=number == b"2")
+                elif number == b"4":
+                    self.finish_move()
+                    params = dict(words[1:])
+                    self.time += float(params.get(b"P", 0)) / 1000 + float(params.get(b"S", 0))
+                elif number == b"92":
+                    self.set_position(dict(words[1:]))
+                elif number == b"28":
+                    self.finish_move()
+                    self.home(dict(words[1:]))
+                elif number == b"29":
+                    self.finish_move()
+                else:
+                    self.set_mode((letter, number), dict(words[1:]))
+            elif letter + number in STOP_COMMANDS:
+                self.finish_move()
+            else:
+                self.set_mode(command, dict(words[1:]))
+
+    def move_axis(self, position, value, relative):
+        # returns new position and distance along the axis, which is None if it depends on the previous chunk
+        value = float(value)
+        if relative:
+            if position is None:
+                return StartOffset(value), value
+            if isinstance(position, StartOffset):
+                return StartOffset(position.offset + value), value
+            return position + value, value
+        if not is_known(position):
+            return value, None
+        return value, value - position
+
+    def move(self, line, params, clockwise=None):
+        start_x, start_y, start_z, start_e, start_feedrate = self.x, self.y, self.z, self.e, self.feedrate
+        x, y, z, e = start_x, start_y, start_z, start_e
+        dx = dy = dz = de = 0.0
+        value = params.get(b"X")
+        if value is not None:
+            x, dx = self.move_axis(start_x, value, self.relative)
+        value = params.get(b"Y")
+        if value is not None:
+            y, dy = self.move_axis(start_y, value, self.relative)
+        value = params.get(b"Z")
+        if value is not None:
+            z, dz = self.move_axis(start_z, value, self.relative)
+        value = params.get(b"E")
+        if value is not None:
+            e, de = self.move_axis(start_e, value, self.relative_e)
+        value = params.get(b"F")
+        if value is not None:
+            self.feedrate = float(value) / 60 or self.default_feedrate
+        self.x, self.y, self.z, self.e = x, y, z, e
+        if self.pending is not None and (None in (dx, dy, dz, de, self.feedrate)
+                                         or (clockwise is not None or de > 0)
+                                         and (not is_known(start_x) or not is_known(start_y) or isinstance(z, StartOffset))):
+            self.pending.append((line, (start_x, start_y, start_z, start_e, start_feedrate) + self.get_modes()))
+            self.finish_move()
+            return
+        if clockwise is None:
+            distance = math.sqrt(dx * dx + dy * dy + dz * dz)
+        else:
+            distance = self.get_arc_length(start_x, start_y, dx, dy, dz, params, clockwise)
+        if distance > 0:
+            self.plan_move(distance, dx / distance, dy / distance, dz / distance)
+        elif de:
+            self.finish_move()
+            distance = abs(de)
+            self.time += trapezoid_time(distance, self.feedrate, 0.0, 0.0, self.acceleration)
+        if de > 0:
+            restored = min(de, self.retracted)
+            self.retracted -= restored
+            self.extruded[self.tool] = self.extruded.get(self.tool, 0.0) + de - restored
+            if distance > 0:
+                self.add_extrusion(start_x, start_y, x, y, z)
+        elif de < 0:
+            self.retracted -= de
+
+    def get_arc_length(self, start_x, start_y, dx, dy, dz, params, clockwise):
+        radius = params.get(b"R")
+        if radius is not None:
+            radius = float(radius)
+            chord = math.hypot(dx, dy)
+            if not radius:
+                return math.sqrt(chord * chord + dz * dz)
+            angle = 2 * math.asin(min(1.0, chord / abs(2 * radius)))
+            if radius < 0:
+                angle = 2 * math.pi - angle
+            radius = abs(radius)
+        else:
+            center_x = float(params.get(b"I", 0))
+            center_y = float(params.get(b"J", 0))
+            radius = math.hypot(center_x, center_y)
+            start_angle = math.atan2(-center_y, -center_x)
+            end_angle = math.atan2(dy - center_y, dx - center_x)
+            angle = end_angle - start_angle
+            if clockwise and angle >= 0:
+                angle -= 2 * math.pi
+            elif not clockwise and angle <= 0:
+                angle += 2 * math.pi
+            angle = abs(angle)
+        return math.hypot(angle * radius, dz)
+
+    def plan_move(self, distance, direction_x, direction_y, direction_z):
+        # time of a move is known, when speed of the junction with the next move is known
+        speed = self.feedrate
+        junction_speed = 0.0
+        if self.last_move:
+            last_distance, last_speed, last_entry_speed, last_x, last_y, last_z = self.last_move
+            cosine = last_x * direction_x + last_y * direction_y + last_z * direction_z
+            junction_speed = min(last_speed, speed) * (1 + cosine) / 2
+            self.time += trapezoid_time(last_distance, last_speed, last_entry_speed, junction_speed, self.acceleration)
+        self.last_move = (distance, speed, junction_speed, direction_x, direction_y, direction_z)
+
+    def finish_move(self):
+        # the printer stops after the last move
+        if self.last_move:
+            distance, speed, entry_speed = self.last_move[:3]
+            self.time += trapezoid_time(distance, speed, entry_speed, 0.0, self.acceleration)
+            self.last_move = None
+
+    def add_extrusion(self, start_x, start_y, x, y, z):
+        # unknown height of a chunk start is added on merge
+        if z is None:
+            self.start_height_extrusion = True
+        elif not self.layer_heights or z > self.layer_heights[-1] + LAYER_EPSILON:
+            self.layer_heights.append(z)
+        low_x, high_x = (start_x, x) if start_x < x else (x, start_x)
+        low_y, high_y = (start_y, y) if start_y < y else (y, start_y)
+        bbox = self.bbox
+        if not bbox or z is None or bbox[2] is None:
+            self.extend_bbox([low_x, low_y, z, high_x, high_y, z])
+            return
+        if low_x < bbox[0]:
+            bbox[0] = low_x
+        if low_y < bbox[1]:
+            bbox[1] = low_y
+        if z < bbox[2]:
+            bbox[2] = z
+        if high_x > bbox[3]:
+            bbox[3] = high_x
+        if high_y > bbox[4]:
+            bbox[4] = high_y
+        if z > bbox[5]:
+            bbox[5] = z
+
+    def extend_bbox(self, bbox):
+        if not self.bbox:
+            self.bbox = list(bbox)
+            return
+        for index in range(6):
+            value, current = bbox[index], self.bbox[index]
+            if current is None or value is not None and (value < current if index < 3 else value > current):
+                self.bbox[index] = value
+
+    def set_position(self, params):
+        self.finish_move()
+        if not params:
+            params = {b"X": b"0", b"Y": b"0", b"Z": b"0", b"E": b"0"}
+        for axis in (b"X", b"Y", b"Z", b"E"):
+            value = params.get(axis)
+            if value is not None:
+                setattr(self, axis.decode().lower(), float(value))
+
+    def home(self, params):
+        axes = [axis for axis in (b"X", b"Y", b"Z") if axis in params] or (b"X", b"Y", b"Z")
+        for axis in axes:
+            setattr(self, axis.decode().lower(), 0.0)
+
+    def merge(self, chunk):
+        # adds results of the next chunk, which was analyzed separately
+        self.finish_move()
+        boundary = self.get_state()
+        for line, state in chunk.pending:
+            self.set_state(self.fill_state(state, boundary))
+            self.analyze([line])
+            self.finish_move()
+        self.set_state(self.fill_state(chunk.get_state(), boundary))
+        self.time += chunk.time
+        for tool, length in chunk.extruded.items():
+            self.extruded[tool] = self.extruded.get(tool, 0.0) + length
+        heights = chunk.layer_heights
+        start_height = boundary[self.STATE_FIELDS.index('z')]
+        if chunk.start_height_extrusion and is_known(start_height):
+            heights = [start_height] + heights
+            self.extend_bbox([None, None, start_height, None, None, start_height])
+        for height in heights:
+            if not self.layer_heights or height > self.layer_heights[-1] + LAYER_EPSILON:
+                self.layer_heights.append(height)
+        if chunk.bbox:
+            self.extend_bbox(chunk.bbox)
+        self.retracted = chunk.retracted
+
+    @staticmethod
+    def fill_state(state, boundary):
+        # values from the end of the previous chunk and ones relative to them become absolute
+        filled = []
+        for index, value in enumerate(state):
+            if value is None:
+                value = boundary[index]
+            elif isinstance(value, StartOffset):
+                value = value.resolve(boundary[index])
+            filled.append(value)
+        return tuple(filled)
+
+    def get_results(self, filament_diameter=DEFAULT_FILAMENT_DIAMETER):
+        self.finish_move()
+        area = math.pi * filament_diameter * filament_diameter / 4
+        tools_count = max(self.extruded) + 1 if self.extruded else 0
+        lengths = [round(self.extruded.get(tool, 0.0), 2) for tool in range(tools_count)]
+        results = {'estimated_time': int(round(self.time)),
+                   'layers': len(self.layer_heights),
+                   'filament_lengths': lengths, # mm
+                   'material_volumes': [round(length * area / 1000, 2) for length in lengths], # cm3
+                   'bounding_box': [round(value, 3) for value in self.bbox] if self.bbox and None not in self.bbox else None}
+        return results
@@ -0,0 +1,528 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Compact storages of gcode lines with deque like interface. PackedGcodesBuffer keeps all lines in one bytearray and
+# an array of their end offsets, instead of a separate bytes object per line, which costs about 40 bytes of overhead.
+# SpilledGcodesBuffer keeps lines in memory up to a limit and the rest in pages of a temporary file, which are read back
+# as the window of lines in memory is consumed.
+# MappedGcodesFile does not load lines at all and reads them from memory mapped file on demand.
+
+import array
+import collections
+import itertools
+import mmap
+import os
+import re
+import sys
+import tempfile
+import threading
+
+import gcodes_index
+
+
+class PackedGcodesBuffer:
+
+    OFFSET_TYPECODE = 'I'
+    WIDE_OFFSET_TYPECODE = 'Q'
+    WIDE_OFFSETS_MIN = 1 << 32 # larger offsets do not fit OFFSET_TYPECODE, so the array of them is widened
+    COMPACT_MIN_LINES = 64 * 1024 # consumed lines are dropped only in large batches, to keep popleft cheap
+
+    def __init__(self, lines=()):
+        self.lock = threading.RLock()
+        self.data = bytearray()
+        self.ends = array.array(self.OFFSET_TYPECODE)
+        self.head = 0 # index of the next line to pop
+        self.dropped = 0 # number of lines removed from the start of data by compact
+        self.front = collections.deque() # lines pushed back by appendleft
+        if lines:
+            self.extend(lines)
+
+    def __len__(self):
+        return len(self.front) + len(self.ends) - self.head
+
+    def __bool__(self):
+        return bool(len(self))
+
+    def __iter__(self):
+        # iterates over a snapshot of line positions, so lines appended during iteration are not included
+        with self.lock:
+            front = list(self.front)
+            first, last = self.dropped + self.head, self.dropped + len(self.ends)
+        yield from front
+        for number in range(first, last):
+            with self.lock:
+                index = number - self.dropped
+                if index < self.head:
+                    continue # already popped
+                line = self.get_line(index)
+            yield line
+
+    def __getitem__(self, index):
+        with self.lock:
+            length = len(self)
+            if index < 0:
+                index += length
+            if not 0 <= index < length:
+                raise IndexError('gcodes buffer index out of range')
+            if index < len(self.front):
+                return self.front[index]
+            return self.get_line(self.head + index - len(self.front))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self)} lines, {len(self.data)}B)'
+
+    def get_line(self, index):
+        start = self.ends[index - 1] if index else 0
+        return bytes(self.data[start:self.ends[index]])
+
+    @staticmethod
+    def to_bytes(line):
+        if isinstance(line, str):
+            return line.encode('utf-8')
+        return line
+
+    @classmethod
+    def get_offset_typecode(cls, last_offset):
+        if last_offset >= cls.WIDE_OFFSETS_MIN:
+            return cls.WIDE_OFFSET_TYPECODE
+        return cls.OFFSET_TYPECODE
+
+    @classmethod
+    def widen_offsets(cls, offsets, last_offset):
+        # returns offsets in an array, which could hold last_offset too
+        typecode = cls.get_offset_typecode(last_offset)
+        if typecode != offsets.typecode and typecode == cls.WIDE_OFFSET_TYPECODE:
+            return array.array(typecode, offsets)
+        return offsets
+
+    @staticmethod
+    def add_offsets(offsets, ends, base):
+        # array is extended by an array without conversion only when both have the same typecode
+        if base or getattr(ends, 'typecode', None) != offsets.typecode:
+            offsets.extend(map(base.__add__, ends))
+        else:
+            offsets.extend(ends)
+
+    def append(self, line):
+        line = self.to_bytes(line)
+        with self.lock:
+            self.data += line
+            self.ends = self.widen_offsets(self.ends, len(self.data))
+            self.ends.append(len(self.data))
+
+    def extend(self, lines):
+        if isinstance(lines, PackedGcodesBuffer):
+            lines = list(lines)
+        elif not isinstance(lines, (list, tuple)):
+            lines = list(lines)
+        if lines and isinstance(lines[0], str):
+            lines = [self.to_bytes(line) for line in lines]
+        with self.lock:
+            data = b"".join(lines)
+            self.ends = self.widen_offsets(self.ends, len(self.data) + len(data))
+            # running sum of lengths, which starts from the current end, is computed without python level loop
+            ends = itertools.accumulate(itertools.chain((len(self.data),), map(len, lines)))
+            self.ends.extend(itertools.islice(ends, 1, None))
+            self.data += data
+
+    def extend_packed(self, data, ends):
+        # lines in the form of gcodes_cleaner.pack_lines, that is the own form of the buffer
+        with self.lock:
+            base = len(self.data)
+            self.ends = self.widen_offsets(self.ends, base + len(data))
+            self.add_offsets(self.ends, ends, base)
+            self.data += data
+
+    def appendleft(self, line):
+        with self.lock:
+            self.front.appendleft(self.to_bytes(line))
+
+    def popleft(self):
+        with self.lock:
+            if self.front:
+                return self.front.popleft()
+            if self.head >= len(self.ends):
+                raise IndexError('pop from an empty gcodes buffer')
+            line = self.get_line(self.head)
+            self.head += 1
+            if self.head >= self.COMPACT_MIN_LINES and self.head * 2 >= len(self.ends):
+                self.compact()
+            return line
+
+    def compact(self):
+        # drops already popped lines, so memory of a long print is released as it goes
+        with self.lock:
+            if not self.head:
+                return
+            base = self.ends[self.head - 1]
+            del self.data[:base]
+            self.ends = array.array(self.get_offset_typecode(len(self.data)), (end - base for end in self.ends[self.head:]))
+            self.dropped += self.head
+            self.head = 0
+
+    def clear(self):
+        with self.lock:
+            self.data = bytearray()
+            self.ends = array.array(self.OFFSET_TYPECODE)
+            self.head = 0
+            self.dropped = 0
+            self.front.clear()
+
+    def get_memory_size(self):
+        # allocated sizes, which include overallocation of bytearray and array
+        with self.lock:
+            return sys.getsizeof(self.data) + sys.getsizeof(self.ends) + sum(map(sys.getsizeof, self.front))
+
+
+class SpilledGcodesBuffer(PackedGcodesBuffer):
+    # lines are kept in memory while get_memory_size is under memory_limit, after that they are written to pages of
+    # a temporary file. Pages are read back in order, when lines left in memory are less than read_ahead_size, and
+    # the kernel is asked to read the next page ahead, so popleft rarely waits for disk.
+
+    PAGE_SIZE = 1024 * 1024
+    # offset, data size, lines count and typecode of line ends
+    PAGE_RECORD_SIZE = sys.getsizeof((0, 0, 0, 'I')) + 3 * sys.getsizeof(1 << 40)
+
+    def __init__(self, memory_limit=None, read_ahead_size=8*1024*1024, folder=None, lines=()):
+        self.memory_limit = memory_limit # None is no limit
+        self.read_ahead_size = read_ahead_size
+        self.folder = folder
+        self.page_lock = threading.Lock() # taken before lock, guards the file
+        self.file = None
+        self.file_end = 0
+        self.pages = collections.deque() # offset, data size, lines count and typecode of line ends of pages in the file
+        self.pending_data = bytearray() # lines to spill, which are not enough for a page yet
+        self.pending_ends = array.array(self.OFFSET_TYPECODE)
+        self.spilled_lines = 0 # lines in pages and pending
+        super().__init__(lines)
+
+    def __len__(self):
+        return super().__len__() + self.spilled_lines
+
+    def __iter__(self):
+        with self.lock:
+            pages = list(self.pages)
+            pending = (bytes(self.pending_data), self.pending_ends[:])
+        yield from super().__iter__()
+        for page in pages:
+            yield from self.iterate_page(*self.read_page(page))
+        yield from self.iterate_page(*pending)
+
+    def __getitem__(self, index):
+        with self.lock:
+            length = len(self)
+            if index < 0:
+                index += length
+            if not 0 <= index < length:
+                raise IndexError('gcodes buffer index out of range')
+            window = super().__len__()
+            if index < window:
+                return super().__getitem__(index)
+            index -= window
+            for page in self.pages:
+                if index < page[2]:
+                    break
+                index -= page[2]
+            else:
+                return list(self.iterate_page(bytes(self.pending_data), self.pending_ends))[index]
+        # page is read without lock, since page_lock is taken before it
+        return list(self.iterate_page(*self.read_page(page)))[index]
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self)} lines, {len(self.data)}B in memory, {self.file_end}B spilled)'
+
+    @staticmethod
+    def iterate_page(data, ends):
+        start = 0
+        for end in ends:
+            yield data[start:end]
+            start = end
+
+    def is_spilling(self):
+        # once spilled, lines are spilled until the file is read back, to keep their order
+        return bool(self.spilled_lines) or \
+            (self.memory_limit is not None and self.get_memory_size() >= self.memory_limit)
+
+    def append(self, line):
+        self.extend((line,))
+
+    def extend(self, lines):
+        if isinstance(lines, PackedGcodesBuffer):
+            lines = list(lines)
+        elif not isinstance(lines, (list, tuple)):
+            lines = list(lines)
+        if lines and isinstance(lines[0], str):
+            lines = [self.to_bytes(line) for line in lines]
+        data = b"".join(lines)
+        ends = array.array(self.get_offset_typecode(len(data)), itertools.accumulate(map(len, lines)))
+        self.extend_packed(data, ends)
+
+    def extend_packed(self, data, ends):
+        with self.page_lock:
+            with self.lock:
+                if not self.is_spilling():
+                    super().extend_packed(data, ends)
+                    return
+                base = len(self.pending_data)
+                self.pending_ends = self.widen_offsets(self.pending_ends, base + len(data))
+                self.add_offsets(self.pending_ends, ends, base)
+                self.pending_data += data
+                self.spilled_lines += len(ends)
+                if len(self.pending_data) >= self.PAGE_SIZE:
+                    self.write_page()
+
+    def write_page(self):
+        # called with page_lock and lock
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix='3dprinteros-spill-', dir=self.folder)
+        self.file.seek(self.file_end)
+        self.file.write(self.pending_data)
+        self.pending_ends.tofile(self.file)
+        self.pages.append((self.file_end, len(self.pending_data), len(self.pending_ends), self.pending_ends.typecode))
+        self.file_end = self.file.tell()
+        self.pending_data = bytearray()
+        self.pending_ends = array.array(self.OFFSET_TYPECODE)
+
+    @staticmethod
+    def get_page_file_size(page):
+        _, size, count, typecode = page
+        return size + count * array.array(typecode).itemsize
+
+    def read_page(self, page):
+        offset, size, _, typecode = page
+        with self.page_lock:
+            self.file.seek(offset)
+            data = self.file.read(self.get_page_file_size(page))
+        ends = array.array(typecode)
+        ends.frombytes(data[size:])
+        return data[:size], ends
+
+    def advise_read_ahead(self):
+        if self.pages and hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(self.file.fileno(), self.pages[0][0], self.get_page_file_size(self.pages[0]), os.POSIX_FADV_WILLNEED)
+            except OSError:
+                pass
+
+    def load_page(self):
+        # moves the next page or pending lines to memory
+        with self.lock:
+            if not self.pages:
+                if self.pending_ends:
+                    super().extend_packed(bytes(self.pending_data), self.pending_ends)
+                    self.spilled_lines -= len(self.pending_ends)
+                    self.pending_data = bytearray()
+                    self.pending_ends = array.array(self.OFFSET_TYPECODE)
+                return
+            page = self.pages[0]
+        data, ends = self.read_page(page)
+        with self.lock:
+            if self.pages and self.pages[0] == page: # could be cleared meanwhile
+                self.pages.popleft()
+                self.spilled_lines -= page[2]
+                super().extend_packed(data, ends)
+                self.advise_read_ahead()
+
+    def get_window_size(self):
+        # bytes of lines in memory, which are not popped yet
+        if self.head >= len(self.ends):
+            return 0
+        return self.ends[-1] - (self.ends[self.head - 1] if self.head else 0)
+
+    def popleft(self):
+        while True:
+            with self.lock:
+                if self.spilled_lines and self.get_window_size() < self.read_ahead_size:
+                    spilled_lines = self.spilled_lines
+                else:
+                    return super().popleft()
+            # page is read without lock, so other threads are not blocked by disk. Loop is ended by popleft above.
+            self.load_page()
+            if self.spilled_lines == spilled_lines:
+                with self.lock:
+                    return super().popleft()
+
+    def clear(self):
+        with self.page_lock:
+            with self.lock:
+                super().clear()
+                self.pages.clear()
+                self.pending_data = bytearray()
+                self.pending_ends = array.array(self.OFFSET_TYPECODE)
+                self.spilled_lines = 0
+                self.file_end = 0
+                if self.file is not None:
+                    self.file.truncate(0)
+
+    def get_memory_size(self):
+        with self.lock:
+            return super().get_memory_size() + sys.getsizeof(self.pending_data) + sys.getsizeof(self.pending_ends) + \
+                sys.getsizeof(self.pages) + len(self.pages) * self.PAGE_RECORD_SIZE
+
+    def close(self):
+        with self.page_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class MappedGcodesFile:
+    # lines are numbered without empty and comment only lines, same as in the loaded buffers
+
+    INDEX_STEP = gcodes_index.STEP # lines between offsets stored in the sparse index
+    OFFSET_TYPECODE = 'Q'
+
+    def __init__(self, path, comment_chars=(b";",)):
+        self.lock = threading.RLock()
+        self.name = path
+        self.comment_chars = comment_chars
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = b""
+        # matches start of each line, that is not empty after stripping of comments and whitespaces
+        self.line_re = re.compile(rb"^[ \t\r\f\v]*[^\s" + re.escape(b"".join(comment_chars)) + rb"]", re.MULTILINE)
+        self.position = 0 # byte offset of the next line to pop
+        self.line_number = 0 # number of the next line to pop
+        self.front = collections.deque() # lines pushed back by appendleft
+        self.index = array.array(self.OFFSET_TYPECODE, [0]) # byte offsets of lines number 0, INDEX_STEP, 2*INDEX_STEP...
+        self.index_end = 0 # byte offset, up to which lines are counted
+        self.indexed_lines = 0
+        self.total_lines = None
+
+    def strip_line(self, line):
+        # same as BaseSender.strip_line_form_junk
+        line = line.translate(None, b"\r\n").expandtabs(4)
+        for comment_char in self.comment_chars:
+            line = line.split(comment_char)[0].strip()
+        return line
+
+    def read_line(self, position):
+        # returns the next not empty line at or after position, its byte offset and position after it
+        while position < self.size:
+            end = self.map.find(b"\n", position)
+            if end == -1:
+                end = self.size
+            line = self.strip_line(self.map[position:end])
+            if line:
+                return line, position, end + 1
+            position = end + 1
+        return None, self.size, self.size
+
+    def build_index(self, line_number=None):
+        # counts lines up to line_number or to the end of file. Only offsets of every INDEX_STEP line are stored.
+        with self.lock:
+            if self.total_lines is not None:
+                return
+            for match in self.line_re.finditer(self.map, self.index_end):
+                if line_number is not None and self.indexed_lines > line_number:
+                    return
+                if not self.indexed_lines % self.INDEX_STEP and self.indexed_lines // self.INDEX_STEP == len(self.index):
+                    self.index.append(match.start())
+                self.indexed_lines += 1
+                self.index_end = self.map.find(b"\n", match.start()) + 1 or self.size
+            self.index_end = self.size
+            self.total_lines = self.indexed_lines
+
+    def set_line_index(self, line_index):
+        # takes index, which was stored on a previous load of the same file, instead of counting lines
+        with self.lock:
+            if line_index.step == self.INDEX_STEP and line_index.size == self.size and self.total_lines is None:
+                self.index = array.array(self.OFFSET_TYPECODE, line_index.offsets or [0])
+                self.indexed_lines = self.total_lines = line_index.total_lines
+                self.index_end = self.size
+
+    def find_line(self, line_number):
+        # returns byte offset of the line or None if there is no such line
+        with self.lock:
+            self.build_index(line_number)
+            if self.total_lines is not None and line_number >= self.total_lines:
+                return None
+            position = self.index[line_number // self.INDEX_STEP]
+            for _ in range(line_number % self.INDEX_STEP):
+                _, _, position = self.read_line(position)
+            return self.read_line(position)[1]
+
+    def seek(self, line_number):
+        # next popleft will return line of line_number. Used to resume a print from the middle of the file.
+        with self.lock:
+            position = self.find_line(line_number)
+            if position is None:
+                raise IndexError('gcodes file line number out of range')
+            self.front.clear()
+            self.position = position
+            self.line_number = line_number
+
+    def __len__(self):
+        with self.lock:
+            self.build_index()
+            return len(self.front) + self.total_lines - self.line_number
+
+    def __bool__(self):
+        with self.lock:
+            return bool(self.front) or self.read_line(self.position)[0] is not None
+
+    def __iter__(self):
+        with self.lock:
+            front = list(self.front)
+            position = self.position
+        yield from front
+        while True:
+            line, _, position = self.read_line(position)
+            if line is None:
+                return
+            yield line
+
+    def __getitem__(self, index):
+        with self.lock:
+            if index < 0:
+                index += len(self)
+            if 0 <= index < len(self.front):
+                return self.front[index]
+            position = None
+            if index >= 0:
+                position = self.find_line(self.line_number + index - len(self.front))
+            if position is None:
+                raise IndexError('gcodes file index out of range')
+            return self.read_line(position)[0]
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name}, {self.size}B)'
+
+    def popleft(self):
+        with self.lock:
+            if self.front:
+                return self.front.popleft()
+            line, _, position = self.read_line(self.position)
+            if line is None:
+                raise IndexError('pop from an empty gcodes file')
+            self.position = position
+            self.line_number += 1
+            return line
+
+    def appendleft(self, line):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        with self.lock:
+            self.front.appendleft(line)
+
+    def get_memory_size(self):
+        with self.lock:
+            return len(self.index) * self.index.itemsize + sum(len(line) for line in self.front)
+
+    def close(self):
+        with self.lock:
+            if self.size:
+                self.map.close()
+            self.file.close()
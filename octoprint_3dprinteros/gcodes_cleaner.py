@@ -0,0 +1,129 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Removal of comments, surrounding whitespaces and empty lines from whole chunks of gcodes at once.
+# Gives the same lines as line.split(b";")[0].strip() per line, or as BaseSender.strip_line_form_junk with expand_tabs,
+# but most of the work is done by regex and bytes methods over the chunk, instead of python code for each line.
+
+import array
+import itertools
+import re
+
+import gcodes_index
+
+CHUNK_SIZE = 1024 * 1024
+# after comments removal and CRLF to LF replacement, lines of a chunk without these and without spaces on its edges need no strip
+STRIP_MARKERS = (b" \n", b"\n ", b"\t", b"\r", b"\x0b", b"\x0c")
+
+comment_res = {}
+
+
+def get_comment_re(comment_chars):
+    comment_re = comment_res.get(comment_chars)
+    if not comment_re:
+        comment_re = re.compile(b"[" + re.escape(b"".join(comment_chars)) + b"][^\n]*")
+        comment_res[comment_chars] = comment_re
+    return comment_re
+
+
+def split_chunk(chunk, comment_chars=(b";",), expand_tabs=False):
+    # returns cleaned lines of the chunk, including empty ones, so they match lines of the original chunk one to one
+    comment_chars = tuple(comment_chars)
+    if expand_tabs:
+        chunk = chunk.translate(None, b"\r").expandtabs(4)
+    if any(comment_char in chunk for comment_char in comment_chars):
+        chunk = get_comment_re(comment_chars).sub(b"", chunk)
+    chunk = chunk.replace(b"\r\n", b"\n")
+    if chunk[:1] == b" " or chunk[-1:] == b" " or any(marker in chunk for marker in STRIP_MARKERS):
+        return list(map(bytes.strip, chunk.split(b"\n")))
+    return chunk.split(b"\n")
+
+
+def clean_chunk(chunk, comment_chars=(b";",), expand_tabs=False):
+    # chunk should end on a line boundary. Returns list of not empty lines.
+    return list(filter(None, split_chunk(chunk, comment_chars, expand_tabs)))
+
+
+def pack_lines(lines):
+    # joined lines and array of their ends are passed between processes much faster than a list of lines
+    return b"".join(lines), array.array('I', itertools.accumulate(map(len, lines)))
+
+
+def unpack_lines(data, ends):
+    return list(map(data.__getitem__, map(slice, itertools.chain((0,), ends), ends)))
+
+
+def clean_chunk_packed(chunk, comment_chars=(b";",), expand_tabs=False, line_starts=False):
+    # runs in a worker process of the pool. Returns packed cleaned lines, offsets of lines in the chunk, if requested
+    # for the line offsets index, and the chunk size.
+    lines = split_chunk(chunk, comment_chars, expand_tabs)
+    starts = None
+    if line_starts:
+        starts = array.array('I', gcodes_index.iterate_line_starts(chunk, lines))
+    data, ends = pack_lines(list(filter(None, lines)))
+    return data, ends, starts, len(chunk)
+
+
+def split_lines_packed(chunk, is_last):
+    # runs in a worker process of the pool. Splits a chunk of gcodes, which are given as they are, without cleaning.
+    if isinstance(chunk, str):
+        chunk = chunk.encode("utf-8")
+    lines = chunk.replace(b"\r", b"").split(b"\n")
+    if is_last:
+        while lines and not lines[-1]:
+            lines.pop()
+    else:
+        lines.pop() # empty part after the last line end
+    return pack_lines(lines)
+
+
+def iterate_buffer_chunks(data, chunk_size=CHUNK_SIZE):
+    # yields copies of chunks of bytes or str in memory, which end on lines boundaries, with a flag of the last chunk.
+    # Blank lines at the end of data are all in the last chunk, so split_lines_packed drops them as the sequential split does.
+    newline, carriage_return = ("\n", "\r") if isinstance(data, str) else (b"\n", b"\r")
+    start = 0
+    size = len(data)
+    content_end = size
+    while content_end and data[content_end - 1:content_end] in (newline, carriage_return):
+        content_end -= 1
+    while start < size:
+        end = data.rfind(newline, start, start + chunk_size) + 1
+        if end <= start:
+            end = data.find(newline, start + chunk_size) + 1 or size
+        if start + chunk_size >= size or end >= content_end:
+            end = size
+        yield data[start:end], end == size
+        start = end
+
+
+def iterate_chunks(binary_file, chunk_size=CHUNK_SIZE):
+    # yields chunks of about chunk_size of a file like object, which has read. Each chunk, but the last, ends on a line boundary.
+    partline = b""
+    while True:
+        data = binary_file.read(chunk_size)
+        if not data:
+            break
+        data = partline + data
+        end = data.rfind(b"\n") + 1
+        partline = data[end:]
+        if end:
+            yield data[:end]
+    if partline:
+        yield partline
+
+
+def iterate_cleaned(binary_file, comment_chars=(b";",), expand_tabs=False, chunk_size=CHUNK_SIZE):
+    # yields lists of cleaned lines of a file like object, which has read
+    for chunk in iterate_chunks(binary_file, chunk_size):
+        lines = clean_chunk(chunk, comment_chars, expand_tabs)
+        if lines:
+            yield lines
@@ -0,0 +1,132 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Decompression of gzip and zstd compressed gcodes on the fly, while they are read, without an extracted copy.
+# Binary gcodes are decoded the same way, to text gcodes. Format is detected by magic bytes, since downloaded files
+# are stored with .gcode suffix whatever they contain.
+# Module zstandard is optional, without it zstd files are reported as not supported.
+
+import gzip
+import io
+import os
+import struct
+import zlib
+
+import bgcode_decoder
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = "gzip"
+ZSTD = "zstd"
+BGCODE = "bgcode"
+MAGICS = {b"\x1f\x8b": GZIP, b"\x28\xb5\x2f\xfd": ZSTD, bgcode_decoder.MAGIC: BGCODE}
+MAGIC_SIZE = max(map(len, MAGICS))
+ZSTD_FRAME_HEADER_MAX_SIZE = 18
+UNKNOWN_SIZE_RATIO = 4 # typical compression ratio of gcodes, for size estimation when the format does not store it
+ERRORS = (OSError, EOFError, zlib.error, ValueError, struct.error) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+class UnsupportedCompression(ValueError):
+    pass
+
+
+def detect_compression(header):
+    # returns name of the compression of data, which starts with header, or None for not compressed data
+    for magic, compression in MAGICS.items():
+        if header[:len(magic)] == magic:
+            return compression
+    return None
+
+
+def detect_file_compression(path):
+    with open(path, "rb") as f:
+        return detect_compression(f.read(MAGIC_SIZE))
+
+
+def open_decompressed(binary_file, compression):
+    # returns binary file like object with read, which decompresses binary_file
+    if compression == GZIP:
+        return gzip.GzipFile(fileobj=binary_file, mode="rb")
+    if compression == ZSTD:
+        if not zstandard:
+            raise UnsupportedCompression("zstd compressed gcodes require zstandard module")
+        return zstandard.ZstdDecompressor().stream_reader(binary_file, read_across_frames=True, closefd=True)
+    if compression == BGCODE:
+        return bgcode_decoder.BgcodeReader(binary_file)
+    raise UnsupportedCompression(f"unknown compression: {compression}")
+
+
+def open_file(path):
+    # opens gcodes file for reading, decompressing it if it is compressed
+    f = open(path, "rb")
+    try:
+        compression = detect_compression(f.read(MAGIC_SIZE))
+        f.seek(0)
+        if compression == GZIP:
+            f.close()
+            return gzip.open(path, "rb") # GzipFile closes only a file, which it opened itself
+        if compression:
+            return open_decompressed(f, compression)
+    except BaseException:
+        f.close()
+        raise
+    return f
+
+
+def open_bytes(data):
+    # returns file like object over in memory gcodes, decompressing them if they are compressed
+    compression = detect_compression(data[:MAGIC_SIZE])
+    if compression:
+        return open_decompressed(io.BytesIO(data), compression)
+    return io.BytesIO(data)
+
+
+def get_content_size(binary_file, compression):
+    # size of gcodes after decompression of a seekable binary_file. Gzip stores it (modulo 4GB) in the trailer of the last
+    # member and zstd in the frame header, if the compressor knew it. When it is unknown it is estimated by a ratio.
+    position = binary_file.tell()
+    try:
+        compressed_size = binary_file.seek(0, os.SEEK_END)
+        if compression == GZIP and compressed_size >= 18:
+            binary_file.seek(-4, os.SEEK_END)
+            return struct.unpack("<I", binary_file.read(4))[0]
+        if compression == ZSTD and zstandard:
+            binary_file.seek(0)
+            try:
+                size = zstandard.frame_content_size(binary_file.read(ZSTD_FRAME_HEADER_MAX_SIZE))
+            except zstandard.ZstdError:
+                size = -1
+            if size >= 0:
+                return size
+        if compression == BGCODE:
+            return bgcode_decoder.get_content_size(binary_file)
+        return compressed_size * UNKNOWN_SIZE_RATIO
+    finally:
+        binary_file.seek(position)
+
+
+def get_file_content_size(path):
+    with open(path, "rb") as f:
+        compression = detect_compression(f.read(MAGIC_SIZE))
+        if compression:
+            return get_content_size(f, compression)
+        return os.fstat(f.fileno()).st_size
+
+
+def get_bytes_content_size(data):
+    compression = detect_compression(data[:MAGIC_SIZE])
+    if compression:
+        return get_content_size(io.BytesIO(data), compression)
+    return len(data)
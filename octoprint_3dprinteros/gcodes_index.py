@@ -0,0 +1,100 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Sampled index of byte offsets of gcode lines, which is built while a file is loaded and is stored next to it.
+# Lines are numbered without empty and comment only lines, same as in the loaded buffers, so line_number of reports
+# could be found in the file by one lookup and reading of less than STEP lines, to resume a print or to jump to a line.
+
+import array
+import itertools
+import operator
+import os
+import struct
+
+STEP = 1024 # lines between stored offsets
+FILE_EXTENSION = ".lines"
+HEADER = struct.Struct("<8sQQQQ") # magic, step, total lines, file size, file modification time in ns
+MAGIC = b"3DPOSLIX"
+
+def iterate_line_starts(chunk, cleaned_lines, base=0):
+    # cleaned lines are ones of gcodes_cleaner.split_chunk, with empty lines kept, so they match lines of the chunk.
+    # Yields offsets of not empty lines, which are selected by iterators without a python level loop over lines.
+    lengths = map(operator.add, map(len, chunk.split(b"\n")), itertools.repeat(1))
+    return itertools.compress(itertools.accumulate(itertools.chain((base,), lengths)), cleaned_lines)
+
+
+def get_index_path(path):
+    return os.fspath(path) + FILE_EXTENSION
+
+
+class LineOffsetIndex:
+
+    def __init__(self, step=STEP):
+        self.step = step
+        self.offsets = array.array('Q') # byte offsets of lines number 0, step, 2*step...
+        self.total_lines = 0
+        self.size = 0 # bytes indexed
+
+    def add_chunk(self, chunk, cleaned_lines):
+        # chunks are consecutive parts of the file, which end on lines boundaries
+        first = -self.total_lines % self.step
+        self.offsets.extend(itertools.islice(iterate_line_starts(chunk, cleaned_lines, self.size), first, None, self.step))
+        self.total_lines += sum(map(bool, cleaned_lines))
+        self.size += len(chunk)
+
+    def add_line_starts(self, line_starts, chunk_size):
+        # same as add_chunk, but with offsets of all not empty lines relative to the chunk, that were found by a pool worker
+        first = -self.total_lines % self.step
+        self.offsets.extend(map(self.size.__add__, itertools.islice(line_starts, first, None, self.step)))
+        self.total_lines += len(line_starts)
+        self.size += chunk_size
+
+    def locate(self, line_number):
+        # returns byte offset of the closest indexed line and number of lines to skip after it
+        if not 0 <= line_number < self.total_lines:
+            raise IndexError('line number out of indexed range')
+        return self.offsets[line_number // self.step], line_number % self.step
+
+    def save(self, path):
+        stat = os.stat(path)
+        if stat.st_size != self.size:
+            raise ValueError('index does not cover the whole file')
+        tmp_path = get_index_path(path) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, self.step, self.total_lines, stat.st_size, stat.st_mtime_ns))
+            self.offsets.tofile(f)
+        os.replace(tmp_path, get_index_path(path))
+
+    @classmethod
+    def load(cls, path):
+        # returns None when there is no index or it is stale
+        try:
+            stat = os.stat(path)
+            with open(get_index_path(path), "rb") as f:
+                magic, step, total_lines, size, mtime = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC or size != stat.st_size or mtime != stat.st_mtime_ns or not step:
+                    return None
+                index = cls(step)
+                count = (total_lines + step - 1) // step
+                index.offsets.fromfile(f, count)
+        except (OSError, EOFError, struct.error):
+            return None
+        index.total_lines = total_lines
+        index.size = size
+        return index
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(get_index_path(path))
+        except OSError:
+            pass
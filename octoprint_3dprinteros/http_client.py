@@ -11,9 +11,12 @@
 # and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
 
 
+import os
 import re
 import sys
 import time
+import heapq
+import itertools
 import json
 import uuid
 import http.client
@@ -23,6 +26,8 @@ import threading
 import ifaddr
 
 import config
+import dns_cache
+import paths
 import version
 import platforms
 import client_ssl_context
@@ -48,6 +53,7 @@ class HTTPClient:
     HTTPS_MODE = config.get_settings()['protocol']['encryption']
     CUSTOM_PORT = config.get_settings()['protocol'].get('custom_port', 0)
     RESP_TIME_LOGGING = config.get_settings()['protocol'].get('response_time_log', False)
+    COALESCE_REPORTS = config.get_settings()['protocol'].get('coalesce_reports', False)
     BASE_TIMEOUT = 6
     MAX_TIMEOUT = BASE_TIMEOUT * 3
     RECONNECTION_ATTEMPT_DELAY = BASE_TIMEOUT / 2
@@ -69,6 +75,17 @@ class HTTPClient:
     EMPTY_COMMAND = {"command" : None}
     SEND_LOGS_TOKEN_FIELD_NAME = 'user_token'
     IS_LINK_BYTES = b"is_link"
+    BODY_WRITE_CHUNK = 64*1024
+    FRAME_FIELDS = ("file_data", "image") # base64 camera frame of streamer and apiprinter protocols
+    CAMERA_IMAGEJPEG_SUPPORTED = True
+    HOST_ID_CACHE_PATH = os.path.join(paths.CURRENT_SETTINGS_FOLDER, 'host_id.json')
+    ACK_PRIORITY = 0
+    REPORT_PRIORITY = 1
+    JOBS_PRIORITY = 2
+    LOGS_PRIORITY = 3
+
+    host_identity = {}
+    host_identity_lock = threading.Lock()
 
     def __init__(self, parent, keep_connection_flag = True, logging_level = logging.INFO, exit_on_fail=False):
         self.parent = parent
@@ -92,6 +109,12 @@ class HTTPClient:
         self.host_id = getattr(app, 'host_id', "")
         self.macaddr = getattr(app, 'macaddr', "")
         self.lock = threading.RLock()
+        self.queue_lock = threading.Lock()
+        self.outbound_queue = []
+        self.outbound_counter = itertools.count()
+        self.last_status = None
+        self.bytes_sent = 0
+        self.bytes_copied = 0
         if self.CUSTOM_PORT:
             self.port = self.CUSTOM_PORT
         elif self.HTTPS_MODE:
@@ -179,24 +202,72 @@ class HTTPClient:
                 retry += 1
                 return HTTPClient.get_macaddr(local_ip, retry, old_macid_compat)
 
+    @staticmethod
+    def load_host_identity(local_ip):
+        # should be called under host_identity_lock
+        identity = HTTPClient.host_identity
+        if identity.get('local_ip') != local_ip:
+            try:
+                with open(HTTPClient.HOST_ID_CACHE_PATH) as f:
+                    identity = json.load(f)
+            except FileNotFoundError:
+                return None
+            except (OSError, ValueError):
+                logging.getLogger('HTTPClient').warning('Unable to read host id cache file. Ignoring it')
+                return None
+            if not isinstance(identity, dict) or identity.get('local_ip') != local_ip:
+                return None
+            if not identity.get('host_id') or not identity.get('macaddr'):
+                return None
+            HTTPClient.host_identity = identity
+        return identity
+
+    @staticmethod
+    def save_host_identity(local_ip, host_id, macaddr):
+        # should be called under host_identity_lock
+        identity = {'local_ip': local_ip, 'host_id': host_id, 'macaddr': macaddr}
+        HTTPClient.host_identity = identity
+        tmp_path = HTTPClient.HOST_ID_CACHE_PATH + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(identity, f)
+            os.replace(tmp_path, HTTPClient.HOST_ID_CACHE_PATH)
+        except OSError as e:
+            logging.getLogger('HTTPClient').warning('Unable to write host id cache file: ' + str(e))
+
+    # mac address discovery is slow, so its result is shared by all clients and cached on disk until local ip changes
+    def resolve_host_identity(self):
+        with self.host_identity_lock:
+            identity = self.load_host_identity(self.local_ip)
+            if identity:
+                if not self.host_id:
+                    self.host_id = identity['host_id']
+                if not self.macaddr:
+                    self.macaddr = identity['macaddr']
+                return
+            if not self.host_id:
+                self.host_id = self.get_host_id()
+            if not self.macaddr:
+                self.macaddr = self.get_macaddr(self.local_ip, old_macid_compat = False)
+            if self.host_id and self.macaddr and self.host_id != hex(uuid.getnode()) + "L":
+                self.save_host_identity(self.local_ip, self.host_id, self.macaddr)
+
     def connect(self):
         #self.logger.debug('{ Connecting...')
         while not getattr(self.parent, "stop_flag", False) and not getattr(self.parent, "offline_mode", False):
             if self.HTTPS_MODE:
-                connection_class = http.client.HTTPSConnection
+                connection_class = dns_cache.HTTPSConnection
                 kwargs = {'context': client_ssl_context.SSL_CONTEXT}
             else:
-                connection_class = http.client.HTTPConnection
+                connection_class = dns_cache.HTTPConnection
                 kwargs = {}
             with self.connection_lock:
                 try:
                     connection = connection_class(self.URL, port = self.port, timeout = self.timeout, **kwargs)
                     connection.connect()
                     self.local_ip = connection.sock.getsockname()[0]
-                    if not self.host_id:
-                        self.host_id = self.get_host_id()
-                    if not self.macaddr:
-                        self.macaddr = self.get_macaddr(self.local_ip, old_macid_compat = False)
+                    if not self.host_id or not self.macaddr:
+                        self.resolve_host_identity()
                 except Exception as e:
                     self.parent.register_error(5, 'Error during HTTP connection: ' + str(e))
                     #self.logger.debug('...failed }')
@@ -212,16 +283,46 @@ class HTTPClient:
                         self.logger.info('Connected to server from: %s %s' % (self.local_ip, self.host_id))
                     return connection
 
+    @staticmethod
+    def get_payload_length(payload):
+        if isinstance(payload, (list, tuple)):
+            return sum(len(segment) for segment in payload)
+        return len(payload)
+
+    def write_body(self, connection, body):
+        # body can be bytes-like or a list of bytes-like segments, which are written without joining or copying
+        if not isinstance(body, (list, tuple)):
+            body = (body,)
+        for segment in body:
+            if isinstance(segment, str):
+                segment = segment.encode('utf-8')
+                self.bytes_copied += len(segment)
+            view = memoryview(segment)
+            for offset in range(0, len(view), self.BODY_WRITE_CHUNK):
+                chunk = view[offset:offset + self.BODY_WRITE_CHUNK]
+                connection.send(chunk)
+                self.bytes_sent += len(chunk)
+
     def request(self, method, connection, path, payload, headers=None):
         #self.logger.debug('{ Requesting...')
         if headers is None:
             headers = self.DEFAULT_HEADERS
             headers = {"Content-Type": "application/json"}
-        headers["Content-Length"] = len(payload)
+        headers["Content-Length"] = self.get_payload_length(payload)
         if self.keep_connection_flag:
             headers['Connection'] = 'keep-alive'
+        self.last_status = None
         try:
-            connection.request(method, path, payload, headers)
+            if isinstance(payload, str):
+                connection.request(method, path, payload, headers)
+                self.bytes_copied += len(payload)
+                self.bytes_sent += len(payload)
+            else:
+                connection.putrequest(method, path)
+                for header, value in headers.items():
+                    connection.putheader(header, value)
+                connection.endheaders()
+                self.write_body(connection, payload)
             resp = connection.getresponse()
         except Exception as e:
             if self.parent:
@@ -229,6 +330,7 @@ class HTTPClient:
             time.sleep(1)
         else:
             #self.logger.debug('Response status: %s %s' % (resp.status, resp.reason))
+            self.last_status = resp.status
             try:
                 received = resp.read()
             except Exception as e:
@@ -247,40 +349,103 @@ class HTTPClient:
         self.logger.warning('Warning: HTTP request failed!')
 
     def pack_and_send(self, target, *payloads, **kwargs_payloads):
-        with self.lock:
-            path, packed_message = self.pack(target, *payloads, **kwargs_payloads)
-            if target == self.CAMERA or target == self.CAMERA_IMAGEJPEG:
-                self.logger.info(f"REQ({target}):\nCamera frame: {len(packed_message)}B")
+        path, packed_message = self.pack(target, *payloads, **kwargs_payloads)
+        if target == self.CAMERA or target == self.CAMERA_IMAGEJPEG:
+            self.logger.info(f"REQ({target}):\nCamera frame: {self.get_payload_length(packed_message)}B")
+        else:
+            if BRANCH_TOKEN:
+                self.logger.info(f"REQ({target}):\n{packed_message.replace(BRANCH_TOKEN, '__hidden__')}")
             else:
-                if BRANCH_TOKEN:
-                    self.logger.info(f"REQ({target}):\n{packed_message.replace(BRANCH_TOKEN, '__hidden__')}")
+                self.logger.info(f"REQ({target}):\n{packed_message}")
+        request = OutboundRequest(self.get_priority(target, *payloads), path, packed_message)
+        # only plain periodic reports replace each other. Errors, events and other requests to server are never dropped
+        if self.COALESCE_REPORTS and request.priority == self.REPORT_PRIORITY and target == self.COMMAND and not kwargs_payloads:
+            request.coalesce_key = target
+        self.enqueue(request)
+        return self.process_outbound_queue(request)
+
+    def get_priority(self, target, *payloads):
+        if target == self.COMMAND:
+            if len(payloads) > 2 and payloads[2]:
+                return self.ACK_PRIORITY
+            return self.REPORT_PRIORITY
+        if target in (self.GET_JOBS, self.START_JOB):
+            return self.JOBS_PRIORITY
+        if target in (self.TOKEN_SEND_LOGS, self.CAMERA, self.CAMERA_IMAGEJPEG):
+            return self.LOGS_PRIORITY
+        return self.REPORT_PRIORITY
+
+    def enqueue(self, request):
+        with self.queue_lock:
+            if request.coalesce_key:
+                for _, _, queued_request in self.outbound_queue:
+                    if queued_request.coalesce_key == request.coalesce_key and not queued_request.finished:
+                        self.logger.info(f"Dropping superseded request to {queued_request.path}")
+                        queued_request.finish(None)
+            heapq.heappush(self.outbound_queue, (request.priority, next(self.outbound_counter), request))
+
+    def process_outbound_queue(self, request):
+        # every caller helps to send the queue in priority order, one attempt at a time,
+        # so retries of a low priority request do not block acks and reports of other callers
+        while not request.finished:
+            with self.lock:
+                if request.finished:
+                    break
+                with self.queue_lock:
+                    queued_request = None
+                    while self.outbound_queue:
+                        _, order, queued_request = heapq.heappop(self.outbound_queue)
+                        if not queued_request.finished:
+                            break
+                        queued_request = None
+                if not queued_request:
+                    break
+                finished, answer = self.send_attempt(queued_request.path, queued_request.data)
+                if finished:
+                    queued_request.finish(answer)
                 else:
-                    self.logger.info(f"REQ({target}):\n{packed_message}")
-            return self.send(path, packed_message)
-
-    def send(self, path, data, headers = None):
-        while not getattr(self.parent, "stop_flag", False) and not getattr(self.parent, "offline_mode", False):
-            if not self.errors_until_reconnect:
-                self.errors_until_reconnect = self.RECONNECT_AFTER_N_ERRORS
-                self.close()
-            if not self.connection:
-                self.connection = self.connect()
-            if self.connection:
-                if self.RESP_TIME_LOGGING:
-                    start_time = time.monotonic()
-                answer = self.request('POST', self.connection, path, data, headers)
-                if self.RESP_TIME_LOGGING:
-                    delta = time.monotonic() - start_time
-                    self.logger.info(f'Request time: {delta:2f}')
-            elif self.exit_on_fail:
+                    with self.queue_lock:
+                        heapq.heappush(self.outbound_queue, (queued_request.priority, order, queued_request))
+        return request.answer
+
+    def send(self, path, data, headers = None, attempts = 0):
+        # attempts == 0 means retry until success, stop or offline mode
+        attempt = 0
+        while True:
+            attempt += 1
+            finished, answer = self.send_attempt(path, data, headers, attempts and attempt >= attempts)
+            if finished:
+                return answer
+            if attempts and attempt >= attempts:
                 return
-            else:
-                answer = None
-            if answer == None or not self.keep_connection_flag:
-                self.close()
-                time.sleep(self.RECONNECTION_ATTEMPT_DELAY) # Some delay before retry reconnection
-            if answer:
-                return self.unpack(answer, path)
+
+    def send_attempt(self, path, data, headers = None, last_attempt = False):
+        if getattr(self.parent, "stop_flag", False) or getattr(self.parent, "offline_mode", False):
+            return True, None
+        if not self.errors_until_reconnect:
+            self.errors_until_reconnect = self.RECONNECT_AFTER_N_ERRORS
+            self.close()
+        if not self.connection:
+            self.connection = self.connect()
+        if self.connection:
+            if self.RESP_TIME_LOGGING:
+                start_time = time.monotonic()
+            answer = self.request('POST', self.connection, path, data, headers)
+            if self.RESP_TIME_LOGGING:
+                delta = time.monotonic() - start_time
+                self.logger.info(f'Request time: {delta:2f}')
+        elif self.exit_on_fail:
+            return True, None
+        else:
+            answer = None
+        if answer == None or not self.keep_connection_flag:
+            self.close()
+            if answer == None and last_attempt:
+                return False, None
+            time.sleep(self.RECONNECTION_ATTEMPT_DELAY) # Some delay before retry reconnection
+        if answer:
+            return True, self.unpack(answer, path)
+        return False, None
 
     def pack(self, target, *args, **kwargs):
         if target == self.USER_LOGIN:
@@ -324,15 +489,39 @@ class HTTPClient:
             message[key] = value
         message.update(kwargs)
         #self.logger.info(f"Message: {target} {message}")
-        return self.API_PREFIX + target, json.dumps(message)
+        return self.API_PREFIX + target, self.dumps(message)
+
+    @classmethod
+    def dumps(cls, message):
+        # base64 camera frame is placed into json as a separate body segment to avoid copying it. Base64 has no
+        # characters to escape in json, so only FRAME_FIELDS are spliced as is. Bytes in other fields are not serializable.
+        if not isinstance(message, dict):
+            return json.dumps(message)
+        binary_fields = [key for key in cls.FRAME_FIELDS if isinstance(message.get(key), (bytes, bytearray, memoryview))]
+        if not binary_fields:
+            return json.dumps(message)
+        text_fields = {key: value for key, value in message.items() if key not in binary_fields}
+        head = json.dumps(text_fields)[:-1]
+        segments = []
+        for key in binary_fields:
+            if text_fields or segments:
+                head += ", "
+            segments.append((head + json.dumps(key) + ': "').encode('utf-8'))
+            segments.append(message[key])
+            head = '"'
+        segments.append((head + '}').encode('utf-8'))
+        return segments
+
+    def get_transfer_stats(self):
+        return {'bytes_sent': self.bytes_sent, 'bytes_copied': self.bytes_copied}
 
     def unpack(self, json_text, path):
         if not json_text:
             self.logger.info("RESP(%s):\n%s", path, json_text)
-        elif len(json_text) > self.MAX_RESP_LEN:
-            self.logger.info("RESP(%s):\n%s", path, json_text[:self.MAX_RESP_LEN] + b"...")
         elif self.hide_sensitive_log and self.IS_LINK_BYTES in json_text:
             self.logger.info("RESP(%s):\n%s", path, '__hidden__')
+        elif len(json_text) > self.MAX_RESP_LEN:
+            self.logger.info("RESP(%s):\n%s", path, json_text[:self.MAX_RESP_LEN] + b"...")
         else:
             self.logger.info("RESP(%s):\n%s", path, json_text)
         try:
@@ -429,9 +618,25 @@ class HTTPClient:
                 self.connection = None
 
 
+class OutboundRequest:
+
+    def __init__(self, priority, path, data):
+        self.priority = priority
+        self.path = path
+        self.data = data
+        self.coalesce_key = None
+        self.finished = False
+        self.answer = None
+
+    def finish(self, answer):
+        self.answer = answer
+        self.finished = True
+
+
 class HTTPClientPrinterAPIV1(HTTPClient):
 
     API_PREFIX = '/apiprinter/v1/printer/'
+    CAMERA_IMAGEJPEG_SUPPORTED = False
     REGISTER = 'register'
     PRINTER_PROFILES = 'get_printer_profiles'
     SEND_LOGS_TOKEN_FIELD_NAME = 'auth_token'
@@ -478,7 +683,7 @@ class HTTPClientPrinterAPIV1(HTTPClient):
            return self.COMMAND, {}
         message.update(kwargs)
         #self.logger.info(f"Message: {target} {message}")
-        return self.API_PREFIX + target, json.dumps(message)
+        return self.API_PREFIX + target, self.dumps(message)
 
 
 # class ProtobufPrinterHTTPClient(HTTPClient, protobuf_protocol.ProtobufProtocol):
@@ -0,0 +1,120 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Downloads the file of the next queued job into the download cache while the current job prints,
+# so when the queue autostarts it, the downloader finds the file in the cache and skips the network.
+# A queued job carries its file as the gcodes command does: a link in payload, marked by is_link.
+
+import hashlib
+import os
+import tempfile
+import threading
+import zlib
+
+import certifi
+
+import bandwidth
+import config
+import dns_cache
+import download_cache
+import log
+
+
+class JobPrefetcher(threading.Thread):
+
+    ENABLED = config.get_settings().get('downloader', {}).get('prefetch', False)
+    CHECK_PERIOD = config.get_settings().get('downloader', {}).get('prefetch_period', 60)
+    CONNECTION_TIMEOUT = 6
+    CHUNK_SIZE = 128*1024
+
+    @classmethod
+    def is_enabled(cls):
+        return cls.ENABLED and download_cache.DownloadCache.ENABLED and config.get_settings().get('autostart_queue')
+
+    def __init__(self, parent, prefetched_job_ids):
+        self.logger = parent.logger.getChild(self.__class__.__name__)
+        self.parent = parent
+        self.prefetched_job_ids = prefetched_job_ids
+        self.cache = download_cache.DownloadCache.instance()
+        threading.Thread.__init__(self, name="JobPrefetcher", daemon=True)
+
+    def is_stopped(self):
+        # a real download takes precedence, even if it is a download of the same file
+        downloader = self.parent.downloader
+        return self.parent.stop_flag or bool(downloader and downloader.is_alive())
+
+    @staticmethod
+    def get_link(job):
+        link = job.get('payload')
+        if job.get('is_link') and isinstance(link, str) and link.startswith(('http://', 'https://')):
+            return link
+
+    @log.log_exception
+    def run(self):
+        jobs_list, error = self.parent.get_jobs_list(quiet=True)
+        if error or not jobs_list or not isinstance(jobs_list[0], dict):
+            return
+        job = jobs_list[0]
+        job_id = job.get('id')
+        if not job_id or job_id in self.prefetched_job_ids:
+            return
+        link = self.get_link(job)
+        if not link:
+            # fields are logged without values, since links could be sensitive
+            self.logger.warning(f'Queued job {job_id} has no recognisable download link. Job fields: {sorted(job)}')
+            self.prefetched_job_ids.add(job_id)
+            return
+        file_info = dict(job, job_id=job_id)
+        keys = self.cache.form_keys(file_info)
+        if keys and self.cache.lookup(keys):
+            self.prefetched_job_ids.add(job_id)
+            return
+        self.logger.info(f'Prefetching file of the next queued job {job_id}')
+        if self.prefetch(link, file_info):
+            self.prefetched_job_ids.add(job_id)
+
+    def prefetch(self, link, file_info):
+        session = dns_cache.requests_session()
+        path = None
+        try:
+            sha256 = hashlib.sha256()
+            crc32 = 0
+            with tempfile.NamedTemporaryFile('wb', dir=self.cache.folder, delete=False, suffix='.tmp') as f:
+                path = f.name
+                with session.get(link, stream=True, timeout=self.CONNECTION_TIMEOUT, verify=certifi.where()) as response:
+                    if not response.ok:
+                        self.logger.warning(f'Prefetch failed with HTTP status {response.status_code}')
+                        return False
+                    for chunk in response.iter_content(self.CHUNK_SIZE):
+                        if self.is_stopped() or not bandwidth.acquire(bandwidth.PREFETCH, len(chunk), self.is_stopped):
+                            self.logger.info('Prefetch interrupted')
+                            return False
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        crc32 = zlib.crc32(chunk, crc32)
+            file_hash = sha256.hexdigest()
+            expected_hash = file_info.get('sha256')
+            if expected_hash and str(expected_hash).lower() != file_hash:
+                self.logger.warning('Prefetched file sha256 mismatch')
+                return False
+            self.cache.store(path, self.cache.form_keys(file_info, os.path.getsize(path)), file_hash, crc32)
+            return True
+        except Exception as e:
+            self.logger.warning('Prefetch error: ' + str(e))
+            return False
+        finally:
+            session.close()
+            if path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -30,6 +30,7 @@ from paths import CURRENT_SETTINGS_FOLDER
 
 try:
     import requests
+    import urllib3
 except ImportError: # to prevent a crash due to requests importing pycache with import simplejson in it
     print("Exception on import of module requests:")
     print(sys.exc_info())
@@ -37,6 +38,7 @@ except ImportError: # to prevent a crash due to requests importing pycache with
     paths.cleanup_caches()
     sys.exit(1) #dont try to reimport requests
 
+import bandwidth
 import http_client
 import config
 import version
@@ -252,7 +254,15 @@ def upload_compressed_logs(zip_file_path, token=None):
             if os.path.isfile(DETECTION_REPORT_FILE):
                 integration_file = open(DETECTION_REPORT_FILE, 'rb')
                 files['integration_request_file'] = integration_file
-            response = requests.post(url, data=data, files=files)
+            if bandwidth.is_enabled():
+                # requests reads the whole multipart body into memory anyway, so it is encoded here to be paced by bandwidth manager
+                fields = {name: value for name, value in data.items() if value is not None}
+                for name, f in files.items():
+                    fields[name] = (os.path.basename(f.name), f.read())
+                body, content_type = urllib3.encode_multipart_formdata(fields)
+                response = requests.post(url, data=bandwidth.ThrottledReader(body, bandwidth.LOGS), headers={'Content-Type': content_type})
+            else:
+                response = requests.post(url, data=data, files=files)
     except Exception as e:
         return 'Error while sending logs: ' + str(e)
     else:
@@ -17,9 +17,10 @@ import os
 import time
 import pprint
 
+import gcodes_decompressor
 from base_sender import BaseSender
 from octoprint.filemanager import FileDestinations
-from octoprint.filemanager.util import DiskFileWrapper
+from octoprint.filemanager.util import DiskFileWrapper, StreamWrapper
 
 
 class Sender(BaseSender):
@@ -44,25 +45,75 @@ class Sender(BaseSender):
         self.file_pos = 0
         self.remove_print_file()
 
-    def gcodes(self, path):
+    def gcodes(self, path, keep_file=False, start_line=0):
         if not self.is_operational():
             self.parent.register_error(604, "Printer is not ready.", is_blocking=False)
         elif self.is_printing():
             self.parent.register_error(604, "Printer already printing.", is_blocking=False)
             return False
+        elif start_line and str(path).endswith(".zip"):
+            self.parent.register_error(85, "Print from a line is not supported for zip files. Cancelling...", is_blocking=False)
+            return False
         else:
             self.percent = 0.0
+            self.stop_gcodes_analysis() # of the previous file
             octo_path = self.file_manager.add_folder(FileDestinations.LOCAL, self.FOLDER_NAME, ignore_existing=True)
             octo_path = self.file_manager.join_path(FileDestinations.LOCAL, octo_path, self.FILE_NAME)
-            path = self.file_manager.add_file(FileDestinations.LOCAL, octo_path, DiskFileWrapper(os.path.split(path)[-1], path, move=True), allow_overwrite=True, analysis={})
-            if not path:
-                self.parent.register_error(604, "Some error on file upload to OctoPrint", is_blocking=True)
-                return False
-            self.logger.info("File transfer to printer successful")
-            path = self.file_manager.path_on_disk(FileDestinations.LOCAL, path)
-            self.octo_printer.select_file(path, False, printAfterSelect=True)
-            self.logger.info("File was selected and print was started")
-            return True
+            source_path = path
+            compression = self.get_file_compression(path)
+            # kept file stays where it is, so the print could be resumed from a line of it later
+            keep = self.keep_print_files or keep_file
+            try:
+                if start_line:
+                    # only lines from start_line are passed to OctoPrint storage
+                    try:
+                        f = self.open_gcodes_file_at_line(path, start_line)
+                    except gcodes_decompressor.ERRORS as e:
+                        self.logger.warning(f'Unable to open gcodes file {path} at line {start_line}: {e}')
+                        self.parent.register_error(85, "File loading error. Cancelling...", is_blocking=True)
+                        return False
+                    if not f:
+                        self.parent.register_error(85, f"Line {start_line} to start print from is out of file. Cancelling...", is_blocking=False)
+                        return False
+                    self.logger.info(f'Printing from line {start_line}')
+                    with f:
+                        path = self.file_manager.add_file(FileDestinations.LOCAL, octo_path, StreamWrapper(self.FILE_NAME, f), allow_overwrite=True, analysis={})
+                elif compression:
+                    # compressed or binary gcodes are decoded straight into the file of OctoPrint storage
+                    try:
+                        with gcodes_decompressor.open_file(path) as f:
+                            octo_path = self.file_manager.add_file(FileDestinations.LOCAL, octo_path, StreamWrapper(self.FILE_NAME, f), allow_overwrite=True, analysis={})
+                    except gcodes_decompressor.ERRORS as e:
+                        self.logger.warning('Decompression error: ' + str(e))
+                        self.parent.register_error(87, "Decompression error. Cancelling...", is_blocking=True)
+                        return False
+                    path = octo_path
+                else:
+                    path = self.file_manager.add_file(FileDestinations.LOCAL, octo_path, DiskFileWrapper(os.path.split(path)[-1], path, move=not keep), allow_overwrite=True, analysis={})
+                if not path:
+                    self.parent.register_error(604, "Some error on file upload to OctoPrint", is_blocking=True)
+                    return False
+                self.logger.info("File transfer to printer successful")
+                path = self.file_manager.path_on_disk(FileDestinations.LOCAL, path)
+                self.octo_printer.select_file(path, False, printAfterSelect=True)
+                self.logger.info("File was selected and print was started")
+                if keep and not str(source_path).endswith(".zip"):
+                    self.kept_print_file = os.fspath(source_path)
+                    if self.LINE_OFFSET_INDEX and not start_line and not compression:
+                        try:
+                            self.build_line_index(self.kept_print_file)
+                        except gcodes_decompressor.ERRORS as e:
+                            self.logger.warning('Unable to index lines of kept print file: ' + str(e))
+                if not start_line:
+                    # analysis of a compressed file reads the original one, so estimations from bgcode metadata are not lost
+                    self.start_gcodes_analysis(source_path if compression else path)
+                return True
+            finally:
+                if compression and not keep:
+                    try:
+                        os.remove(source_path)
+                    except OSError:
+                        pass
 
     def unbuffered_gcodes(self, gcodes):
         self.logger.info("Gcodes to send now: " + str(gcodes))
@@ -25,6 +25,8 @@ APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
 SETTINGS_NAME = '.3dprinteros'
 STORAGE_NAME = 'user_files'
 DOWNLOAD_NAME = 'downloads'
+DOWNLOAD_CACHE_NAME = 'download_cache'
+PARTIAL_DOWNLOADS_NAME = 'partial_downloads'
 PRINTER_SETTINGS_NAME = 'printer_settings'
 SIZE_UNITS = ['B', 'kB', 'MB', 'GB']
 SIZE_OUTPUT_TEMPLATE = "%.1f%s"
@@ -73,7 +75,7 @@ if not custom_dir:
                 pass
 
 CURRENT_SETTINGS_FOLDER = init_folder(SETTINGS_NAME, custom_dir)
-for folder in (STORAGE_NAME, DOWNLOAD_NAME):
+for folder in (STORAGE_NAME, DOWNLOAD_NAME, PARTIAL_DOWNLOADS_NAME):
     init_folder(folder, CURRENT_SETTINGS_FOLDER)
 
 
@@ -81,12 +83,15 @@ UPDATE_FILE_PATH = os.path.join(CURRENT_SETTINGS_FOLDER, '3dprinteros_client_upd
 PLUGIN_INSTALL_FILE_PATH = os.path.join(CURRENT_SETTINGS_FOLDER, "plugin_to_install.zip")
 STORAGE_FOLDER = os.path.join(CURRENT_SETTINGS_FOLDER, STORAGE_NAME)
 DOWNLOAD_FOLDER = os.path.join(CURRENT_SETTINGS_FOLDER, DOWNLOAD_NAME)
+DOWNLOAD_CACHE_FOLDER = os.path.join(CURRENT_SETTINGS_FOLDER, DOWNLOAD_CACHE_NAME)
+PARTIAL_DOWNLOADS_FOLDER = os.path.join(CURRENT_SETTINGS_FOLDER, PARTIAL_DOWNLOADS_NAME)
 PRINTER_SETTINGS_FOLDER = os.path.join(CURRENT_SETTINGS_FOLDER, PRINTER_SETTINGS_NAME)
 AUDIO_FILES_FOLDER = os.path.join(APP_FOLDER, 'audio_files')
 OFFLINE_PRINTER_TYPE_FOLDER_PATH = os.path.join(CURRENT_SETTINGS_FOLDER, 'offline_printer_types')
 RELEASE_NOTES_FILE_PATH = os.path.join(APP_FOLDER, 'release_notes.txt')
 REQUEST_DUMPING_DIR = os.path.join(CURRENT_SETTINGS_FOLDER, 'request_dump')
 CAMERA_URLS_FILE = os.path.join(CURRENT_SETTINGS_FOLDER, "camera_urls.txt")
+BANDWIDTH_STATE_FOLDER = os.path.join(CURRENT_SETTINGS_FOLDER, "bandwidth")
 UPDATE_FILE_NAME = '3dprinteros_client_update.zip'
 UPDATE_FILE_PATH = os.path.join(CURRENT_SETTINGS_FOLDER, UPDATE_FILE_NAME)
 CUSTOM_CACERT_PATH = os.path.join(CURRENT_SETTINGS_FOLDER, 'custom_ca.pem')
@@ -30,6 +30,7 @@ import config
 import downloader
 import forced_settings
 import http_client
+import job_prefetcher
 import log
 import printer_settings_and_id
 import printer_states
@@ -65,6 +66,9 @@ class PrinterInterface(threading.Thread):
         self.logger.info("Server connection class: " + self.server_connection_class.__name__)
         self.sender = None
         self.downloader = None
+        self.prefetcher = None
+        self.prefetched_job_ids = set()
+        self.last_prefetch_check_time = time.monotonic()
         self.forced_state = "connecting"
         self.printer_token = None
         self.printer_name = ""
@@ -470,6 +474,7 @@ class PrinterInterface(threading.Thread):
                 else:
                     kw_message_prev = copy.deepcopy(kw_message)
             self._check_operational_status()
+            self._check_prefetch()
             sleep_time = loop_start_time - time.monotonic() + self.command_request_period
             if sleep_time > 0:
                 steps_left = self.LOOP_SLEEP_STEPS
@@ -614,7 +619,7 @@ class PrinterInterface(threading.Thread):
                             print_time = server_message.get('printing_duration', 0)
                         self.sender.set_estimated_print_time(print_time)
                     self.downloader = downloader.Downloader(self, server_message.get('payload'), method,\
-                                                            is_zip=bool(server_message.get('zip')))
+                                                            is_zip=bool(server_message.get('zip')), file_info=server_message)
                     self.downloader.start()
                     result = True
             else:
@@ -648,7 +653,7 @@ class PrinterInterface(threading.Thread):
             state = printer_states.CONNECTING_STATE
         elif self.sender.is_paused():
             state = printer_states.PAUSED_STATE
-        elif self.downloader and self.downloader.is_alive() or self.sender.upload_in_progress:
+        elif self.downloader and self.downloader.is_alive() and not self.downloader.stream_started or self.sender.upload_in_progress:
             state = printer_states.DOWNLOADING_STATE
             if getattr(forced_settings, "HIDE_DOWNLOAD_STATUS", False):
                 state = printer_states.PRINTING_STATE
@@ -669,7 +674,7 @@ class PrinterInterface(threading.Thread):
         report = {"state": self.get_printer_state()}
         if self.sender:
             try:
-                if self.is_downloading() and not getattr(forced_settings, "HIDE_DOWNLOAD_STATUS", False):
+                if self.is_downloading() and not self.downloader.stream_started and not getattr(forced_settings, "HIDE_DOWNLOAD_STATUS", False):
                     report["percent"] = self.sender.get_downloading_percent()
                 else:
                     report["percent"] = self.sender.get_percent()
@@ -1036,14 +1041,24 @@ class PrinterInterface(threading.Thread):
                         self.connection_id = conn.get('id')
                         self.connection_profile = conn
 
-    def get_jobs_list(self) -> typing.Union[typing.List[dict], typing.Tuple[list, dict]]:
-        self.logger.info("Requesting a jobs list")
+    def get_jobs_list(self, quiet: bool = False) -> typing.Union[typing.List[dict], typing.Tuple[list, dict]]:
+        # quiet is for periodic requests, such as the ones of the prefetcher, which should not flood the log
+        log_level = logging.DEBUG if quiet else logging.INFO
+        self.logger.log(log_level, "Requesting a jobs list")
         if self.server_connection:
             jobs_list = self.server_connection.get_jobs_list(self.printer_token)
-            self.logger.info("Cloud's jobs list:\n" + pprint.pformat(jobs_list))
+            if self.logger.isEnabledFor(log_level):
+                self.logger.log(log_level, "Cloud's jobs list:\n" + pprint.pformat(self.hide_jobs_links(jobs_list)))
             return jobs_list
         return [], {"message": "No connection to server", "code": 9}
 
+    @staticmethod
+    def hide_jobs_links(jobs_list: typing.Any) -> typing.Any:
+        if not config.get_settings().get('hide_sensitive_log') or not isinstance(jobs_list, tuple) or not jobs_list:
+            return jobs_list
+        jobs = [dict(job, payload='__hidden__') if isinstance(job, dict) and job.get('is_link') else job for job in jobs_list[0]]
+        return (jobs,) + jobs_list[1:]
+
     def start_job_by_id(self, job_id: str) -> bool:
         if self.server_connection:
             self.logger.info(f"Sending a request to start a job {job_id}")
@@ -1137,6 +1152,19 @@ class PrinterInterface(threading.Thread):
                 self.local_mode = False
                 self.local_mode_timeout_thread = None
 
+    def _check_prefetch(self) -> None:
+        if self.offline_mode or not job_prefetcher.JobPrefetcher.is_enabled():
+            return
+        if self.prefetcher and self.prefetcher.is_alive():
+            return
+        if not self.sender or not self.sender.is_printing() or (self.downloader and self.downloader.is_alive()):
+            return
+        now = time.monotonic()
+        if now - self.last_prefetch_check_time > job_prefetcher.JobPrefetcher.CHECK_PERIOD:
+            self.last_prefetch_check_time = now
+            self.prefetcher = job_prefetcher.JobPrefetcher(self, self.prefetched_job_ids)
+            self.prefetcher.start()
+
     def _set_cloud_job_id_and_snr(self, server_message: dict) -> None:
         if server_message:
             clouds_job_id = server_message.get('job_id')
@@ -0,0 +1,112 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Pool of processes for CPU heavy work on large gcodes files, such as cleaning and analysis of chunks.
+# Work in other processes does not hold the GIL of the client, so loops of other printers are not stalled by it.
+# Functions, which run in the pool, should be in modules without heavy imports, because the spawned processes import them.
+# One pool is created on the first use and is shared by all the printers, so processes are spawned only once.
+
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+import threading
+
+import config
+
+SETTINGS = config.get_settings().get('process_pool', {})
+ENABLED = SETTINGS.get('enabled', False)
+PROCESSES = SETTINGS.get('processes', 0) # 0 is all CPUs but one, which is left for printing
+MP_CONTEXT = SETTINGS.get('mp_context', 'spawn')
+MIN_SIZE = SETTINGS.get('min_size_mb', 32) * 1024 * 1024 # smaller files are processed faster than the pool starts
+CHUNK_SIZE = SETTINGS.get('chunk_size_kb', 4096) * 1024
+
+executor = None
+executor_processes = 0
+executor_lock = threading.Lock()
+
+
+class Stopped(Exception):
+    # raised by map_ordered on stop, so results, which were yielded before it, are not taken for complete ones
+    pass
+
+
+def get_processes_count():
+    return PROCESSES or max(1, (os.cpu_count() or 1) - 1)
+
+
+def is_worth_using(size, min_size=None):
+    if min_size is None:
+        min_size = MIN_SIZE
+    return ENABLED and size >= min_size and get_processes_count() > 1
+
+
+def get_executor():
+    global executor, executor_processes
+    with executor_lock:
+        processes = get_processes_count()
+        if executor and executor_processes != processes:
+            shutdown_executor(executor)
+            executor = None
+        if not executor:
+            executor = concurrent.futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context(MP_CONTEXT))
+            executor_processes = processes
+        return executor
+
+
+def discard_executor(broken_executor):
+    # a pool, which lost a process, could not run anything, so the next use creates a new one
+    global executor
+    with executor_lock:
+        if executor is broken_executor:
+            executor = None
+    shutdown_executor(broken_executor)
+
+
+def shutdown():
+    global executor
+    with executor_lock:
+        if executor:
+            shutdown_executor(executor)
+            executor = None
+
+
+def shutdown_executor(executor_to_shutdown):
+    if sys.version_info >= (3, 9):
+        executor_to_shutdown.shutdown(wait=False, cancel_futures=True)
+    else: # no cancel_futures before 3.9, but pending calls of map_ordered are cancelled by it anyway
+        executor_to_shutdown.shutdown(wait=False)
+
+
+def map_ordered(executor, function, arguments_iterable, stop_check=None):
+    # yields results of function for each tuple of arguments in order of the iterable. Number of submitted, but
+    # not yet consumed calls is limited, so a large file is not read in memory at once. Raises Stopped on stop.
+    futures = collections.deque()
+    max_pending = get_processes_count() * 2
+    try:
+        for arguments in arguments_iterable:
+            if stop_check and stop_check():
+                raise Stopped()
+            futures.append(executor.submit(function, *arguments))
+            while futures and (len(futures) > max_pending or futures[0].done()):
+                yield futures.popleft().result()
+        while futures:
+            if stop_check and stop_check():
+                raise Stopped()
+            yield futures.popleft().result()
+    except concurrent.futures.process.BrokenProcessPool:
+        discard_executor(executor)
+        raise
+    finally:
+        for future in futures:
+            future.cancel()
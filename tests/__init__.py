@@ -0,0 +1,31 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Client modules are imported flat, as the client does it. Importing of them creates settings files in the home
+# folder, so tests use a temporary one.
+# Usage: python -m pytest tests
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+TESTS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_FOLDER = os.path.join(os.path.dirname(TESTS_FOLDER), 'octoprint_3dprinteros')
+
+HOME = tempfile.mkdtemp(prefix='3dprinteros-tests-')
+os.environ['HOME'] = HOME
+os.environ['APPDATA'] = HOME
+atexit.register(shutil.rmtree, HOME, True)
+if PACKAGE_FOLDER not in sys.path:
+    sys.path.insert(0, PACKAGE_FOLDER)
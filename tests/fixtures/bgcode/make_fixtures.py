@@ -0,0 +1,136 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+# Writes bgcode fixtures of source.gcode for each compression and gcode encoding, in layout of libbgcode format version 1.
+# It does not use bgcode_decoder, so the decoder is not tested against itself. Heatshrink blocks are compressed by
+# the reference heatshrink implementation of heatshrink2 module, which is needed only to regenerate the fixtures:
+#     python make_fixtures.py
+
+import os
+import struct
+import zlib
+
+import heatshrink2
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+GCODE_BLOCK_SIZE = 1024 # small, so each fixture has several gcode blocks
+
+COMPRESSIONS = {'none': 0, 'deflate': 1, 'heatshrink_11_4': 2, 'heatshrink_12_4': 3}
+ENCODINGS = {'none': 0, 'meatpack': 1, 'meatpack_comments': 2}
+
+METADATA = [
+    (0, b"Producer=make_fixtures.py\n"), # file
+    (3, b"printer_model=MK4\nfilament_diameter=1.75\n"), # printer
+    (4, b"filament used [mm]=123.45\nfilament used [g]=0.37\nestimated printing time (normal mode)=1h 2m 3s\ntotal layers count=2\n"), # print
+    (2, b"layer_height=0.2\n"), # slicer
+]
+THUMBNAIL = (0, 16, 16) # png format, width, height
+THUMBNAIL_DATA = b"\x89PNG\r\n\x1a\n" + bytes(range(64))
+
+MEATPACK_CHARS = "0123456789. \nGX"
+MEATPACK_SIGNAL = b"\xff\xff"
+MEATPACK_ENABLE_PACKING = 251
+MEATPACK_ENABLE_NO_SPACES = 247
+
+
+def compress(data, compression):
+    if compression == 1:
+        return zlib.compress(data)
+    if compression == 2:
+        return heatshrink2.compress(data, window_sz2=11, lookahead_sz2=4)
+    if compression == 3:
+        return heatshrink2.compress(data, window_sz2=12, lookahead_sz2=4)
+    return data
+
+
+def block(block_type, compression, data, parameters):
+    compressed = compress(data, compression)
+    header = struct.pack("<HHI", block_type, compression, len(data))
+    if compression:
+        header += struct.pack("<I", len(compressed))
+    body = header + parameters + compressed
+    return body + struct.pack("<I", zlib.crc32(body))
+
+
+def strip_line(line, keep_comments):
+    # no spaces mode omits spaces in code of G lines. Comments are dropped, unless they are kept.
+    code, sep, comment = line.partition(";")
+    if line.startswith("G"):
+        code = code.replace(" ", "")
+    if not keep_comments:
+        return code.rstrip()
+    return code + sep + comment
+
+
+def meatpack_encode(text, keep_comments):
+    # packs two characters of MEATPACK_CHARS in a byte, low half first. 0b1111 is a half of a character, which follows
+    # the byte in full. In no spaces mode 'E' is packed in place of space. Half after newline is not decoded.
+    chars = MEATPACK_CHARS.replace(" ", "E")
+    lines = (strip_line(line, keep_comments) for line in text.split("\n")[:-1])
+    text = "".join(line + "\n" for line in lines if line)
+    out = bytearray(MEATPACK_SIGNAL + bytes([MEATPACK_ENABLE_PACKING]) + MEATPACK_SIGNAL + bytes([MEATPACK_ENABLE_NO_SPACES]))
+    position = 0
+    while position < len(text):
+        first = text[position]
+        second = text[position + 1] if first != "\n" and position + 1 < len(text) else None
+        position += 1 if second is None else 2
+        halves = []
+        full = b""
+        for char in (first, second):
+            if char is None:
+                halves.append(0)
+            elif char in chars:
+                halves.append(chars.index(char))
+            else:
+                halves.append(0xf)
+                full += char.encode()
+        out.append(halves[1] << 4 | halves[0])
+        out += full
+    return bytes(out)
+
+
+def iterate_gcode_blocks(text):
+    start = 0
+    while start < len(text):
+        end = text.rfind("\n", start, start + GCODE_BLOCK_SIZE) + 1 or len(text)
+        yield text[start:end]
+        start = end
+
+
+def make_fixture(text, compression, encoding):
+    out = struct.pack("<4sIH", b"GCDE", 1, 1)
+    for block_type, data in METADATA[:2]:
+        out += block(block_type, compression, data, struct.pack("<H", 0))
+    out += block(5, 0, THUMBNAIL_DATA, struct.pack("<HHH", *THUMBNAIL))
+    for block_type, data in METADATA[2:]:
+        out += block(block_type, compression, data, struct.pack("<H", 0))
+    for gcodes in iterate_gcode_blocks(text):
+        if encoding:
+            data = meatpack_encode(gcodes, encoding == 2)
+        else:
+            data = gcodes.encode()
+        out += block(1, compression, data, struct.pack("<H", encoding))
+    return out
+
+
+def main():
+    with open(os.path.join(FOLDER, "source.gcode"), newline="\n") as f:
+        text = f.read()
+    for compression_name, compression in COMPRESSIONS.items():
+        for encoding_name, encoding in ENCODINGS.items():
+            path = os.path.join(FOLDER, f"{compression_name}-{encoding_name}.bgcode")
+            with open(path, "wb") as f:
+                f.write(make_fixture(text, compression, encoding))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+; generated for bgcode decoder tests
+M73 P0 R12
+M104 S215 ; set temperature
+M140 S60
+G28 W; home all without mesh bed level
+G90
+M83
+G92 E0
+M117 Printing layer 1 of 2
+G1 Z0.2 F720
+G1 X10 Y10 E0.5 F1800;prime line to EXTRUDE at X
+;LAYER_CHANGE
+;Z:0.2
+G1 Z0.2 F720
+G1 X20.0 Y20.0 E0.03000
+G1 X27.1 Y33.3 E0.04000
+G1 X34.2 Y46.6 E0.05000
+G1 X41.3 Y59.9 E0.06000
+G1 X48.4 Y22.2 E0.07000
+G1 X55.5 Y35.5 E0.03000
+G1 X62.6 Y48.8 E0.04000
+G1 X69.7 Y61.1 E0.05000
+G1 X26.8 Y24.4 E0.06000
+G1 X33.9 Y37.7 E0.07000
+G1 X40.0 Y50.0 E0.03000
+G1 X47.1 Y63.3 E0.04000
+G1 X54.2 Y26.6 E0.05000
+G1 X61.3 Y39.9 E0.06000
+G1 X68.4 Y52.2 E0.07000
+G1 X25.5 Y65.5 E0.03000
+G1 X32.6 Y28.8 E0.04000
+G1 X39.7 Y41.1 E0.05000
+G1 X46.8 Y54.4 E0.06000
+G1 X53.9 Y67.7 E0.07000
+G1 X60.0 Y30.0 E0.03000
+G1 X67.1 Y43.3 E0.04000
+G1 X24.2 Y56.6 E0.05000
+G1 X31.3 Y69.9 E0.06000
+G1 X38.4 Y32.2 E0.07000
+G1 X45.5 Y45.5 E0.03000
+G1 X52.6 Y58.8 E0.04000
+G1 X59.7 Y21.1 E0.05000
+G1 X66.8 Y34.4 E0.06000
+G1 X23.9 Y47.7 E0.07000
+G1 X30.0 Y60.0 E0.03000
+G1 X37.1 Y23.3 E0.04000
+G1 X44.2 Y36.6 E0.05000
+G1 X51.3 Y49.9 E0.06000
+G1 X58.4 Y62.2 E0.07000
+G1 X65.5 Y25.5 E0.03000
+G1 X22.6 Y38.8 E0.04000
+G1 X29.7 Y51.1 E0.05000
+G1 X36.8 Y64.4 E0.06000
+G1 X43.9 Y27.7 E0.07000
+G2 X30 Y30 I5 J5 E1.2
+G1 E-0.8 F2100;retract
+;LAYER_CHANGE
+;Z:0.4
+G1 Z0.4 F720
+G1 X20.0 Y20.0 E0.03000
+G1 X27.1 Y33.3 E0.04000
+G1 X34.2 Y46.6 E0.05000
+G1 X41.3 Y59.9 E0.06000
+G1 X48.4 Y22.2 E0.07000
+G1 X55.5 Y35.5 E0.03000
+G1 X62.6 Y48.8 E0.04000
+G1 X69.7 Y61.1 E0.05000
+G1 X26.8 Y24.4 E0.06000
+G1 X33.9 Y37.7 E0.07000
+G1 X40.0 Y50.0 E0.03000
+G1 X47.1 Y63.3 E0.04000
+G1 X54.2 Y26.6 E0.05000
+G1 X61.3 Y39.9 E0.06000
+G1 X68.4 Y52.2 E0.07000
+G1 X25.5 Y65.5 E0.03000
+G1 X32.6 Y28.8 E0.04000
+G1 X39.7 Y41.1 E0.05000
+G1 X46.8 Y54.4 E0.06000
+G1 X53.9 Y67.7 E0.07000
+G1 X60.0 Y30.0 E0.03000
+G1 X67.1 Y43.3 E0.04000
+G1 X24.2 Y56.6 E0.05000
+G1 X31.3 Y69.9 E0.06000
+G1 X38.4 Y32.2 E0.07000
+G1 X45.5 Y45.5 E0.03000
+G1 X52.6 Y58.8 E0.04000
+G1 X59.7 Y21.1 E0.05000
+G1 X66.8 Y34.4 E0.06000
+G1 X23.9 Y47.7 E0.07000
+G1 X30.0 Y60.0 E0.03000
+G1 X37.1 Y23.3 E0.04000
+G1 X44.2 Y36.6 E0.05000
+G1 X51.3 Y49.9 E0.06000
+G1 X58.4 Y62.2 E0.07000
+G1 X65.5 Y25.5 E0.03000
+G1 X22.6 Y38.8 E0.04000
+G1 X29.7 Y51.1 E0.05000
+G1 X36.8 Y64.4 E0.06000
+G1 X43.9 Y27.7 E0.07000
+G2 X30 Y30 I5 J5 E1.2
+G1 E-0.8 F2100;retract
+M107
+G1 Z10 F720
+M104 S0
+M140 S0
+M84
@@ -0,0 +1,103 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+import io
+import os
+import unittest
+import unittest.mock
+
+import tests
+
+import bgcode_decoder
+
+FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'bgcode')
+COMPRESSIONS = ('none', 'deflate', 'heatshrink_11_4', 'heatshrink_12_4')
+ENCODINGS = ('none', 'meatpack', 'meatpack_comments')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_FOLDER, name), 'rb') as f:
+        return f.read()
+
+
+def strip_comments(text):
+    # meatpack encoding without comments drops them and lines, which are left empty
+    lines = (line.partition(b";")[0].rstrip() for line in text.split(b"\n"))
+    return b"".join(line + b"\n" for line in lines if line)
+
+
+# pure python heatshrink decompression is tested, even when heatshrink2 is installed
+@unittest.mock.patch.object(bgcode_decoder, 'heatshrink2', None)
+class BgcodeReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.source = read_fixture('source.gcode')
+
+    def get_expected(self, encoding):
+        if encoding == 'meatpack':
+            return strip_comments(self.source)
+        return self.source
+
+    def test_decode(self):
+        for compression in COMPRESSIONS:
+            for encoding in ENCODINGS:
+                with self.subTest(compression=compression, encoding=encoding):
+                    data = read_fixture(f'{compression}-{encoding}.bgcode')
+                    with bgcode_decoder.BgcodeReader(io.BytesIO(data)) as f:
+                        self.assertEqual(f.read(), self.get_expected(encoding))
+                        metadata = f.metadata
+                    self.assertEqual(metadata['printer']['printer_model'], 'MK4')
+                    analysis = bgcode_decoder.get_analysis(metadata)
+                    self.assertEqual(analysis['estimated_time'], 3723)
+                    self.assertEqual(analysis['layers'], 2)
+                    self.assertEqual(analysis['filament_lengths'], [123.45])
+                    content_size = bgcode_decoder.get_content_size(io.BytesIO(data))
+                    if encoding == 'none':
+                        self.assertEqual(content_size, len(self.source))
+                    else:
+                        self.assertGreaterEqual(content_size, len(self.get_expected(encoding)))
+
+    def test_readline_and_seek(self):
+        with bgcode_decoder.BgcodeReader(io.BytesIO(read_fixture('heatshrink_12_4-meatpack_comments.bgcode'))) as f:
+            lines = list(iter(f.readline, b""))
+            self.assertEqual(b"".join(lines), self.source)
+        with bgcode_decoder.BgcodeReader(io.BytesIO(read_fixture('deflate-none.bgcode'))) as f:
+            offset = len(self.source) // 2
+            self.assertEqual(f.seek(offset), offset)
+            self.assertEqual(f.read(), self.source[offset:])
+
+    def test_read_metadata(self):
+        metadata = bgcode_decoder.read_metadata(io.BytesIO(read_fixture('deflate-meatpack.bgcode')))
+        self.assertEqual(metadata['file']['Producer'], 'make_fixtures.py')
+        self.assertEqual(metadata['slicer']['layer_height'], '0.2')
+
+    def test_corrupted_checksum(self):
+        data = bytearray(read_fixture('heatshrink_11_4-meatpack.bgcode'))
+        data[-10] ^= 0x01 # in the last gcode block
+        with bgcode_decoder.BgcodeReader(io.BytesIO(bytes(data))) as f:
+            with self.assertRaisesRegex(bgcode_decoder.BgcodeError, 'checksum mismatch'):
+                f.read()
+
+    def test_truncated(self):
+        data = read_fixture('deflate-none.bgcode')[:-100]
+        with bgcode_decoder.BgcodeReader(io.BytesIO(data)) as f:
+            with self.assertRaises(bgcode_decoder.BgcodeError):
+                f.read()
+
+    def test_respace_keeps_comments(self):
+        text = b"G1X1Y2E0.5;move to EXTRUDE at X\nM117 Layer X\n;G1X2\nG92E0\n"
+        self.assertEqual(bgcode_decoder.respace_g_lines(text),
+                         b"G1 X1 Y2 E0.5;move to EXTRUDE at X\nM117 Layer X\n;G1X2\nG92 E0\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+import unittest
+import unittest.mock
+
+import tests
+
+import gcodes_buffer
+import gcodes_cleaner
+
+
+def make_lines(count, start=0):
+    return [b"G1 X%d Y%d E%d.12345" % (number, number * 2, number * 3) for number in range(start, start + count)]
+
+
+# offsets of 16 bits overflow at 64KB instead of 4GB, so the widening of offsets is tested without 4GB of lines
+@unittest.mock.patch.object(gcodes_buffer.PackedGcodesBuffer, 'OFFSET_TYPECODE', 'H')
+@unittest.mock.patch.object(gcodes_buffer.PackedGcodesBuffer, 'WIDE_OFFSETS_MIN', 1 << 16)
+class OffsetsOverflowTest(unittest.TestCase):
+
+    LINES_COUNT = 10000 # about 250KB of lines
+
+    def test_append(self):
+        lines = make_lines(self.LINES_COUNT)
+        buffer = gcodes_buffer.PackedGcodesBuffer()
+        for line in lines:
+            buffer.append(line)
+        self.assertEqual(buffer.ends.typecode, 'Q')
+        self.assertEqual(list(buffer), lines)
+
+    def test_extend(self):
+        lines = make_lines(self.LINES_COUNT)
+        buffer = gcodes_buffer.PackedGcodesBuffer(lines[:100])
+        self.assertEqual(buffer.ends.typecode, 'H')
+        buffer.extend(lines[100:])
+        self.assertEqual(list(buffer), lines)
+
+    def test_extend_packed_and_compact(self):
+        lines = make_lines(self.LINES_COUNT)
+        buffer = gcodes_buffer.PackedGcodesBuffer()
+        for start in range(0, len(lines), 1000):
+            buffer.extend_packed(*gcodes_cleaner.pack_lines(lines[start:start + 1000]))
+        self.assertEqual(buffer[-1], lines[-1])
+        popped = [buffer.popleft() for _ in range(len(lines) - 10)]
+        buffer.compact()
+        self.assertEqual(buffer.ends.typecode, 'H')
+        self.assertEqual(popped + list(buffer), lines)
+
+    @unittest.mock.patch.object(gcodes_buffer.SpilledGcodesBuffer, 'PAGE_SIZE', 200 * 1024)
+    def test_spilled_pages(self):
+        # window in memory and pages, that are written at once by a large extend, cross the boundary
+        lines = make_lines(self.LINES_COUNT * 2)
+        buffer = gcodes_buffer.SpilledGcodesBuffer(memory_limit=1, read_ahead_size=1 << 17)
+        try:
+            buffer.extend(lines[:10])
+            buffer.extend(lines[10:self.LINES_COUNT])
+            for start in range(self.LINES_COUNT, len(lines), 3000):
+                buffer.extend_packed(*gcodes_cleaner.pack_lines(lines[start:start + 3000]))
+            self.assertTrue(buffer.pages)
+            self.assertIn('Q', [page[3] for page in buffer.pages])
+            self.assertEqual(list(buffer), lines)
+            self.assertEqual(buffer[len(lines) // 2], lines[len(lines) // 2])
+            self.assertEqual([buffer.popleft() for _ in range(len(lines))], lines)
+        finally:
+            buffer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
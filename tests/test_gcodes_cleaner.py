@@ -0,0 +1,90 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+import tempfile
+import unittest
+import unittest.mock
+
+import tests
+
+import base_sender
+import gcodes_cleaner
+import process_pool
+
+
+class SplitLinesPackedTest(unittest.TestCase):
+    # split of chunks for the pool should give exactly the lines of the sequential split of BaseSender.preprocess_gcodes
+
+    CHUNK_SIZE = 16
+    INPUTS = [
+        b"G28\n\n\nG1 X1\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\nG1 X2\n\n\n\n",
+        b"G28\nG1 X1\n" + b"\n" * 100,
+        b"G28\r\nG1 X1\r\n\r\n\r\n" + b"\r\n" * 40 + b"G1 X2\r\n" + b"\r\n" * 40,
+        b"G1 X1\n\n" * 20 + b"G1 X2",
+        b"\n" * 50,
+        b"\n\n\nG28\n",
+        b"G28",
+        b"G1 X1234567890123456789012345678901234567890\n\nG1 Y1\n\n",
+    ]
+
+    def setUp(self):
+        self.pool_enabled = process_pool.ENABLED
+        process_pool.ENABLED = False
+        self.sender = base_sender.BaseSender(None, usb_info={'VID': '0000', 'PID': '0000', 'SNR': 'tests'})
+
+    def tearDown(self):
+        process_pool.ENABLED = self.pool_enabled
+
+    def split_in_chunks(self, data):
+        lines = []
+        for chunk, is_last in gcodes_cleaner.iterate_buffer_chunks(data, self.CHUNK_SIZE):
+            lines.extend(gcodes_cleaner.unpack_lines(*gcodes_cleaner.split_lines_packed(chunk, is_last)))
+        return lines
+
+    def test_blank_lines_at_chunk_boundaries_and_end(self):
+        for data in self.INPUTS:
+            with self.subTest(data=data):
+                expected = list(self.sender.preprocess_gcodes(data))
+                self.assertEqual(self.split_in_chunks(data), expected)
+                self.assertEqual(self.split_in_chunks(data.decode()), expected)
+
+    def test_pool(self):
+        data = self.INPUTS[0] * 1000 + self.INPUTS[1]
+        expected = list(self.sender.preprocess_gcodes(data))
+        chunk_size = process_pool.CHUNK_SIZE
+        process_pool.CHUNK_SIZE = 4096
+        try:
+            gcodes_out = self.sender.BUFFER_CLASS()
+            self.assertTrue(self.sender.preprocess_in_pool(data, gcodes_out))
+        finally:
+            process_pool.CHUNK_SIZE = chunk_size
+            process_pool.shutdown()
+        self.assertEqual(list(gcodes_out), expected)
+
+    @unittest.mock.patch.multiple(process_pool, ENABLED=True, MIN_SIZE=0, PROCESSES=2, CHUNK_SIZE=4096)
+    def test_pool_stop(self):
+        # gcodes, which were loaded partially before stop, should not be printed
+        with tempfile.NamedTemporaryFile(suffix='.gcode', delete=False) as f:
+            f.write(self.INPUTS[0] * 1000)
+        self.sender.stop_flag = True
+        self.sender.load_gcodes = unittest.mock.Mock()
+        try:
+            with self.assertRaises(process_pool.Stopped):
+                self.sender.process_gcodes_file(f.name)
+            self.assertFalse(self.sender.gcodes(f.name))
+        finally:
+            process_pool.shutdown()
+        self.sender.load_gcodes.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
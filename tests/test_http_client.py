@@ -0,0 +1,117 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+import base64
+import json
+import logging
+import threading
+import time
+import unittest
+import unittest.mock
+
+import tests
+
+import http_client
+
+
+class FakePrinterInterface:
+
+    def __init__(self):
+        self.logger = logging.getLogger('FakePrinterInterface')
+        self.stop_flag = False
+        self.offline_mode = True # no connection is made by the constructor
+
+    def register_error(self, *args, **kwargs):
+        pass
+
+
+@unittest.mock.patch.object(http_client.HTTPClient, 'COALESCE_REPORTS', True)
+class OutboundQueueTest(unittest.TestCase):
+
+    TIMEOUT = 5
+
+    def setUp(self):
+        parent = FakePrinterInterface()
+        self.client = http_client.HTTPClient(parent)
+        parent.offline_mode = False
+        self.sent = []
+        self.first_attempt_started = threading.Event()
+        self.first_attempt_release = threading.Event()
+        self.answers = {}
+        self.client.send_attempt = self.send_attempt
+
+    def send_attempt(self, path, data, headers=None, last_attempt=False):
+        self.sent.append(data)
+        if len(self.sent) == 1:
+            # the first attempt of the jobs request hangs and fails, as on a slow cloud
+            self.first_attempt_started.set()
+            self.first_attempt_release.wait(self.TIMEOUT)
+            return False, None
+        return True, {'answer_to': data}
+
+    def start_request(self, name, *payloads, **kwargs_payloads):
+        def request():
+            self.answers[name] = self.client.pack_and_send(*payloads, **kwargs_payloads)
+        thread = threading.Thread(target=request, daemon=True)
+        thread.start()
+        return thread
+
+    def wait_queue_length(self, length):
+        deadline = time.monotonic() + self.TIMEOUT
+        while len(self.client.outbound_queue) < length:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_priorities_and_coalescing(self):
+        threads = [self.start_request('jobs', http_client.HTTPClient.GET_JOBS, 'token')]
+        self.assertTrue(self.first_attempt_started.wait(self.TIMEOUT))
+        threads.append(self.start_request('logs', http_client.HTTPClient.CAMERA, 'token', 0, 'camera', 'frame'))
+        self.wait_queue_length(1)
+        threads.append(self.start_request('old_report', http_client.HTTPClient.COMMAND, 'token', {'state': 'printing', 'percent': 1}, None))
+        self.wait_queue_length(2)
+        threads.append(self.start_request('new_report', http_client.HTTPClient.COMMAND, 'token', {'state': 'printing', 'percent': 2}, None))
+        self.wait_queue_length(3)
+        threads.append(self.start_request('error_report', http_client.HTTPClient.COMMAND, 'token', {'state': 'error'}, None, error=[{'code': 1}]))
+        self.wait_queue_length(4)
+        threads.append(self.start_request('ack', http_client.HTTPClient.COMMAND, 'token', {'state': 'printing'}, {'number': 1, 'result': True}))
+        self.wait_queue_length(5)
+        self.first_attempt_release.set()
+        for thread in threads:
+            thread.join(self.TIMEOUT)
+        sent = self.sent[1:]
+        self.assertEqual(len(sent), 5)
+        self.assertIn('command_ack', sent[0])
+        self.assertIn('"percent": 2', sent[1])
+        self.assertIn('"error"', sent[2])
+        self.assertIn('printer_token', sent[3])
+        self.assertNotIn('report', sent[3])
+        self.assertIn('camera_name', sent[4])
+        self.assertIsNone(self.answers['old_report'])
+        self.assertEqual(self.answers['new_report'], {'answer_to': sent[1]})
+        self.assertEqual(self.answers['jobs'], {'answer_to': sent[3]})
+
+
+class DumpsTest(unittest.TestCase):
+
+    def test_frame_is_spliced(self):
+        frame = base64.b64encode(bytes(range(256)))
+        body = http_client.HTTPClient.dumps({'user_token': 'a"b', 'file_data': frame, 'host_mac': None})
+        self.assertIs(body[1], frame)
+        self.assertEqual(json.loads(b"".join(body)), {'user_token': 'a"b', 'file_data': frame.decode(), 'host_mac': None})
+
+    def test_other_bytes_are_not_spliced(self):
+        with self.assertRaises(TypeError):
+            http_client.HTTPClient.dumps({'report': b'"\\\n', 'file_data': b'AAAA'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# Copyright 3D Control Systems, Inc. All Rights Reserved 2017-2019.
+# Built in San Francisco.
+
+# This software is distributed under a commercial license for personal,
+# educational, corporate or any other use.
+# The software as a whole or any parts of it is prohibited for distribution or
+# use without obtaining a license from 3D Control Systems, Inc.
+
+# All software licenses are subject to the 3DPrinterOS terms of use
+# (available at https://www.3dprinteros.com/terms-and-conditions/),
+# and privacy policy (available at https://www.3dprinteros.com/privacy-policy/)
+
+import logging
+import unittest
+import unittest.mock
+
+import tests
+
+import job_prefetcher
+
+
+# queued job, shaped as a gcodes command with a link
+QUEUED_JOB = {
+    'id': 'f1d2c3b4',
+    'command': 'gcodes',
+    'is_link': True,
+    'payload': 'https://cloud.3dprinteros.com/files/f1d2c3b4/model.gcode?token=secret',
+    'filename': 'model.gcode',
+    'size': 1048576,
+    'sha256': 'a' * 64,
+    'zip': False,
+    'printing_duration': 3600,
+}
+
+
+class FakePrinterInterface:
+
+    def __init__(self, jobs_list):
+        self.logger = logging.getLogger('FakePrinterInterface')
+        self.stop_flag = False
+        self.downloader = None
+        self.jobs_list = jobs_list
+
+    def get_jobs_list(self, quiet=False):
+        assert quiet, 'periodic requests of the prefetcher should not flood the log'
+        return self.jobs_list, None
+
+
+class JobPrefetcherTest(unittest.TestCase):
+
+    def run_prefetcher(self, job):
+        prefetched_job_ids = set()
+        prefetcher = job_prefetcher.JobPrefetcher(FakePrinterInterface([job]), prefetched_job_ids)
+        with unittest.mock.patch.object(prefetcher, 'prefetch', return_value=True) as prefetch:
+            prefetcher.run()
+        return prefetch, prefetched_job_ids
+
+    def test_link(self):
+        self.assertEqual(job_prefetcher.JobPrefetcher.get_link(QUEUED_JOB), QUEUED_JOB['payload'])
+        prefetch, prefetched_job_ids = self.run_prefetcher(QUEUED_JOB)
+        prefetch.assert_called_once()
+        link, file_info = prefetch.call_args.args
+        self.assertEqual(link, QUEUED_JOB['payload'])
+        self.assertEqual(file_info['job_id'], QUEUED_JOB['id'])
+        self.assertEqual(prefetched_job_ids, {QUEUED_JOB['id']})
+
+    def test_no_link(self):
+        for job in (dict(QUEUED_JOB, is_link=False, payload='G28\nG1 X10'), {'id': 'f1d2c3b5', 'filename': 'model.gcode'}):
+            with self.subTest(job=sorted(job)):
+                with self.assertLogs(level='WARNING') as logs:
+                    prefetch, prefetched_job_ids = self.run_prefetcher(job)
+                prefetch.assert_not_called()
+                self.assertEqual(prefetched_job_ids, {job['id']})
+                self.assertIn('no recognisable download link', logs.output[0])
+                self.assertNotIn('G28', logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()